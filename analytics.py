@@ -0,0 +1,157 @@
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+TRADING_DAYS = 252  # Used to annualize volatility
+WINDOW = 20  # Default window for the rolling indicators
+
+# Copy a history's columns into NumPy arrays (days, closes, volumes) in date
+# order; a history not known to be sorted is ordered in the copy, not in place
+def history_arrays(history):
+    days = np.array(history.days, dtype=np.int64)
+    closes = np.array(history.closes, dtype=np.float64)
+    volumes = np.array(history.volumes, dtype=np.float64)
+    if not history.is_sorted():
+        order = np.argsort(days, kind="stable")
+        days, closes, volumes = days[order], closes[order], volumes[order]
+    return days, closes, volumes
+
+# Daily simple returns; the first value is NaN
+def returns(closes):
+    result = np.full(len(closes), np.nan)
+    if len(closes) > 1:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result[1:] = closes[1:] / closes[:-1] - 1.0
+    return result
+
+# Pad a rolling result with NaN so it lines up with the input
+def _pad(values, length):
+    result = np.full(length, np.nan)
+    if len(values):
+        result[length - len(values):] = values
+    return result
+
+# Rolling simple moving average; the first window - 1 values are NaN
+def moving_average(closes, window=WINDOW):
+    if len(closes) < window:
+        return np.full(len(closes), np.nan)
+    sums = np.cumsum(np.concatenate(([0.0], closes)))
+    return _pad((sums[window:] - sums[:-window]) / window, len(closes))
+
+# Exponential moving average seeded with the first close (alpha = 2 / (span + 1)).
+# The recurrence is solved in closed form over blocks short enough that the
+# decay factors cannot overflow, so the only Python loop is over blocks. With
+# span 1 nothing decays and the average is the closes themselves.
+def exponential_average(closes, span=WINDOW):
+    if span < 1:
+        raise ValueError(f"EMA span must be at least 1, not {span}.")
+    count = len(closes)
+    result = np.empty(count)
+    if not count:
+        return result
+    alpha = 2.0 / (span + 1.0)
+    decay = 1.0 - alpha
+    if decay == 0:
+        result[:] = closes
+        return result
+    block = max(1, int(200.0 / -math.log(decay)))
+    previous = closes[0]
+    for start in range(0, count, block):
+        chunk = closes[start:start + block]
+        steps = np.arange(1, len(chunk) + 1)
+        weights = decay ** -steps
+        result[start:start + len(chunk)] = (previous + alpha * np.cumsum(chunk * weights)) / weights
+        previous = result[start + len(chunk) - 1]
+    return result
+
+# Rolling standard deviation of daily returns, annualized by default
+def rolling_volatility(closes, window=WINDOW, annualize=True):
+    daily = returns(closes)[1:]
+    if len(daily) < window:
+        return np.full(len(closes), np.nan)
+    volatility = sliding_window_view(daily, window).std(axis=-1, ddof=1)
+    if annualize:
+        volatility = volatility * math.sqrt(TRADING_DAYS)
+    return _pad(volatility, len(closes))
+
+# Fraction below the running peak close (0 at a new high, negative below it)
+def drawdown(closes):
+    if not len(closes):
+        return np.empty(0)
+    return closes / np.maximum.accumulate(closes) - 1.0
+
+# Volume-weighted average price, cumulative or over a rolling window. Only daily
+# closes are stored, so the close stands in for each day's typical price.
+def vwap(closes, volumes, window=None):
+    turnover = np.cumsum(np.concatenate(([0.0], closes * volumes)))
+    volume = np.cumsum(np.concatenate(([0.0], volumes)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if window is None:
+            return turnover[1:] / volume[1:]
+        if len(closes) < window:
+            return np.full(len(closes), np.nan)
+        return _pad((turnover[window:] - turnover[:-window]) / (volume[window:] - volume[:-window]), len(closes))
+
+# All indicators for one history, as a dict of arrays aligned with its rows
+def indicators(history, window=WINDOW):
+    days, closes, volumes = history_arrays(history)
+    return {
+        "days": days,
+        "returns": returns(closes),
+        "moving_average": moving_average(closes, window),
+        "exponential_average": exponential_average(closes, window),
+        "volatility": rolling_volatility(closes, window),
+        "drawdown": drawdown(closes),
+        "vwap": vwap(closes, volumes),
+    }
+
+# Indicators for every stock in a portfolio: {symbol: indicators}
+def portfolio_indicators(stock_list, window=WINDOW):
+    return {stock.symbol: indicators(stock.history, window) for stock in stock_list if len(stock.history)}
+
+# Daily market value of the portfolio (shares x last known close) on every date
+# that any stock has a bar. Returns (days, values).
+def portfolio_value(stock_list):
+    stocks = [stock for stock in stock_list if len(stock.history)]
+    if not stocks:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    columns = [history_arrays(stock.history)[:2] for stock in stocks]
+    all_days = np.unique(np.concatenate([days for days, _ in columns]))
+    values = np.zeros(len(all_days))
+    for stock, (days, closes) in zip(stocks, columns):
+        last = np.searchsorted(days, all_days, side="right") - 1
+        held = last >= 0
+        values[held] += stock.shares * closes[last[held]]
+    return all_days, values
+
+# Latest indicator values for one stock, or None if it has no history
+def summarize(stock, window=WINDOW):
+    if not len(stock.history):
+        return None
+    days, closes, volumes = history_arrays(stock.history)
+    return {
+        "close": closes[-1],
+        "total_return": closes[-1] / closes[0] - 1.0 if closes[0] else math.nan,
+        "moving_average": moving_average(closes, window)[-1],
+        "exponential_average": exponential_average(closes, window)[-1],
+        "volatility": rolling_volatility(closes, window)[-1],
+        "max_drawdown": drawdown(closes).min(),
+        "vwap": vwap(closes, volumes)[-1],
+        "market_value": stock.shares * closes[-1],
+    }
+
+# Format a number, or "n/a" while there is not enough history for it
+def _format(value, spec):
+    return "n/a" if math.isnan(value) else format(value, spec)
+
+# One-line text version of summarize() for the console report and the GUI
+def format_summary(summary, window=WINDOW):
+    if summary is None:
+        return "No price history."
+    return (f"Return: {_format(summary['total_return'], '+.2%')}"
+            f" | SMA{window}: ${_format(summary['moving_average'], '.2f')}"
+            f" | EMA{window}: ${_format(summary['exponential_average'], '.2f')}"
+            f" | Vol{window}: {_format(summary['volatility'], '.1%')}"
+            f" | Max DD: {_format(summary['max_drawdown'], '.1%')}"
+            f" | VWAP: ${_format(summary['vwap'], '.2f')}"
+            f" | Value: ${summary['market_value']:,.2f}")
@@ -0,0 +1,380 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+from stock_class import Stock, Portfolio
+import stock_data
+import ledger
+import metrics
+
+# Headless entry point for scripted bulk work such as nightly cron refreshes.
+# Each subcommand runs one stage against the database without prompting; `run`
+# executes a JSON job of several stages in one process, so the portfolio is
+# loaded once and shared between them.
+#
+#   python batch.py fetch --start 1/1/24 --manifest symbols.csv
+#   python batch.py ingest --source downloads/ --add-missing
+#   python batch.py report --output prices.parquet --tier weekly
+#   python batch.py run nightly.json
+#
+# Symbol manifests are CSV (a header with a symbol column and optionally name
+# and shares, or just one symbol per line) or JSON (a list of symbols or of
+# {"symbol", "name", "shares"} objects, or such a list under "symbols").
+# Job manifests are JSON: a list of steps or {"steps": [...]}, each step naming
+# its command and giving that command's options as keys:
+#
+#   {"steps": [{"command": "fetch", "start": "1/1/24", "manifest": "symbols.csv"},
+#              {"command": "report", "output": "prices.csv"}]}
+#
+# Dates may be m/d/yy (as in the console) or YYYY-MM-DD.
+
+EXIT_OK = 0
+EXIT_FAILED = 1  # A stage failed
+EXIT_USAGE = 2  # Bad arguments or manifest
+EXIT_PARTIAL = 3  # Every stage ran, but some symbols failed
+SEVERITY = (EXIT_OK, EXIT_PARTIAL, EXIT_USAGE, EXIT_FAILED)  # Least to most serious
+
+
+# State shared by the stages of one batch: the portfolio, loaded from the
+# database on first use, and the time each stage took
+class Batch:
+    def __init__(self):
+        self._portfolio = None
+        self.timings = []  # (stage, seconds, exit status)
+
+    @property
+    def portfolio(self):
+        if self._portfolio is None:
+            self.load(lazy=True)
+        return self._portfolio
+
+    # Read the stocks from the database; lazily, histories are read on first use.
+    # Share counts are then taken from the ledger.
+    def load(self, lazy=True):
+        self._portfolio = Portfolio()
+        stock_data.load_stock_data(self._portfolio, lazy=lazy)
+        for discrepancy in ledger.sync_shares(self._portfolio):
+            print(ledger.format_discrepancy(discrepancy))
+        return self._portfolio
+
+    # Write pending changes; False if the save failed
+    def save(self):
+        return self._portfolio is None or stock_data.save_stock_data(self._portfolio)
+
+    # Run one stage, printing how long it took. Errors are reported and turned
+    # into an exit status.
+    def run_stage(self, options):
+        name = options.command
+        print(f"--- {name}")
+        start = time.perf_counter()
+        try:
+            with metrics.timer(f"batch.{name}"):
+                status = COMMANDS[name](self, options)
+        except ValueError as e:
+            print(f"[ERROR] {name}: {e}")
+            status = EXIT_USAGE
+        except (sqlite3.Error, OSError, RuntimeError) as e:
+            print(f"[ERROR] {name}: {e}")
+            status = EXIT_FAILED
+        elapsed = time.perf_counter() - start
+        self.timings.append((name, elapsed, status))
+        print(f"--- {name}: {elapsed:.2f} s, {'ok' if status == EXIT_OK else f'exit status {status}'}")
+        return status
+
+
+# Most serious of several exit statuses
+def worst(statuses):
+    return max(statuses, key=SEVERITY.index, default=EXIT_OK)
+
+# Date given as m/d/yy or YYYY-MM-DD
+def parse_date(text):
+    for fmt in ("%m/%d/%y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Dates must look like m/d/yy or YYYY-MM-DD: {text}")
+
+# Stocks listed in a symbol manifest as (symbol, name, shares); name and shares
+# are None when the manifest does not give them
+def read_manifest(path):
+    with open(path, newline="") as f:
+        if path.lower().endswith(".json"):
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = data.get("symbols", [])
+            entries = [{"symbol": entry} if isinstance(entry, str) else entry for entry in data]
+        else:
+            rows = [row for row in csv.reader(f) if row and row[0].strip()]
+            header = [column.strip().lower() for column in rows[0]] if rows else []
+            if "symbol" in header:
+                entries = [dict(zip(header, row)) for row in rows[1:]]
+            else:
+                entries = [{"symbol": row[0]} for row in rows]
+
+    stocks = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not str(entry.get("symbol") or "").strip():
+            raise ValueError(f"{path}: every entry needs a symbol.")
+        shares = entry.get("shares")
+        try:
+            shares = float(shares) if shares not in (None, "") else None
+        except ValueError:
+            raise ValueError(f"{path}: bad share count for {entry['symbol']}: {shares}")
+        stocks.append((str(entry["symbol"]).strip().upper(), entry.get("name") or None, shares))
+    return stocks
+
+# Manifest entries and --symbols of a stage, or None to mean every stock
+def selected_entries(options):
+    entries = read_manifest(options.manifest) if getattr(options, "manifest", None) else []
+    entries += [(symbol.upper(), None, None) for symbol in getattr(options, "symbols", None) or []]
+    return entries or None
+
+# Add the stocks of manifest entries that are not in the portfolio yet (their
+# shares recorded as a purchase, as in the console); returns every entry's stock
+def add_stocks(portfolio, entries):
+    stocks = []
+    for symbol, name, shares in entries:
+        stock = portfolio.get(symbol)
+        if stock is None:
+            stock = Stock(symbol, name or symbol, 0)
+            portfolio.add(stock)
+            if shares:
+                ledger.buy(stock, shares)
+        stocks.append(stock)
+    return stocks
+
+# Import CSV files (a file, folder or glob pattern) or, with --ticks, replay a
+# tick feed file, then save everything in one transaction
+def ingest(batch, options):
+    if not glob.glob(options.source) and not os.path.exists(options.source):
+        raise FileNotFoundError(f"Nothing to ingest at {options.source}.")
+    if options.ticks:
+        import ticks
+
+        result = ticks.ingest(batch.portfolio, ticks.read_tick_file(options.source), add_missing=options.add_missing,
+                              save=False)
+        print(f"{result.ticks} ticks made {result.bars} daily bars over {result.sessions} sessions.")
+    else:
+        result = stock_data.import_stock_csv_files(batch.portfolio, options.source, processes=options.processes,
+                                                   add_missing=options.add_missing)
+        print(f"{result.inserted} bars added, {result.updated} updated, {result.unchanged} unchanged.")
+    return EXIT_OK if batch.save() else EXIT_FAILED
+
+# Download the bars a set of stocks is missing (every stock by default),
+# adding manifest stocks that are new, then save
+def fetch(batch, options):
+    entries = selected_entries(options)
+    stocks = Portfolio(add_stocks(batch.portfolio, entries)) if entries else batch.portfolio
+    start = parse_date(options.start).strftime("%m/%d/%y")
+    end = (parse_date(options.end) if options.end else date.today()).strftime("%m/%d/%y")
+    failed = []
+
+    def progress(result, done, total):
+        if result.error is not None:
+            failed.append(result.symbol)
+
+    try:
+        records = stock_data.retrieve_stock_web(start, end, stocks, workers=options.workers,
+                                                per_second=options.per_second, progress=progress,
+                                                incremental=not options.full, cache=not options.no_cache)
+    finally:
+        saved = batch.save()
+    print(f"{records} bars downloaded for {len(stocks)} stocks; {len(failed)} requests failed.")
+    if not saved:
+        return EXIT_FAILED
+    return EXIT_PARTIAL if failed else EXIT_OK
+
+# Read every stock and its bars, optionally writing the snapshot the console
+# and GUI open at startup
+def load(batch, options):
+    import snapshot
+
+    portfolio = batch.load(lazy=False)
+    bars = sum(len(stock.history) for stock in portfolio)
+    print(f"{len(portfolio)} stocks and {bars} daily bars in {stock_data.database().path}.")
+    if options.snapshot and not snapshot.save_snapshot(portfolio, options.snapshot, stock_data.database().path):
+        return EXIT_FAILED
+    return EXIT_OK
+
+# Add the stocks of a manifest and bring names and share counts in line with
+# it (changes recorded in the ledger), then save
+def save(batch, options):
+    entries = selected_entries(options) or []
+    portfolio = batch.portfolio
+    count = len(portfolio)
+    add_stocks(portfolio, entries)
+    for symbol, name, shares in entries:
+        stock = portfolio.get(symbol)
+        if name and name != stock.name:
+            stock.name = name
+        if shares is not None and shares != stock.shares:
+            if shares > stock.shares:
+                ledger.buy(stock, shares - stock.shares)
+            else:
+                ledger.sell(stock, stock.shares - shares)
+    print(f"{len(entries)} stocks in the manifest, {len(portfolio) - count} new.")
+    return EXIT_OK if batch.save() else EXIT_FAILED
+
+# Export the selected bars to a csv, jsonl, arrow or parquet file
+def export(batch, options):
+    import report
+
+    entries = selected_entries(options)
+    count = report.export_report(batch.portfolio, options.output, options.format,
+                                 symbols=[symbol for symbol, _, _ in entries] if entries else None,
+                                 date_start=parse_date(options.start) if options.start else None,
+                                 date_end=parse_date(options.end) if options.end else None, tier=options.tier)
+    print(f"{count} rows written to {options.output}.")
+    return EXIT_OK
+
+# Bring the schema up to date, then optionally change the retention policy
+# and reclaim free space
+def migrate(batch, options):
+    path = stock_data.database().path
+    before = 0
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+        try:
+            before = conn.execute("PRAGMA user_version;").fetchone()[0]
+        finally:
+            conn.close()
+    stock_data.create_database()
+    print(f"Schema version {before} -> {stock_data.SCHEMA_VERSION}.")
+    if options.retention is not None:
+        deleted = stock_data.set_retention(round(options.retention) or None)
+        print(f"{deleted} daily bars compacted.")
+    if options.vacuum:
+        stock_data.vacuum_database()
+    return EXIT_OK
+
+# Command-line arguments for the options of a job step
+def step_arguments(step):
+    if not isinstance(step, dict) or step.get("command") not in STEP_COMMANDS:
+        raise ValueError(f"Each step needs a command, one of {', '.join(STEP_COMMANDS)}: {step}")
+    argv = [step["command"]]
+    for key, value in step.items():
+        flag = "--" + key.replace("_", "-")
+        if key == "command" or value is None or value is False:
+            continue
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list):
+            argv += [flag, *map(str, value)]
+        else:
+            argv += [flag, str(value)]
+    return argv
+
+# Run the steps of a job manifest in order. Every step is checked before the
+# first one runs; the job stops at the first failed step unless --keep-going.
+def run(batch, options):
+    with open(options.job) as f:
+        steps = json.load(f)
+    if isinstance(steps, dict):
+        steps = steps.get("steps", [])
+    parser = make_parser()
+    parsed = []
+    for step in steps:
+        argv = step_arguments(step)
+        try:
+            parsed.append(parser.parse_args(argv))
+        except SystemExit:
+            raise ValueError(f"Bad options in step {step}")
+
+    statuses = []
+    for step in parsed:
+        statuses.append(batch.run_stage(step))
+        if statuses[-1] in (EXIT_FAILED, EXIT_USAGE) and not options.keep_going:
+            print(f"Stopped after {len(statuses)} of {len(parsed)} steps.")
+            break
+    return worst(statuses)
+
+COMMANDS = {
+    "ingest": ingest,
+    "fetch": fetch,
+    "load": load,
+    "save": save,
+    "report": export,
+    "migrate": migrate,
+    "run": run,
+}
+STEP_COMMANDS = [name for name in COMMANDS if name != "run"]
+
+# Options for --symbols and --manifest
+def add_selection(parser):
+    parser.add_argument("--symbols", nargs="+", help="ticker symbols")
+    parser.add_argument("--manifest", help="CSV or JSON file listing the symbols")
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="batch.py", description="Run stock data jobs without prompting.")
+    parser.add_argument("--database", default=stock_data.DATABASE_FILE, help="SQLite database file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("ingest", help="import CSV files or a tick feed file")
+    command.add_argument("--source", required=True, help="CSV file, folder or glob pattern, or a tick file")
+    command.add_argument("--ticks", action="store_true", help="the source is a SYMBOL,TIMESTAMP,PRICE,SIZE tick file")
+    command.add_argument("--add-missing", action="store_true", help="add stocks that are not in the database")
+    command.add_argument("--processes", type=int, help="worker processes for parsing CSV files")
+
+    command = commands.add_parser("fetch", help="download missing bars for a date range")
+    add_selection(command)
+    command.add_argument("--start", required=True, help="first date")
+    command.add_argument("--end", help="last date (default today)")
+    command.add_argument("--workers", type=int, default=8, help="concurrent requests")
+    command.add_argument("--per-second", type=float, default=4.0, help="most requests started per second")
+    command.add_argument("--full", action="store_true", help="download the whole range, not just missing bars")
+    command.add_argument("--no-cache", action="store_true", help="do not reuse downloaded pages")
+
+    command = commands.add_parser("load", help="read every stock and bar from the database")
+    command.add_argument("--snapshot", help="also write a snapshot file here")
+
+    command = commands.add_parser("save", help="add stocks and update names and shares from a manifest")
+    add_selection(command)
+
+    command = commands.add_parser("report", help="export bars to csv, jsonl, arrow or parquet")
+    add_selection(command)
+    command.add_argument("--output", required=True, help="file to write; the extension picks the format")
+    command.add_argument("--format", help="csv, jsonl, arrow or parquet")
+    command.add_argument("--start", help="first date")
+    command.add_argument("--end", help="last date")
+    command.add_argument("--tier", default="daily", help="daily, weekly, monthly or auto")
+
+    command = commands.add_parser("migrate", help="upgrade the database schema")
+    command.add_argument("--retention", type=float, help="days of daily bars to keep (0 keeps all)")
+    command.add_argument("--vacuum", action="store_true", help="reclaim free space afterwards")
+
+    command = commands.add_parser("run", help="run the steps of a JSON job manifest")
+    command.add_argument("job", help="JSON job manifest")
+    command.add_argument("--keep-going", action="store_true", help="run later steps after a failed one")
+    return parser
+
+def main(argv=None):
+    options = make_parser().parse_args(argv)
+    batch = Batch()
+    with stock_data.open_database(options.database):
+        if options.command != "run":
+            status = batch.run_stage(options)
+        else:
+            try:
+                status = run(batch, options)
+            except ValueError as e:
+                print(f"[ERROR] {options.job}: {e}")
+                status = EXIT_USAGE
+            except OSError as e:
+                print(f"[ERROR] {options.job}: {e}")
+                status = EXIT_FAILED
+    if len(batch.timings) > 1:
+        print("\n=== Stages ===")
+        for name, elapsed, stage_status in batch.timings:
+            print(f"{name:10s} {elapsed:9.2f} s  exit status {stage_status}")
+        print(f"{'total':10s} {sum(elapsed for _, elapsed, _ in batch.timings):9.2f} s")
+    return status
+
+if __name__ == "__main__":
+    metrics.configure()
+    sys.exit(main())
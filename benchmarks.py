@@ -0,0 +1,737 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from stock_class import Stock, DailyEntry, History, Portfolio, from_epoch_day, to_epoch_day
+
+STARTUP_BUDGET_MS = 150  # Import time allowed for each entry point module
+STARTUP_MODULES = ("stock_console", "gui")
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")  # Saved history pages
+# Loaded on first use only; none of these may be imported at startup
+DEFERRED_MODULES = ("numpy", "matplotlib", "analytics", "stock_web", "html.parser", "urllib.request",
+                    "concurrent.futures", "selenium", "bs4")
+
+# Build a list of DailyEntry objects, one per day starting on 1/1/00
+def make_entries(rows):
+    start = datetime(2000, 1, 1)
+    return [DailyEntry(start + timedelta(days=i), 10.0 + (i % 97) * 0.25, 1000.0 + i) for i in range(rows)]
+
+# Weekday day numbers covering the given years from 1/3/00
+def trading_days(years):
+    first_day = to_epoch_day(datetime(2000, 1, 3))
+    return array("q", (day for day in range(first_day, first_day + int(years * 365.25)) if (day + 3) % 7 < 5))
+
+# Build a portfolio of synthetic stocks with weekday bars over the given years.
+# Closes are a random walk and volumes are random, both drawn from a generator
+# seeded per symbol, so the same arguments always give the same portfolio.
+def make_portfolio(symbols, years, seed=0):
+    days = trading_days(years)
+    stocks = Portfolio()
+    for n in range(symbols):
+        rng = random.Random(f"{seed}:{n}")
+        close = 20.0 + rng.random() * 80.0
+        closes = array("d")
+        volumes = array("d")
+        for _ in range(len(days)):
+            close = max(1.0, close * (1.0 + rng.gauss(0.0003, 0.02)))
+            closes.append(round(close, 2))
+            volumes.append(float(rng.randrange(1000, 1000000)))
+        stock = Stock(f"S{n:05d}", f"Synthetic {n}", float(rng.randrange(1, 500)))
+        stock.history.extend_columns(days, closes, volumes)
+        stocks.append(stock)
+    return stocks
+
+# Copy of a portfolio's stocks without their histories
+def empty_portfolio(stocks):
+    return Portfolio(Stock(stock.symbol, stock.name, 0) for stock in stocks)
+
+# Measure the memory held by `build()` after it returns
+def measure_memory(build):
+    tracemalloc.start()
+    data = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, current
+
+# Time a callable, keeping the best of a few runs
+def measure_time(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Compare the columnar History store against a plain list of DailyEntry objects
+def bench_history(rows):
+    entries, list_bytes = measure_memory(lambda: make_entries(rows))
+    history, history_bytes = measure_memory(lambda: History(entries))
+
+    list_rows = measure_time(lambda: sum(d.close for d in entries))
+    history_rows = measure_time(lambda: sum(d.close for d in history))
+    history_column = measure_time(lambda: sum(history.closes))
+
+    print(f"\n=== History store: {rows} rows ===")
+    print(f"List of DailyEntry : {list_bytes / rows:8.1f} bytes/row")
+    print(f"History columns    : {history_bytes / rows:8.1f} bytes/row")
+    print(f"Iterate list       : {list_rows * 1000:8.2f} ms")
+    print(f"Iterate row views  : {history_rows * 1000:8.2f} ms")
+    print(f"Scan close column  : {history_column * 1000:8.2f} ms")
+    return {"rows": rows, "list_bytes_per_row": list_bytes / rows, "history_bytes_per_row": history_bytes / rows,
+            "iterate_list_s": list_rows, "iterate_rows_s": history_rows, "scan_column_s": history_column}
+
+# Time a full save, a save with nothing changed, a save after one share update,
+# eager and lazy loads of the saved database, and whole-range chart points drawn
+# from the rollups (a 200 point budget) against the daily bars (2000 points)
+def bench_database(symbols, years, seed=0):
+    import stock_data
+    import utilities
+
+    stocks = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in stocks)
+    lazy_stocks = Portfolio()
+    with tempfile.TemporaryDirectory() as folder, stock_data.open_database(os.path.join(folder, "stocks.db")):
+        stock_data.create_database()
+        full = measure_time(lambda: stock_data.save_stock_data(stocks, wal=True, synchronous="NORMAL"), repeat=1)
+        unchanged = measure_time(lambda: stock_data.save_stock_data(stocks))
+        stocks[0].buy(1)
+        one_change = measure_time(lambda: stock_data.save_stock_data(stocks), repeat=1)
+
+        def one_buy():
+            stocks[0].buy(1)
+            stock_data.save_stock_data(stocks)
+
+        small_save = measure_time(one_buy, repeat=20)
+        eager = measure_time(lambda: stock_data.load_stock_data(Portfolio()), repeat=1)
+        lazy = measure_time(lambda: stock_data.load_stock_data(lazy_stocks, lazy=True), repeat=1)
+        utilities.date_offset()  # Loads matplotlib outside the timing
+        rollup_chart = measure_time(lambda: [utilities.chart_points(stock, max_points=200) for stock in lazy_stocks],
+                                    repeat=1)
+        histories = measure_time(lambda: [len(stock.history) for stock in lazy_stocks], repeat=1)
+        daily_chart = measure_time(lambda: [utilities.chart_points(stock, max_points=2000) for stock in stocks],
+                                   repeat=1)
+
+    print(f"\n=== stocks.db: {symbols} symbols, {rows} rows ===")
+    print(f"Full save          : {full * 1000:8.2f} ms")
+    print(f"Nothing changed    : {unchanged * 1000:8.2f} ms")
+    print(f"One share update   : {one_change * 1000:8.2f} ms")
+    print(f"Buy + save, warm   : {small_save * 1000:8.2f} ms")
+    print(f"Load (eager)       : {eager * 1000:8.2f} ms")
+    print(f"Load (lazy)        : {lazy * 1000:8.2f} ms")
+    print(f"Lazy histories     : {histories * 1000:8.2f} ms ({histories / symbols * 1e6:.0f} us each)")
+    print(f"Charts, rollups    : {rollup_chart * 1000:8.2f} ms (lazy stocks, whole range)")
+    print(f"Charts, daily bars : {daily_chart * 1000:8.2f} ms (loaded stocks, whole range)")
+    return {"symbols": symbols, "rows": rows, "save_full_s": full, "save_unchanged_s": unchanged,
+            "save_one_change_s": one_change, "save_small_s": small_save, "load_eager_s": eager,
+            "load_lazy_s": lazy, "lazy_histories_s": histories, "chart_rollup_s": rollup_chart,
+            "chart_daily_s": daily_chart}
+
+# Time writing a portfolio snapshot and opening it, against loading the same
+# portfolio from stocks.db, plus a first full scan of the mapped closes
+def bench_snapshot(symbols, years, seed=0):
+    import snapshot
+    import stock_data
+
+    stocks = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in stocks)
+    with tempfile.TemporaryDirectory() as folder, stock_data.open_database(os.path.join(folder, "stocks.db")) as db:
+        path = os.path.join(folder, snapshot.SNAPSHOT_FILE)
+        stock_data.save_stock_data(stocks)
+        write = measure_time(lambda: snapshot.save_snapshot(stocks, path, db.path), repeat=1)
+        size = os.path.getsize(path)
+        database = measure_time(lambda: stock_data.load_stock_data(Portfolio()), repeat=1)
+        opened = Portfolio()
+        open_time = measure_time(lambda: snapshot.load_snapshot(opened, path))
+        scan = measure_time(lambda: sum(sum(stock.history.closes) for stock in opened), repeat=1)
+        del opened  # Releases the mapping before the folder is removed
+
+    print(f"\n=== Snapshot: {symbols} symbols, {rows} rows, {size / 1e6:.1f} MB ===")
+    print(f"Write snapshot     : {write * 1000:8.2f} ms")
+    print(f"Load stocks.db     : {database * 1000:8.2f} ms")
+    print(f"Open snapshot      : {open_time * 1000:8.2f} ms")
+    print(f"Scan mapped closes : {scan * 1000:8.2f} ms")
+    return {"symbols": symbols, "rows": rows, "file_bytes": size, "write_s": write, "database_load_s": database,
+            "open_s": open_time, "scan_s": scan}
+
+# Time add_entry into random stocks at random dates as the portfolio grows.
+# The cost per entry should stay flat since nothing is re-sorted.
+def bench_add_entry(sizes=(100, 1000, 5000), entries=2000, seed=0):
+    print(f"\n=== add_entry: {entries} entries ===")
+    results = {"entries": entries}
+    for symbols in sizes:
+        stocks = make_portfolio(symbols, 1, seed)
+        rng = random.Random(symbols)
+        first, last = stocks[0].history.days[0], stocks[0].history.days[-1]
+        bars = [(rng.choice(stocks), DailyEntry(from_epoch_day(rng.randint(first, last + 30)), 1.0, 1.0))
+                for _ in range(entries)]
+
+        def add_all():
+            for stock, entry in bars:
+                stock.add_entry(entry)
+
+        elapsed = measure_time(add_all, repeat=1)
+        print(f"{symbols:5d} symbols      : {elapsed / entries * 1e6:8.2f} us/entry")
+        results[f"per_entry_{symbols}_symbols_s"] = elapsed / entries
+    return results
+
+# Time sort_stock_history_by_date on histories whose rows arrived out of order
+def bench_sort(symbols, years, seed=0):
+    from utilities import sort_stock_history_by_date
+
+    source = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in source)
+    stocks = empty_portfolio(source)
+    for stock, original in zip(stocks, source):
+        order = list(range(len(original.history)))
+        random.Random(stock.symbol).shuffle(order)
+        history = original.history
+        for i in order:
+            stock.history.append_row(history.days[i], history.closes[i], history.volumes[i])
+
+    shuffled = measure_time(lambda: sort_stock_history_by_date(stocks), repeat=1)
+    already = measure_time(lambda: sort_stock_history_by_date(stocks))
+    print(f"\n=== sort_stock_history_by_date: {symbols} symbols, {rows} rows ===")
+    print(f"Shuffled histories : {shuffled * 1000:8.2f} ms")
+    print(f"Already sorted     : {already * 1000:8.2f} ms")
+    return {"symbols": symbols, "rows": rows, "shuffled_s": shuffled, "sorted_s": already}
+
+# Time the full indicator set for every stock plus the portfolio value series
+def bench_analytics(symbols, years, seed=0):
+    import analytics
+
+    stocks = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in stocks)
+    indicators = measure_time(lambda: analytics.portfolio_indicators(stocks), repeat=1)
+    value = measure_time(lambda: analytics.portfolio_value(stocks), repeat=1)
+    print(f"\n=== analytics: {symbols} symbols, {rows} rows ===")
+    print(f"All indicators     : {indicators * 1000:8.2f} ms")
+    print(f"Portfolio value    : {value * 1000:8.2f} ms")
+    return {"symbols": symbols, "rows": rows, "indicators_s": indicators, "portfolio_value_s": value}
+
+# Time the pairwise covariance/correlation matrices on 1, 2, 4 and 8 workers,
+# plus one rolling correlation run over every pair
+def bench_pairwise(symbols, years, seed=0, worker_counts=(1, 2, 4, 8)):
+    import pairwise
+
+    stocks = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in stocks)
+    print(f"\n=== pairwise: {symbols} symbols, {rows} rows, {os.cpu_count()} CPUs ===")
+    matrices = {}
+    for workers in worker_counts:
+        seconds = measure_time(lambda: pairwise.correlation_matrices(stocks, workers=workers, block=32), repeat=1)
+        matrices[str(workers)] = seconds
+        print(f"Matrices, {workers} worker(s): {seconds * 1000:8.2f} ms"
+              f"  (x{matrices['1'] / seconds:.2f})")
+    rolling = measure_time(lambda: pairwise.rolling_correlations(stocks, workers=max(worker_counts)), repeat=1)
+    print(f"Rolling, all pairs : {rolling * 1000:8.2f} ms")
+    return {"symbols": symbols, "rows": rows, "cpus": os.cpu_count(), "matrices_s": matrices, "rolling_s": rolling}
+
+# Time the console report, rendered into memory instead of the terminal, and
+# the CSV and JSON lines exports
+def bench_report(symbols, years, seed=0):
+    import analytics  # Loaded on first use by the report; keep that out of the timing
+    import report
+
+    stocks = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in stocks)
+    output = io.StringIO()
+
+    def render():
+        output.seek(0)
+        output.truncate()
+        report.render_report(stocks, output)
+
+    elapsed = measure_time(render, repeat=1)
+    size = len(output.getvalue())
+    print(f"\n=== report: {symbols} symbols, {rows} rows ===")
+    print(f"Render             : {elapsed * 1000:8.2f} ms ({size / 1e6:.1f} MB of text)")
+    result = {"symbols": symbols, "rows": rows, "render_s": elapsed, "text_bytes": size}
+    with tempfile.TemporaryDirectory() as folder:
+        for fmt in ("csv", "jsonl"):
+            filename = os.path.join(folder, "report." + fmt)
+            seconds = measure_time(lambda: report.export_report(stocks, filename), repeat=1)
+            print(f"Export {fmt:11s} : {seconds * 1000:8.2f} ms ({os.path.getsize(filename) / 1e6:.1f} MB)")
+            result[f"export_{fmt}_s"] = seconds
+    return result
+
+# Time chart data preparation for every stock, over the full range and over the
+# last year, downsampled to a typical plot width
+def bench_chart(symbols, years, seed=0, max_points=1000):
+    from utilities import chart_points
+
+    stocks = make_portfolio(symbols, years, seed)
+    rows = sum(len(stock.history) for stock in stocks)
+    last_year = from_epoch_day(stocks[0].history.days[-1]) - timedelta(days=365)
+    chart_points(stocks[0])  # Loads NumPy and matplotlib.dates outside the timing
+    full = measure_time(lambda: [chart_points(stock, max_points=max_points) for stock in stocks], repeat=1)
+    window = measure_time(lambda: [chart_points(stock, last_year, max_points=max_points) for stock in stocks],
+                          repeat=1)
+    print(f"\n=== chart_points: {symbols} symbols, {rows} rows, {max_points} points ===")
+    print(f"Full range         : {full * 1000:8.2f} ms")
+    print(f"Last year          : {window * 1000:8.2f} ms")
+    return {"symbols": symbols, "rows": rows, "max_points": max_points, "full_range_s": full, "last_year_s": window}
+
+# Render a stock's history as a Yahoo! Finance style history page
+def make_history_page(stock):
+    rows = []
+    for day, close, volume in zip(stock.history.days, stock.history.closes, stock.history.volumes):
+        date = from_epoch_day(day).strftime("%b %d, %Y")
+        rows.append(f"<tr><td><span>{date}</span></td><td>{close:.2f}</td><td>{close:.2f}</td>"
+                    f"<td>{close:.2f}</td><td>{close:.2f}</td><td>{close:.2f}</td><td>{int(volume):,}</td></tr>")
+    return ("<html><body><table><thead><tr><th>Date</th><th>Open</th><th>High</th><th>Low</th>"
+            "<th>Close</th><th>Adj Close</th><th>Volume</th></tr></thead><tbody>"
+            + "".join(rows) + "</tbody></table></body></html>")
+
+# Write one history page per synthetic stock into `folder` as SYMBOL.html
+def record_fixtures(folder, symbols, years, seed=0):
+    os.makedirs(folder, exist_ok=True)
+    for stock in make_portfolio(symbols, years, seed):
+        with open(os.path.join(folder, f"{stock.symbol}.html"), "w", encoding="utf-8") as f:
+            f.write(make_history_page(stock))
+
+# Time parse_history_page over saved history pages (*.html in `fixtures`).
+# Without a fixtures folder, pages are recorded from a synthetic portfolio first.
+def bench_parse(symbols, years, seed=0, fixtures=None):
+    import stock_web
+
+    with tempfile.TemporaryDirectory() as folder:
+        if fixtures is None:
+            record_fixtures(folder, symbols, years, seed)
+            fixtures = folder
+        pages = []
+        for filename in sorted(glob.glob(os.path.join(fixtures, "*.html"))):
+            with open(filename, encoding="utf-8") as f:
+                pages.append(f.read())
+
+    stock_web.parse_page_date.cache_clear()
+    parsed = []
+    elapsed = measure_time(lambda: parsed.extend(stock_web.parse_history_page(page) for page in pages), repeat=1)
+    rows = sum(len(columns[0]) for columns, _ in parsed)
+    failures = sum(failures for _, failures in parsed)
+    size = sum(len(page) for page in pages)
+    print(f"\n=== parse_history_page: {len(pages)} pages, {rows} rows ===")
+    print(f"Parse              : {elapsed * 1000:8.2f} ms ({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+    return {"pages": len(pages), "rows": rows, "failures": failures, "page_bytes": size, "parse_s": elapsed}
+
+# Parser regression check against the saved AAPL page in FIXTURES_FOLDER: the
+# price rows come back newest first with Adj Close as the close, the dividend
+# row is skipped, and only the page with its price rows removed counts as empty.
+# Prints each problem and returns True when there are none.
+def check_parse():
+    import re
+    import stock_web
+
+    with open(os.path.join(FIXTURES_FOLDER, "AAPL_history.html"), encoding="utf-8") as f:
+        page = f.read()
+    issues = []
+    (days, closes, volumes), failures = stock_web.parse_history_page(page)
+    expected_days = [to_epoch_day(datetime(2020, 2, day)) for day in (11, 10, 7, 6, 5, 4, 3)]
+    if list(days) != expected_days:
+        issues.append(f"days {[from_epoch_day(day).strftime('%m/%d/%y') for day in days]}")
+    if list(closes) != [315.87, 317.79, 316.29, 320.65, 316.94, 314.38, 304.33]:
+        issues.append(f"closes {list(closes)}")
+    if list(volumes) != [23580800, 27337200, 29421000, 26356400, 29706700, 34154100, 43496400]:
+        issues.append(f"volumes {list(volumes)}")
+    if failures:
+        issues.append(f"{failures} rows failed to parse")
+    if stock_web.is_empty_history(page):
+        issues.append("the page was taken for an empty history")
+    if not stock_web.is_empty_history(re.sub(r"<tbody>.*</tbody>", "<tbody></tbody>", page, flags=re.S)):
+        issues.append("the page without price rows was not taken for an empty history")
+    if stock_web.is_empty_history(re.sub(r"<table.*</table>", "", page, flags=re.S)):
+        issues.append("the page without a table was taken for an empty history")
+    for issue in issues:
+        print(f"[ERROR] {issue}")
+    print(f"\n=== check_parse: {'passed' if not issues else f'{len(issues)} problems'} ===")
+    return not issues
+
+# Serve pages ({symbol: html}) from a local stand-in for Yahoo! Finance.
+# Every response is delayed by `latency` seconds to mimic the network.
+def serve_pages(pages, latency=0.0):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.split("/")
+            page = pages.get(parts[2]) if len(parts) > 2 and parts[1] == "quote" else None
+            time.sleep(latency)
+            if page is None:
+                self.send_error(404)
+                return
+            body = page.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Fetch a synthetic portfolio from the local stand-in server with 1 and 8
+# workers, then time a refresh that only fills gaps, and a cold and a warm
+# fetch through the page cache
+def bench_fetch(symbols, years, latency=0.05, seed=0):
+    import stock_data
+    import stock_web
+
+    source = make_portfolio(symbols, years, seed)
+    pages = {stock.symbol: make_history_page(stock) for stock in source}
+    server = serve_pages(pages, latency)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    last_date = from_epoch_day(source[0].history.days[-1]).strftime("%m/%d/%y")
+    results = {"symbols": symbols, "latency_s": latency}
+
+    def fetch(stocks, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return measure_time(lambda: stock_data.retrieve_stock_web(
+                "01/01/00", last_date, stocks, per_second=0, base_url=base_url, **options), repeat=1)
+
+    print(f"\n=== retrieve_stock_web: {symbols} symbols, {latency * 1000:.0f} ms latency ===")
+    # Planning reads stocks.db, so it gets a throwaway one
+    with tempfile.TemporaryDirectory() as scratch, stock_data.open_database(os.path.join(scratch, "stocks.db")):
+        try:
+            for workers in (1, 8):
+                stocks = empty_portfolio(source)
+                elapsed = fetch(stocks, workers=workers, cache=False)
+                rows = sum(len(stock.history) for stock in stocks)
+                print(f"{workers} worker(s)        : {elapsed * 1000:8.2f} ms ({rows} rows)")
+                results[f"workers_{workers}_s"] = elapsed
+                results["rows"] = rows
+
+            # Every other stock loses a 60 day stretch of bars
+            for stock in stocks[::2]:
+                days = stock.history.days
+                keep = [i for i, day in enumerate(days) if not days[100] <= day < days[100] + 60]
+                columns = [array(column.typecode, (column[i] for i in keep))
+                           for column in (days, stock.history.closes, stock.history.volumes)]
+                stock.history.clear()
+                stock.history.extend_columns(*columns)
+            requests = len(stock_data.plan_fetch(stocks, "01/01/00", last_date))
+            elapsed = fetch(stocks, cache=False)
+            print(f"Gap-only refresh   : {elapsed * 1000:8.2f} ms ({requests} requests)")
+            results["gap_refresh_s"] = elapsed
+            results["gap_refresh_requests"] = requests
+
+            with tempfile.TemporaryDirectory() as folder:
+                cache = stock_web.FetchCache(folder)
+                for label, key in (("Cold cache", "cold_cache_s"), ("Warm cache", "warm_cache_s")):
+                    results[key] = fetch(empty_portfolio(source), cache=cache)
+                    print(f"{label:19s}: {results[key] * 1000:8.2f} ms")
+        finally:
+            server.shutdown()
+    return results
+
+# Write a stock's history as a Yahoo! Finance CSV file
+def write_history_csv(stock, filename):
+    with open(filename, "w", newline="") as f:
+        f.write("Date,Open,High,Low,Close,Adj Close,Volume\n")
+        for day, close, volume in zip(stock.history.days, stock.history.closes, stock.history.volumes):
+            date = from_epoch_day(day).strftime("%Y-%m-%d")
+            f.write(f"{date},{close:.2f},{close:.2f},{close:.2f},{close:.2f},{close:.2f},{int(volume)}\n")
+
+# Import synthetic CSV files one by one, then as a folder with 1 and 4 processes
+def bench_csv_import(symbols, years, seed=0):
+    import stock_data
+
+    source = make_portfolio(symbols, years, seed)
+    print(f"\n=== CSV import: {symbols} files ===")
+    with tempfile.TemporaryDirectory() as folder:
+        for stock in source:
+            write_history_csv(stock, os.path.join(folder, f"{stock.symbol}.csv"))
+
+        def import_each():
+            stocks = empty_portfolio(source)
+            for stock in stocks:
+                stock_data.import_stock_web_csv(stocks, stock.symbol, os.path.join(folder, f"{stock.symbol}.csv"))
+
+        def import_folder(processes):
+            return stock_data.import_stock_csv_files(empty_portfolio(source), folder, processes=processes)
+
+        rows = import_folder(1).inserted
+        results = {"symbols": symbols, "rows": rows, "one_at_a_time_s": measure_time(import_each, repeat=1)}
+        print(f"One file at a time : {results['one_at_a_time_s'] * 1000:8.2f} ms ({rows} rows)")
+        for processes in (1, 4):
+            elapsed = measure_time(lambda: import_folder(processes), repeat=1)
+            print(f"Folder, {processes} process(es): {elapsed * 1000:7.2f} ms")
+            results[f"folder_{processes}_processes_s"] = elapsed
+    return results
+
+# Write a tick feed file: `sessions` trading days of ticks spread over market
+# hours, on a random walk per symbol
+def write_tick_file(filename, symbols, sessions, ticks_per_session, seed=0):
+    import ticks
+
+    rng = random.Random(seed)
+    names = [f"T{n:04d}" for n in range(symbols)]
+    prices = [rng.uniform(10, 500) for _ in names]
+    open_time = 19000 * 86400 + 9.5 * 3600 - ticks.SESSION_UTC_OFFSET
+    step = 6.5 * 3600 / ticks_per_session
+    with open(filename, "w") as f:
+        for session in range(sessions):
+            start = open_time + session * 86400
+            lines = []
+            for n in range(ticks_per_session):
+                i = rng.randrange(symbols)
+                prices[i] *= 1 + rng.gauss(0, 0.0005)
+                lines.append(f"{names[i]},{start + n * step:.3f},{prices[i]:.4f},{rng.randint(1, 1000)}\n")
+            f.writelines(lines)
+
+# Bars saved from a tick replay that differ from OHLC bars built tick by tick
+# from the same ticks; returns (symbol, day, expected, saved) tuples
+def check_tick_bars(chunks, stocks):
+    import ticks
+
+    expected = {}
+    for symbol, timestamp, price, size in (tick for chunk in chunks for tick in chunk):
+        key = (symbol, int(timestamp + ticks.SESSION_UTC_OFFSET) // 86400)
+        bar = expected.get(key)
+        if bar is None:
+            expected[key] = [price, price, price, price, size]
+        else:
+            bar[1], bar[2], bar[3], bar[4] = max(bar[1], price), min(bar[2], price), price, bar[4] + size
+    saved = {(stock.symbol, to_epoch_day(row.date)): [row.open, row.high, row.low, row.close, row.volume]
+             for stock in stocks for row in stock.history}
+    mismatches = [(key[0], key[1], bar, saved.get(key)) for key, bar in expected.items()
+                  if saved.get(key) is None or any(abs(a - b) > 1e-6 for a, b in zip(bar, saved[key]))]
+    mismatches += [(key[0], key[1], None, bar) for key, bar in saved.items() if key not in expected]
+    return mismatches
+
+# Parse and aggregate a tick feed file, then replay it into a portfolio and a
+# temporary stocks.db with a save at every session close
+def bench_ticks(symbols, sessions=5, ticks_per_session=200000, seed=0):
+    import stock_data
+    import ticks
+
+    total = sessions * ticks_per_session
+    print(f"\n=== Ticks: {symbols} symbols, {sessions} sessions, {total} ticks ===")
+    with tempfile.TemporaryDirectory() as folder, stock_data.open_database(os.path.join(folder, "stocks.db")):
+        path = os.path.join(folder, "ticks.csv")
+        write_tick_file(path, symbols, sessions, ticks_per_session, seed)
+        chunks = []
+        parse = measure_time(lambda: chunks.extend(ticks.read_tick_file(path)), repeat=1)
+
+        def aggregate():
+            ticks.TickAggregator(lambda *bar: None).add_many(tick for chunk in chunks for tick in chunk)
+
+        fold = measure_time(aggregate, repeat=1)
+        result = None
+
+        def replay():
+            nonlocal result
+            result = ticks.ingest(Portfolio(), ticks.read_tick_file(path), add_missing=True)
+
+        ingest = measure_time(replay, repeat=1)
+        saved = Portfolio()
+        stock_data.load_stock_data(saved)
+        mismatches = check_tick_bars(chunks, saved)
+    for label, elapsed in (("Parse", parse), ("Aggregate", fold), ("Ingest and save", ingest)):
+        print(f"{label:<19}: {elapsed * 1000:8.2f} ms ({total / elapsed:,.0f} ticks/s)")
+    print(f"Bars written       : {result.bars}")
+    if mismatches:
+        raise AssertionError(f"{len(mismatches)} replayed bars differ from the ticks, first {mismatches[0]}")
+    return {"symbols": symbols, "ticks": total, "bars": result.bars, "parse_s": parse, "aggregate_s": fold,
+            "ingest_s": ingest}
+
+# Append trades to the ledger one transaction per trade and in group commits,
+# then time reopening it, rebuilding positions and querying one symbol and a
+# time range
+def bench_ledger(trades=200000, symbols=500, seed=0):
+    import ledger
+
+    rng = random.Random(seed)
+    rows = [(f"S{rng.randrange(symbols):05d}", "BUY" if rng.random() < 0.6 else "SELL",
+             float(rng.randrange(1, 100)), round(rng.uniform(10, 200), 2), 1.6e9 + i * 60) for i in range(trades)]
+    single = min(trades, 2000)
+    print(f"\n=== ledger: {trades} trades, {symbols} symbols ===")
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "ledger.db")
+        with ledger.Ledger(os.path.join(folder, "single.db"), batch_size=1) as trade_log:
+            one_by_one = measure_time(lambda: [trade_log.record(*row) for row in rows[:single]], repeat=1)
+
+        def write():
+            with ledger.Ledger(path) as trade_log:
+                for row in rows:
+                    trade_log.record(*row)
+
+        grouped = measure_time(write, repeat=1)
+        opened = measure_time(lambda: ledger.Ledger(path).close())
+        with ledger.Ledger(path) as trade_log:
+            positions = measure_time(trade_log.positions)
+            by_symbol = measure_time(lambda: trade_log.trade_ids("S00001"))
+            day = measure_time(lambda: trade_log.trade_ids(start=1.6e9 + 86400 * 30, end=1.6e9 + 86400 * 31))
+
+    print(f"One per commit     : {one_by_one / single * 1e6:8.2f} us/trade")
+    print(f"Group commit       : {grouped / trades * 1e6:8.2f} us/trade")
+    print(f"Open               : {opened * 1000:8.2f} ms")
+    print(f"Positions          : {positions * 1000:8.2f} ms")
+    print(f"One symbol         : {by_symbol * 1000:8.2f} ms")
+    print(f"One day            : {day * 1000:8.2f} ms")
+    return {"trades": trades, "single_commit_per_trade_s": one_by_one / single,
+            "group_commit_per_trade_s": grouped / trades, "open_s": opened, "positions_s": positions, "symbol_query_s": by_symbol, "day_query_s": day}
+
+# Per-call cost of the instrumentation calls with metrics off and on, over a
+# loop that makes the same call without them
+def bench_metrics(calls=200000):
+    import metrics
+
+    def call():
+        pass
+
+    timed_call = metrics.timed("bench.call")(call)
+
+    def bare():
+        for _ in range(calls):
+            call()
+
+    def instrumented():
+        for _ in range(calls):
+            metrics.count("bench.count")
+            with metrics.timer("bench.timer"):
+                timed_call()
+
+    baseline = measure_time(bare)
+    off = measure_time(instrumented)
+    metrics.enable()
+    on = measure_time(instrumented, repeat=1)
+    metrics.disable()
+    metrics.reset()
+    print(f"\n=== metrics: count + timer + timed call ===")
+    print(f"Disabled           : {(off - baseline) / calls * 1e9:8.1f} ns/call overhead")
+    print(f"Enabled            : {(on - baseline) / calls * 1e9:8.1f} ns/call overhead")
+    return {"calls": calls, "disabled_overhead_s": (off - baseline) / calls,
+            "enabled_overhead_s": (on - baseline) / calls}
+
+# Import `module` in a fresh interpreter with -X importtime. Returns the total
+# import time in seconds and the DEFERRED_MODULES that got loaded with it.
+def measure_import(module):
+    code = f"import sys, {module}; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            loaded = result.stdout.strip()
+            return int(fields[1]) / 1e6, loaded.split(",") if loaded else []
+    raise RuntimeError(f"No import time reported for {module}")
+
+# Import time of each entry point (median of a few runs) against STARTUP_BUDGET_MS
+def bench_startup(runs=5):
+    print(f"\n=== Startup imports (budget {STARTUP_BUDGET_MS} ms) ===")
+    results = {"budget_s": STARTUP_BUDGET_MS / 1000}
+    for module in STARTUP_MODULES:
+        samples = sorted(measure_import(module) for _ in range(runs))
+        elapsed, loaded = samples[len(samples) // 2]
+        verdict = "ok" if elapsed * 1000 <= STARTUP_BUDGET_MS and not loaded else "OVER BUDGET"
+        extra = f", loaded {', '.join(loaded)}" if loaded else ""
+        print(f"{module:19s}: {elapsed * 1000:8.2f} ms {verdict}{extra}")
+        results[f"{module}_s"] = elapsed
+        results[f"{module}_deferred_loaded"] = loaded
+    return results
+
+# Startup regression check: True when every entry point imports within budget
+# and without any of the DEFERRED_MODULES
+def check_startup(runs=5):
+    results = bench_startup(runs)
+    return all(results[f"{module}_s"] * 1000 <= STARTUP_BUDGET_MS and not results[f"{module}_deferred_loaded"]
+               for module in STARTUP_MODULES)
+
+# Commit the benchmarks ran against, or None outside a git checkout
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+# Print every timing (keys ending in _s) next to the same timing from an earlier run
+def compare_results(results, baseline):
+    print(f"\n=== Compared with {baseline['meta'].get('commit') or 'baseline'} ===")
+    for name, metrics in results.items():
+        old = baseline["results"].get(name, {})
+        for key, value in metrics.items():
+            if key.endswith("_s") and old.get(key):
+                print(f"{name + '.' + key:36s}: {value / old[key]:6.2f}x"
+                      f" ({old[key] * 1000:.2f} -> {value * 1000:.2f} ms)")
+
+# Each benchmark takes the parsed command line and returns a dict of metrics
+BENCHMARKS = {
+    "history": lambda args: bench_history(args.rows),
+    "add_entry": lambda args: bench_add_entry(seed=args.seed),
+    "database": lambda args: bench_database(args.symbols, args.years, args.seed),
+    "snapshot": lambda args: bench_snapshot(args.symbols, args.years, args.seed),
+    "sort": lambda args: bench_sort(args.symbols, args.years, args.seed),
+    "analytics": lambda args: bench_analytics(args.symbols, args.years, args.seed),
+    "pairwise": lambda args: bench_pairwise(args.symbols, args.years, args.seed),
+    "report": lambda args: bench_report(args.symbols, args.years, args.seed),
+    "chart": lambda args: bench_chart(args.symbols, args.years, args.seed),
+    "parse": lambda args: bench_parse(min(args.symbols, 50), args.years, args.seed, args.fixtures),
+    "fetch": lambda args: bench_fetch(min(args.symbols, 40), 2, seed=args.seed),
+    "csv_import": lambda args: bench_csv_import(args.symbols, args.years, args.seed),
+    "ticks": lambda args: bench_ticks(args.symbols, seed=args.seed),
+    "ledger": lambda args: bench_ledger(seed=args.seed),
+    "metrics": lambda args: bench_metrics(),
+    "startup": lambda args: bench_startup(),
+}
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the stock application on synthetic data, offline.")
+    parser.add_argument("--symbols", type=int, default=200, help="stocks in the synthetic portfolio")
+    parser.add_argument("--years", type=float, default=10, help="years of daily bars per stock")
+    parser.add_argument("--rows", type=int, default=100000, help="rows for the History store benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic data")
+    parser.add_argument("--fixtures", help="folder of saved history pages (*.html) for the parse benchmark")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to compare against")
+    parser.add_argument("--check-startup", action="store_true",
+                        help="only check entry point import times; exit with status 1 if over budget")
+    parser.add_argument("--check-parse", action="store_true",
+                        help="only check the history page parser against the saved fixture; exit with status 1 on failure")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.check_startup:
+        sys.exit(0 if check_startup() else 1)
+    if args.check_parse:
+        sys.exit(0 if check_parse() else 1)
+    results = {name: BENCHMARKS[name](args) for name in args.only or BENCHMARKS}
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+    if args.json:
+        meta = {
+            "commit": git_commit(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "symbols": args.symbols,
+            "years": args.years,
+            "seed": args.seed,
+        }
+        with open(args.json, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+if __name__ == "__main__":
+    main()
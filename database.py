@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import metrics
+
+# Shared access to one SQLite file from any thread: a single writer connection
+# behind a lock plus a small pool of reader connections, all opened once and
+# reused. Under WAL (the default) readers never block the writer or each other.
+# Each connection keeps its own cache of prepared statements.
+#
+#   with Database("stocks.db") as db:
+#       with db.reader() as conn: ...       # queries
+#       with db.transaction() as conn: ...  # writes, committed together
+
+DATABASE_FILE = "stocks.db"
+READERS = 4  # Most reader connections kept open
+CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+BUSY_TIMEOUT = 5.0  # Seconds a connection waits for a lock held by another process
+
+# Settings applied to every connection. page_size only changes a database that
+# is still empty (or on the next VACUUM).
+DEFAULT_PRAGMAS = {
+    "cache_size": -16384,  # Negative: KiB, so 16 MiB per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+PRAGMAS = ("page_size", "cache_size", "mmap_size", "temp_store", "synchronous", "foreign_keys")
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+class Database:
+    # `prepare(conn)` runs once on the writer connection before anything else,
+    # to create or upgrade the schema.
+    def __init__(self, path=DATABASE_FILE, readers=READERS, wal=True, synchronous=None, pragmas=None,
+                 prepare=None):
+        self.path = os.path.abspath(path)
+        self.readers = readers
+        self.wal = wal
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        if synchronous is not None:
+            self.pragmas["synchronous"] = synchronous
+        for name in self.pragmas:
+            if name not in PRAGMAS:
+                raise ValueError(f"Unknown pragma: {name}")
+        if "synchronous" in self.pragmas and str(self.pragmas["synchronous"]).upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode: {self.pragmas['synchronous']}")
+        self._prepare = prepare
+        self._write_lock = threading.RLock()
+        self._pool_lock = threading.Lock()
+        self._writer = None
+        self._idle = []  # Reader connections not in use
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value};")
+        metrics.count("db.connections")
+        return conn
+
+    # The writer connection, opened (and the schema prepared) on first use.
+    # Callers hold _write_lock.
+    def _writer_connection(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError(f"{self.path} has been closed.")
+        if self._writer is None:
+            conn = self._connect()
+            try:
+                if self.wal:
+                    conn.execute("PRAGMA journal_mode=WAL;")
+                if self._prepare is not None:
+                    self._prepare(conn)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._writer = conn
+        return self._writer
+
+    # Writer connection for the duration of the block, for work that manages
+    # its own transactions (schema changes, chunked copies)
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            yield self._writer_connection()
+
+    # Writer connection inside one transaction: committed when the block ends,
+    # rolled back if it raises
+    @contextmanager
+    def transaction(self):
+        with self._write_lock:
+            conn = self._writer_connection()
+            with conn:
+                yield conn
+
+    # A reader connection from the pool for the duration of the block. The
+    # schema is prepared first, so readers never see an old layout.
+    @contextmanager
+    def reader(self):
+        with self._pool_lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            if self._writer is None:
+                with self._write_lock:
+                    self._writer_connection()
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._pool_lock:
+                if self._closed or len(self._idle) >= self.readers:
+                    conn.close()
+                else:
+                    self._idle.append(conn)
+
+    # Close every connection; readers still in use are closed when returned
+    def close(self):
+        with self._write_lock, self._pool_lock:
+            self._closed = True
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
@@ -1,21 +1,221 @@
 from tkinter import *
-from tkinter import messagebox, filedialog, simpledialog
+from tkinter import messagebox, filedialog, simpledialog, ttk
+import queue
+import threading
+import time
+from contextlib import closing
 import stock_data
-from stock_class import Stock
-from utilities import *
-import csv
+import snapshot
+import ledger
+import metrics
+from stock_class import Stock, Portfolio, from_epoch_day
+from utilities import show_price_chart
+
+# A unit of background work. `work(job)` runs on the worker thread and calls
+# job.report() to send progress and partial results back to the Tk thread.
+class Job:
+    def __init__(self, name, work, on_partial=None, on_done=None, locks_portfolio=False, cancellable=False):
+        self.name = name
+        self.work = work
+        self.on_partial = on_partial  # Called on the Tk thread with each partial result
+        self.on_done = on_done  # Called on the Tk thread with the work's return value
+        self.locks_portfolio = locks_portfolio  # Stocks must not change while it runs
+        self.cancellable = cancellable  # The work checks `cancelled` and stops early
+        self.fraction = 0.0
+        self.message = "Waiting..."
+        self._cancel = threading.Event()
+        self._handled = threading.Event()  # Set once the Tk thread has run on_done
+        self._outbox = None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def report(self, fraction=None, message=None, partial=None):
+        self._outbox.put(("progress", self, fraction, message, partial))
+
+
+# Runs queued jobs one at a time on a worker thread. Everything a job reports
+# is delivered on the Tk thread by polling with root.after, a few milliseconds
+# of messages per tick so the window keeps repainting. The next job starts only
+# after the Tk thread has handled the previous one's result.
+class TaskQueue:
+    POLL_MS = 50
+    POLL_BUDGET = 0.02  # Seconds of message handling per tick
+
+    def __init__(self, root, on_update):
+        self._root = root
+        self._on_update = on_update
+        self._jobs = queue.Queue()
+        self._outbox = queue.Queue()
+        self.current = None
+        self.pending = 0
+        self._locking = 0  # Jobs submitted with locks_portfolio and not handled yet
+        threading.Thread(target=self._run, daemon=True).start()
+        self._root.after(self.POLL_MS, self._poll)
+
+    # Set from submit until the result is handled, both on the Tk thread, so a
+    # change can never slip in between the check and the job starting
+    @property
+    def portfolio_locked(self):
+        return self._locking > 0
+
+    def submit(self, job):
+        job._outbox = self._outbox
+        self.pending += 1
+        if job.locks_portfolio:
+            self._locking += 1
+        self._jobs.put(job)
+        self._on_update(self)
+
+    def cancel_current(self):
+        if self.current is not None and self.current.cancellable:
+            self.current.cancel()
+            self.current.message = "Cancelling..."
+            self._on_update(self)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            self._outbox.put(("start", job))
+            start = time.perf_counter()
+            try:
+                self._outbox.put(("done", job, job.work(job)))
+            except Exception as e:
+                self._outbox.put(("error", job, e))
+            metrics.record("gui.job." + job.name.split()[0].lower(), time.perf_counter() - start)
+            job._handled.wait()
+
+    # Polling is rescheduled even when a handler raises, so later messages
+    # (and the worker waiting on them) are never stranded
+    def _poll(self):
+        deadline = time.monotonic() + self.POLL_BUDGET
+        try:
+            while time.monotonic() < deadline:
+                self._handle(self._outbox.get_nowait())
+                metrics.count("gui.messages")
+        except queue.Empty:
+            pass
+        finally:
+            self._root.after(self.POLL_MS, self._poll)
+
+    def _handle(self, message):
+        kind, job = message[0], message[1]
+        if kind == "start":
+            self.pending -= 1
+            self.current = job
+            job.message = "Running..."
+        elif kind == "progress":
+            fraction, text, partial = message[2:]
+            if fraction is not None:
+                job.fraction = fraction
+            if text is not None:
+                job.message = text
+            if partial is not None and job.on_partial:
+                job.on_partial(partial)
+        else:
+            self.current = None
+            if job.locks_portfolio:
+                self._locking -= 1
+            try:
+                if kind == "error":
+                    messagebox.showerror(job.name, f"{job.name} failed: {message[2]}")
+                elif job.on_done:
+                    job.on_done(message[2])
+            finally:
+                job._handled.set()
+        self._on_update(self)
+
+
+# Read-only text pane that only formats and draws the rows in view. Content is
+# a few header lines plus `count` rows produced on demand by `row_text(i)`;
+# the scrollbar is driven by hand, so showing a million rows costs the same
+# as showing ten.
+class VirtualTextView:
+    WHEEL_ROWS = 3
+
+    def __init__(self, parent, width, height, **options):
+        self.frame = Frame(parent)
+        self.text = Text(self.frame, width=width, height=height, wrap=NONE, state=DISABLED, **options)
+        self.scrollbar = Scrollbar(self.frame, command=self.scroll)
+        self.text.grid(row=0, column=0, sticky=NSEW)
+        self.scrollbar.grid(row=0, column=1, sticky=NS)
+        self.text.bind("<MouseWheel>", lambda event: self.scroll("scroll", -1 if event.delta > 0 else 1, "wheel"))
+        self.text.bind("<Button-4>", lambda event: self.scroll("scroll", -1, "wheel"))
+        self.text.bind("<Button-5>", lambda event: self.scroll("scroll", 1, "wheel"))
+        self.text.bind("<Prior>", lambda event: self.scroll("scroll", -1, "pages"))
+        self.text.bind("<Next>", lambda event: self.scroll("scroll", 1, "pages"))
+        self.header = []
+        self.count = 0
+        self.row_text = None
+        self.top = 0
+
+    def grid(self, **options):
+        self.frame.grid(**options)
+
+    def page_rows(self):
+        return max(1, int(self.text.cget("height")) - len(self.header))
+
+    def show(self, header, count=0, row_text=None, keep_position=False):
+        self.header = list(header)
+        self.count = count
+        self.row_text = row_text
+        if not keep_position:
+            self.top = 0
+        self.render()
+
+    def clear(self):
+        self.show([])
+
+    # Scrollbar and wheel callback: ("moveto", fraction) or ("scroll", n, units)
+    def scroll(self, action, amount, units=None):
+        if action == "moveto":
+            self.top = int(float(amount) * self.count)
+        elif units == "pages":
+            self.top += int(amount) * self.page_rows()
+        elif units == "wheel":
+            self.top += int(amount) * self.WHEEL_ROWS
+        else:
+            self.top += int(amount)
+        self.render()
+        return "break"
+
+    @metrics.timed("gui.render")
+    def render(self):
+        rows = self.page_rows()
+        self.top = max(0, min(self.top, self.count - rows))
+        stop = min(self.count, self.top + rows)
+        lines = self.header + [self.row_text(i) for i in range(self.top, stop)]
+        self.text.config(state=NORMAL)
+        self.text.delete("1.0", END)
+        self.text.insert("1.0", "\n".join(lines))
+        self.text.config(state=DISABLED)
+        if self.count:
+            self.scrollbar.set(self.top / self.count, stop / self.count)
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
 
 class StockApp:
+    LOG_PAGE = 200  # Trades fetched at a time by the transaction log
+
     def __init__(self):
         self.root = Tk()
         self.root.title("KM Stock Application")
         self.root.geometry("1000x600")
         self.root.configure(bg="#cce6ff") 
 
-        self.stocks = []
-        self.logs = []
+        self.stocks = Portfolio()
+        self.info_symbol = None  # Symbol shown in the info pane
+        self.info_cache = {}  # Symbol -> (history, version, shares, header lines, {row: text})
 
         self.setup_layout()
+        self.tasks = TaskQueue(self.root, self.update_task_status)
+        if snapshot.snapshot_is_current(database=stock_data.database().path):
+            self.open_snapshot()
         self.root.mainloop()
 
     def setup_layout(self):
@@ -56,34 +256,115 @@ class StockApp:
 
         Button(self.root, text="Show Chart", command=self.show_chart).grid(row=13, column=1, columnspan=2, pady=10)
         Button(self.root, text="Transaction Report", command=self.show_log).grid(row=14, column=1, columnspan=2)
+        Button(self.root, text="Load DB", width=10, command=self.load_data).grid(row=15, column=1, pady=5)
+        Button(self.root, text="Save DB", width=10, command=self.save_data).grid(row=15, column=2, pady=5)
+        Button(self.root, text="Save Snapshot", command=self.save_snapshot).grid(row=16, column=1, columnspan=2, pady=2)
+
+        self.info_view = VirtualTextView(self.root, width=60, height=22, font=("Courier", 10))
+        self.info_view.grid(row=2, column=3, rowspan=10, padx=10, pady=5)
+
+        self.task_progress = ttk.Progressbar(self.root, length=420, maximum=1.0)
+        self.task_progress.grid(row=12, column=3, padx=10, sticky=W)
+        self.task_label = Label(self.root, text="Idle", bg="#cce6ff", anchor=W, width=60)
+        self.task_label.grid(row=13, column=3, padx=10, sticky=W)
+        self.cancel_button = Button(self.root, text="Cancel", state=DISABLED, command=self.cancel_task)
+        self.cancel_button.grid(row=14, column=3, padx=10, sticky=W)
+
+    # Refresh the progress bar, status line and cancel button from the task queue
+    def update_task_status(self, tasks):
+        job = tasks.current
+        if job is None:
+            self.task_progress["value"] = 0
+            self.task_label.config(text="Idle" if not tasks.pending else f"{tasks.pending} job(s) queued")
+            self.cancel_button.config(state=DISABLED)
+            return
+        queued = f" ({tasks.pending} queued)" if tasks.pending else ""
+        self.task_progress["value"] = job.fraction
+        self.task_label.config(text=f"{job.name}: {job.message}{queued}")
+        self.cancel_button.config(state=NORMAL if job.cancellable and not job.cancelled else DISABLED)
+
+    def cancel_task(self):
+        self.tasks.cancel_current()
+
+    # Stocks cannot be edited while a save is writing them
+    def portfolio_busy(self):
+        if self.tasks.portfolio_locked:
+            messagebox.showinfo("Busy", "Please wait for the save to finish.")
+            return True
+        return False
+
+    def selected_symbol(self):
+        if not self.stock_listbox.curselection():
+            return None
+        return self.stock_listbox.get(self.stock_listbox.curselection())
 
-        self.info_box = Text(self.root, width=60, height=20, font=("Courier", 10))
-        self.info_box.grid(row=2, column=3, rowspan=10, padx=10, pady=5)
+    def refresh_stock_list(self):
+        self.stock_listbox.delete(0, END)
+        for symbol in self.stocks.symbols():
+            self.stock_listbox.insert(END, symbol)
+        self.info_cache.clear()
+        self.clear_info()
+
+    def clear_info(self):
+        self.info_symbol = None
+        self.info_view.clear()
 
     def add_stock(self):
+        if self.portfolio_busy():
+            return
         try:
             symbol = self.entry_symbol.get().upper()
             name = self.entry_name.get()
             shares = float(self.entry_shares.get())
-            stock = Stock(symbol, name, shares)
-            self.stocks.append(stock)
-            self.stock_listbox.insert(END, symbol)
+            if symbol in self.stocks:
+                messagebox.showerror("Error", f"{symbol} is already in the list.")
+                return
+            stock = Stock(symbol, name, 0)
+            self.stocks.add(stock)
+            if shares:
+                ledger.buy(stock, shares)
+            self.stock_listbox.insert(self.stocks.index(symbol), symbol)
             self.entry_symbol.delete(0, END)
             self.entry_name.delete(0, END)
             self.entry_shares.delete(0, END)
         except:
             messagebox.showerror("Error", "Please enter valid stock details!!!")
 
+    # Formatted summary and rows for a stock. The summary is rebuilt when the
+    # history or the share count (part of its value) changes; the rows only
+    # when the history does.
+    def info_entry(self, stock):
+        import analytics
+
+        history = stock.history
+        entry = self.info_cache.get(stock.symbol)
+        if entry is None or entry[0] is not history or entry[1] != history.version:
+            entry = None
+        if entry is None or entry[2] != stock.shares:
+            summary = analytics.format_summary(analytics.summarize(stock)).split(" | ")
+            entry = (history, history.version, stock.shares, summary, entry[4] if entry else {})
+            self.info_cache[stock.symbol] = entry
+        return entry
+
+    @metrics.timed("gui.show_info")
     def show_info(self, event):
-        self.info_box.delete("1.0", END)
-        if not self.stock_listbox.curselection():
+        symbol = self.selected_symbol()
+        stock = self.stocks.get(symbol) if symbol else None
+        if stock is None:
+            self.clear_info()
             return
-        symbol = self.stock_listbox.get(self.stock_listbox.curselection())
-        for stock in self.stocks:
-            if stock.symbol == symbol:
-                self.info_box.insert(END, f"{stock.name} ({stock.symbol})\nShares: {stock.shares}\n")
-                for d in stock.history:  
-                    self.info_box.insert(END, f"{d.date.strftime('%m/%d/%y')} - ${d.close:.2f} - Vol: {int(d.volume)}\n")
+        history, _, _, summary, rows = self.info_entry(stock)
+        days, closes, volumes = history.days, history.closes, history.volumes
+
+        def row_text(i):
+            text = rows.get(i)
+            if text is None:
+                text = rows[i] = f"{from_epoch_day(days[i]).strftime('%m/%d/%y')} - ${closes[i]:.2f} - Vol: {int(volumes[i])}"
+            return text
+
+        header = [f"{stock.name} ({stock.symbol})", f"Shares: {stock.shares}"] + summary
+        self.info_view.show(header, len(history), row_text, keep_position=symbol == self.info_symbol)
+        self.info_symbol = symbol
 
     def buy_shares(self):
         self._update_shares(buy=True)
@@ -92,65 +373,182 @@ class StockApp:
         self._update_shares(buy=False)
 
     def _update_shares(self, buy):
-        if not self.stock_listbox.curselection():
+        if not self.stock_listbox.curselection() or self.portfolio_busy():
             return
         try:
             amount = float(self.entry_update.get())
             symbol = self.stock_listbox.get(self.stock_listbox.curselection())
-            for stock in self.stocks:
-                if stock.symbol == symbol:
-                    if buy:
-                        stock.buy(amount)
-                        self.logs.append(f"Bought {amount} shares of {symbol}")
-                    else:
-                        stock.sell(amount)
-                        self.logs.append(f"Sold {amount} shares of {symbol}")
-                    self.show_info(None)
+            stock = self.stocks.get(symbol)
+            if stock is not None:
+                if buy:
+                    ledger.buy(stock, amount)
+                else:
+                    ledger.sell(stock, amount)
+                self.show_info(None)
         except:
             messagebox.showerror("Error", "Invalid number.")
 
     def delete_stock(self):
-        if not self.stock_listbox.curselection():
+        if not self.stock_listbox.curselection() or self.portfolio_busy():
             return
         index = self.stock_listbox.curselection()[0]
-        del self.stocks[index]
+        removed = self.stocks.remove(self.stock_listbox.get(index))
+        if removed is not None and removed.shares:
+            ledger.sell(removed, removed.shares)
+        self.info_cache.pop(self.stock_listbox.get(index), None)
         self.stock_listbox.delete(index)
-        self.info_box.delete("1.0", END)
+        self.clear_info()
 
+    # Pages are fetched and parsed on the worker; each symbol's bars are merged
+    # here on the Tk thread as soon as they arrive
     def scrape_data(self):
+        import stock_web
+
         start = simpledialog.askstring("Start Date", "Enter start date (m/d/yy):")
         end = simpledialog.askstring("End Date", "Enter end date (m/d/yy):")
+        if not start or not end:
+            return
         try:
-            stock_data.retrieve_stock_web(start, end, self.stocks)
-            self.show_info(None)
-            messagebox.showinfo("Done", "Web data retrieved.")
-        except:
-            messagebox.showerror("Error", "Failed to retrieve from web.")
+            requests = stock_data.plan_fetch(self.stocks, start, end)
+        except ValueError:
+            messagebox.showerror("Error", "Dates must look like m/d/yy.")
+            return
+        if not requests:
+            messagebox.showinfo("Done", "All stocks are up to date.")
+            return
+        symbols = sorted({symbol for symbol, _, _ in requests})
+        failed = []
+
+        def work(job):
+            fetched = []
+            with closing(stock_web.fetch_ranges(requests, cache=stock_data.fetch_cache())) as results:
+                for done, result in enumerate(results, start=1):
+                    fetched.append(result)
+                    job.report(done / len(requests), f"{result.symbol} ({done}/{len(requests)})", result)
+                    if job.cancelled:
+                        break
+            stock_data.save_empty_ranges(fetched)
+            return len({result.symbol for result in fetched})
+
+        def merge(result):
+            stock = self.stocks.get(result.symbol)
+            if result.error is not None:
+                failed.append(result.symbol)
+            elif stock is not None:
+                stock.merge_columns(*result.columns)
+                if result.symbol == self.selected_symbol():
+                    self.show_info(None)
+
+        def done(count):
+            if failed:
+                messagebox.showerror("Error", f"Failed to retrieve: {', '.join(sorted(set(failed)))}")
+            else:
+                messagebox.showinfo("Done", f"Web data retrieved for {count} of {len(symbols)} stocks.")
+
+        self.tasks.submit(Job("Scrape", work, on_partial=merge, on_done=done, cancellable=True))
 
     def import_csv(self):
-        if not self.stock_listbox.curselection():
+        symbol = self.selected_symbol()
+        if symbol is None:
             return
-        symbol = self.stock_listbox.get(self.stock_listbox.curselection())
         file_path = filedialog.askopenfilename(filetypes=[("CSV Files", "*.csv")])
-        if file_path:
-            stock_data.import_stock_web_csv(self.stocks, symbol, file_path)
-            self.show_info(None)
+        if not file_path:
+            return
+
+        def done(columns):
+            stock = self.stocks.get(symbol)
+            if stock is not None:
+                stock.merge_columns(*columns)
+                if symbol == self.selected_symbol():
+                    self.show_info(None)
             messagebox.showinfo("Import Complete", f"CSV imported for {symbol}")
 
+        self.tasks.submit(Job(f"Import {symbol}", lambda job: stock_data.read_csv_columns(file_path), on_done=done))
+
+    # Stocks are read into a new portfolio on the worker, histories lazily
+    def load_data(self):
+        def work(job):
+            portfolio = Portfolio()
+            stock_data.load_stock_data(portfolio, lazy=True)
+            return portfolio
+
+        def done(portfolio):
+            self.stocks = portfolio
+            self.refresh_stock_list()
+            self.sync_shares()
+
+        self.tasks.submit(Job("Load", work, on_done=done))
+
+    def save_data(self):
+        def done(saved):
+            if saved:
+                messagebox.showinfo("Saved", "Stock data saved.")
+            else:
+                messagebox.showerror("Error", "Stock data could not be saved.")
+
+        self.tasks.submit(Job("Save", lambda job: stock_data.save_stock_data(self.stocks), on_done=done,
+                              locks_portfolio=True))
+
+    # Mapping the snapshot is quick, so it is opened right here on the Tk thread
+    def open_snapshot(self):
+        portfolio = Portfolio()
+        try:
+            snapshot.load_snapshot(portfolio)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Could not open snapshot: {e}")
+            return
+        self.stocks = portfolio
+        self.refresh_stock_list()
+        self.sync_shares()
+
+    # Share counts come from the ledger; list the stocks that disagreed with it
+    def sync_shares(self):
+        discrepancies = ledger.sync_shares(self.stocks)
+        if discrepancies:
+            messagebox.showwarning("Ledger", "\n".join(map(ledger.format_discrepancy, discrepancies)))
+
+    def save_snapshot(self):
+        def done(saved):
+            if saved:
+                messagebox.showinfo("Saved", f"Snapshot written to {snapshot.SNAPSHOT_FILE}.")
+            else:
+                messagebox.showerror("Error", "Snapshot could not be written.")
+
+        def work(job):
+            return snapshot.save_snapshot(self.stocks, database=stock_data.database().path)
+
+        self.tasks.submit(Job("Snapshot", work, on_done=done, locks_portfolio=True))
+
     def show_chart(self):
         if not self.stock_listbox.curselection():
             return
         symbol = self.stock_listbox.get(self.stock_listbox.curselection())
         show_price_chart(self.stocks, symbol) 
 
+    # Trades for the selected stock, or for all stocks when none is selected.
+    # Only the ids are read up front; rows are fetched a page at a time as
+    # they scroll into view.
     def show_log(self):
-        self.info_box.delete("1.0", END)
-        if not self.logs:
-            self.info_box.insert(END, "No transactions yet.")
-        else:
-            self.info_box.insert(END, "Transaction Log:\n")
-            for entry in self.logs:
-                self.info_box.insert(END, entry + "\n")
+        symbol = self.selected_symbol()
+        self.info_symbol = None
+        trade_log = ledger.default_ledger()
+        ids = trade_log.trade_ids(symbol)
+        if not ids:
+            self.info_view.show(["No transactions yet."])
+            return
+        rows = {}
+
+        def row_text(i):
+            if i not in rows:
+                first = i - i % self.LOG_PAGE
+                for n, trade in enumerate(trade_log.fetch(ids[first:first + self.LOG_PAGE]), start=first):
+                    rows[n] = ledger.format_trade(trade)
+            return rows.get(i, "")
+
+        title = f"Transaction Log: {symbol}" if symbol else "Transaction Log:"
+        self.info_view.show([title], len(ids), row_text)
 
 if __name__ == "__main__":
-    StockApp()
+    metrics.configure()
+    with stock_data.open_database():
+        StockApp()
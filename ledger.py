@@ -0,0 +1,312 @@
+import atexit
+import math
+import sqlite3
+import threading
+import time
+from array import array
+from collections import namedtuple
+from datetime import datetime
+import metrics
+
+LEDGER_FILE = "ledger.db"
+BATCH_SIZE = 64  # Trades written per transaction
+FLUSH_SECONDS = 1.0  # Longest a trade waits in memory before it is written
+SNAPSHOT_EVERY = 10000  # Trades between position snapshots
+SIDES = ("BUY", "SELL")
+
+# Trades are only ever inserted. The indexes serve lookups by symbol and time
+# range; snapshots hold every traded position as of a trade id so positions
+# can be rebuilt by replaying only the trades after the latest snapshot.
+# Openings are the shares a stock already held when the ledger first saw it
+# (saved before there was a ledger); they count towards positions but are not
+# trades.
+LEDGER_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS trades (
+        id INTEGER PRIMARY KEY,
+        symbol TEXT NOT NULL,
+        time REAL NOT NULL,
+        side TEXT NOT NULL CHECK (side IN ('BUY', 'SELL')),
+        quantity REAL NOT NULL,
+        price REAL
+    );
+    CREATE INDEX IF NOT EXISTS trades_symbol_time ON trades (symbol, time);
+    CREATE INDEX IF NOT EXISTS trades_time ON trades (time);
+    CREATE TABLE IF NOT EXISTS snapshots (
+        trade_id INTEGER NOT NULL,
+        symbol TEXT NOT NULL,
+        quantity REAL NOT NULL,
+        PRIMARY KEY (trade_id, symbol)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS openings (
+        symbol TEXT PRIMARY KEY,
+        time REAL NOT NULL,
+        quantity REAL NOT NULL
+    );
+"""
+
+# One fill; time is a unix timestamp and price is None when it was not known
+Trade = namedtuple("Trade", ["id", "symbol", "time", "side", "quantity", "price"])
+
+# A stock whose shares did not match its ledger position
+Discrepancy = namedtuple("Discrepancy", ["symbol", "shares", "position"])
+
+# Signed quantity of a trade in SQL
+SIGNED_QUANTITY = "CASE side WHEN 'BUY' THEN quantity ELSE -quantity END"
+
+# Convert a datetime or unix timestamp (or None) to a unix timestamp
+def to_timestamp(value):
+    return value.timestamp() if isinstance(value, datetime) else value
+
+# Append-only trade ledger in its own SQLite file. Trades are buffered and
+# written in groups, one transaction per BATCH_SIZE trades or FLUSH_SECONDS
+# (a timer thread writes a group that is not full yet), and always before a
+# query and on close.
+class Ledger:
+    def __init__(self, path=LEDGER_FILE, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS,
+                 snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.snapshot_every = snapshot_every
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._timer = None  # Pending time-based flush
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.executescript(LEDGER_SCHEMA)
+        self._snapshot_id = self._conn.execute("SELECT coalesce(max(trade_id), 0) FROM snapshots;").fetchone()[0]
+        self._known = {row[0] for row in self._conn.execute(
+            "SELECT DISTINCT symbol FROM trades UNION SELECT symbol FROM openings;")}  # Symbols with a position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self.flush()
+                self._conn.close()
+                self._conn = None
+
+    # Queue one trade; it is written with the next group commit, at most
+    # flush_seconds later
+    def record(self, symbol, side, quantity, price=None, timestamp=None):
+        side = side.upper()
+        if side not in SIDES:
+            raise ValueError(f"Unknown side: {side}")
+        with self._lock:
+            self._pending.append((symbol.upper(), time.time() if timestamp is None else to_timestamp(timestamp),
+                                  side, float(quantity), price))
+            self._known.add(symbol.upper())
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_seconds, self._flush_due)
+                self._timer.daemon = True
+                self._timer.start()
+
+    # Timer thread: write the group that has waited flush_seconds
+    def _flush_due(self):
+        with self._lock:
+            self._timer = None
+            if self._conn is not None:
+                self.flush()
+
+    # Write every queued trade in one transaction
+    @metrics.timed("ledger.flush")
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+            with self._conn:
+                self._conn.executemany("INSERT INTO trades (symbol, time, side, quantity, price)"
+                                       " VALUES (?, ?, ?, ?, ?);", self._pending)
+            metrics.count("ledger.trades_written", len(self._pending))
+            self._pending = []
+            if self.last_id() - self._snapshot_id >= self.snapshot_every:
+                self.snapshot()
+
+    def last_id(self):
+        return self._conn.execute("SELECT coalesce(max(id), 0) FROM trades;").fetchone()[0]
+
+    # Store every traded position as of the latest trade
+    def snapshot(self):
+        with self._lock:
+            self.flush()
+            last_id = self.last_id()
+            if last_id == self._snapshot_id:
+                return
+            rows = [(last_id, symbol, quantity) for symbol, quantity in self._traded_positions().items()]
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO snapshots (trade_id, symbol, quantity)"
+                                       " VALUES (?, ?, ?);", rows)
+                if not rows:
+                    # Marker so an empty portfolio still counts as snapshotted
+                    self._conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, '', 0);", (last_id,))
+            self._snapshot_id = last_id
+
+    # Net traded shares per symbol: the latest snapshot plus a replay of the
+    # trades after it. Callers hold the lock and have flushed.
+    def _traded_positions(self):
+        positions = {symbol: quantity for symbol, quantity in self._conn.execute(
+            "SELECT symbol, quantity FROM snapshots WHERE trade_id = ? AND symbol != '';", (self._snapshot_id,))}
+        tail = self._conn.execute(f"SELECT symbol, sum({SIGNED_QUANTITY}) FROM trades WHERE id > ?"
+                                  " GROUP BY symbol;", (self._snapshot_id,))
+        for symbol, quantity in tail:
+            positions[symbol] = positions.get(symbol, 0.0) + quantity
+        return positions
+
+    # Net shares per symbol: openings plus the traded positions
+    @metrics.timed("ledger.positions")
+    def positions(self):
+        with self._lock:
+            self.flush()
+            positions = self._traded_positions()
+            for symbol, quantity in self._conn.execute("SELECT symbol, quantity FROM openings;"):
+                positions[symbol] = positions.get(symbol, 0.0) + quantity
+            return {symbol: quantity for symbol, quantity in sorted(positions.items()) if quantity}
+
+    # Net shares of one symbol, counting trades not written yet
+    def position(self, symbol):
+        symbol = symbol.upper()
+        with self._lock:
+            row = self._conn.execute("SELECT quantity FROM snapshots WHERE trade_id = ? AND symbol = ?;",
+                                     (self._snapshot_id, symbol)).fetchone()
+            tail = self._conn.execute(f"SELECT coalesce(sum({SIGNED_QUANTITY}), 0) FROM trades"
+                                      " WHERE symbol = ? AND id > ?;", (symbol, self._snapshot_id)).fetchone()[0]
+            opening = self._conn.execute("SELECT coalesce(sum(quantity), 0) FROM openings WHERE symbol = ?;",
+                                         (symbol,)).fetchone()[0]
+            pending = sum(quantity if side == "BUY" else -quantity
+                          for held, _, side, quantity, _ in self._pending if held == symbol)
+            return (row[0] if row else 0.0) + tail + opening + pending
+
+    # Make the ledger the record of each stock's shares. A symbol the ledger
+    # has never seen gets its current shares as an opening; any other stock has
+    # its shares set to the ledger position. Nothing is written as a trade.
+    # Returns a Discrepancy for every stock whose shares were changed.
+    def sync_shares(self, stocks):
+        discrepancies = []
+        with self._lock:
+            positions = self.positions()
+            for stock in stocks:
+                symbol = stock.symbol.upper()
+                if symbol not in self._known:
+                    if stock.shares:
+                        with self._conn:
+                            self._conn.execute("INSERT INTO openings (symbol, time, quantity) VALUES (?, ?, ?);",
+                                               (symbol, time.time(), float(stock.shares)))
+                        self._known.add(symbol)
+                    continue
+                position = positions.get(symbol, 0.0)
+                if not math.isclose(stock.shares, position, abs_tol=1e-9):
+                    discrepancies.append(Discrepancy(stock.symbol, stock.shares, position))
+                    if position > stock.shares:
+                        stock.buy(position - stock.shares)
+                    else:
+                        stock.sell(stock.shares - position)
+        return discrepancies
+
+    # SQL filter for a symbol and a time range (datetimes or unix timestamps)
+    def _where(self, symbol, start, end):
+        clauses, params = [], []
+        if symbol:
+            clauses.append("symbol = ?")
+            params.append(symbol.upper())
+        if start is not None:
+            clauses.append("time >= ?")
+            params.append(to_timestamp(start))
+        if end is not None:
+            clauses.append("time <= ?")
+            params.append(to_timestamp(end))
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    # Ids of the matching trades in time order, read from the indexes only
+    @metrics.timed("ledger.query")
+    def trade_ids(self, symbol=None, start=None, end=None):
+        where, params = self._where(symbol, start, end)
+        with self._lock:
+            self.flush()
+            return array("q", (row[0] for row in self._conn.execute(
+                f"SELECT id FROM trades{where} ORDER BY time, id;", params)))
+
+    # Look up trades by id, in the order given
+    def fetch(self, ids):
+        ids = list(ids)
+        trades = {}
+        for first in range(0, len(ids), 500):
+            chunk = ids[first:first + 500]
+            with self._lock:
+                rows = self._conn.execute(f"SELECT id, symbol, time, side, quantity, price FROM trades"
+                                          f" WHERE id IN ({','.join('?' * len(chunk))});", chunk).fetchall()
+            trades.update((row[0], Trade(*row)) for row in rows)
+        return [trades[i] for i in ids if i in trades]
+
+    # Matching trades in time order, streamed from the database on a connection
+    # of their own, so a flush from the timer thread cannot disturb the cursor
+    def trades(self, symbol=None, start=None, end=None):
+        self.flush()
+        where, params = self._where(symbol, start, end)
+        conn = sqlite3.connect(self.path)
+        try:
+            for row in conn.execute(f"SELECT id, symbol, time, side, quantity, price FROM trades{where}"
+                                    " ORDER BY time, id;", params):
+                yield Trade(*row)
+        finally:
+            conn.close()
+
+
+# One line of text for a trade, as shown by the console and the GUI
+def format_trade(trade):
+    when = datetime.fromtimestamp(trade.time).strftime("%m/%d/%y %H:%M:%S")
+    price = f" @ ${trade.price:.2f}" if trade.price is not None else ""
+    return f"{when}  {trade.side:4s} {trade.quantity:g} {trade.symbol}{price}"
+
+# Last known close of a stock, without loading a history that is not loaded yet
+def last_price(stock):
+    if stock.history_loaded and len(stock.history):
+        return stock.history.closes[-1]
+    return None
+
+_ledger = None
+
+# Ledger shared by the console and the GUI, opened on first use and closed on exit
+def default_ledger():
+    global _ledger
+    if _ledger is None:
+        _ledger = Ledger()
+        atexit.register(_ledger.close)
+    return _ledger
+
+# Bring the shares of loaded stocks in line with the shared ledger; returns
+# the Discrepancy list of Ledger.sync_shares
+def sync_shares(stocks, ledger=None):
+    return (ledger or default_ledger()).sync_shares(stocks)
+
+# Change a stock's shares and record the trade in the ledger, starting from
+# the ledger's position for it
+def buy(stock, quantity, ledger=None):
+    ledger = ledger or default_ledger()
+    ledger.sync_shares((stock,))
+    stock.buy(quantity)
+    ledger.record(stock.symbol, "BUY", quantity, last_price(stock))
+
+def sell(stock, quantity, ledger=None):
+    ledger = ledger or default_ledger()
+    ledger.sync_shares((stock,))
+    stock.sell(quantity)
+    ledger.record(stock.symbol, "SELL", quantity, last_price(stock))
+
+# One line of text for a discrepancy found by sync_shares
+def format_discrepancy(discrepancy):
+    return (f"{discrepancy.symbol}: {discrepancy.shares:g} shares recorded, {discrepancy.position:g} in the ledger;"
+            f" using the ledger.")
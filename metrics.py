@@ -0,0 +1,177 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
+# Timers, counters and latency histograms for the slow paths (database, web,
+# CSV, charts, GUI). Everything is off unless STOCK_METRICS is set or a program
+# is started with --metrics; while off, each call is one flag check.
+#
+#   STOCK_METRICS=1               print a summary on exit
+#   STOCK_METRICS=metrics.json    write the summary as JSON on exit
+#   --metrics / --metrics=FILE    the same from the command line
+
+ENV_VAR = "STOCK_METRICS"
+FLAG = "--metrics"
+
+_enabled = False
+_output = None  # Path of the JSON file written on exit, or None to print
+_lock = threading.Lock()
+_counters = {}
+_timings = {}  # name -> [count, total, max, {bucket: count}]
+
+
+# Context manager returned by timer() while metrics are off
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+# Times the block it wraps and records it under `name`
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+def enabled():
+    return _enabled
+
+# Start collecting. With `output` the summary is written there as JSON on exit,
+# otherwise it is printed.
+def enable(output=None):
+    global _enabled, _output
+    _output = output
+    if not _enabled:
+        _enabled = True
+        atexit.register(dump)
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+
+# Turn metrics on from STOCK_METRICS or a --metrics[=FILE] argument, which is
+# removed from `argv` (sys.argv by default) so the program never sees it
+def configure(argv=None):
+    argv = sys.argv if argv is None else argv
+    output = os.environ.get(ENV_VAR)
+    requested = bool(output) and output != "0"
+    for arg in list(argv[1:]):
+        if arg == FLAG or arg.startswith(FLAG + "="):
+            argv.remove(arg)
+            requested = True
+            output = arg.partition("=")[2]
+    if requested:
+        enable(output if output and output != "1" else None)
+
+# Add `amount` to a counter
+def count(name, amount=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+# Record one duration in seconds. Durations go into power-of-two microsecond
+# buckets so percentiles can be estimated without keeping every sample.
+def record(name, seconds):
+    if not _enabled:
+        return
+    bucket = max(0, int(seconds * 1e6)).bit_length()
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = [0, 0.0, 0.0, {}]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        timing[3][bucket] = timing[3].get(bucket, 0) + 1
+
+# Time a block: `with metrics.timer("db.save"): ...`
+def timer(name):
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+# Decorator that times every call of a function under `name`
+def timed(name):
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+# Upper bound in seconds of the bucket holding the given fraction of samples
+def _percentile(buckets, total, fraction):
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= total * fraction:
+            return (1 << bucket) / 1e6
+    return 0.0
+
+# Counters and per-timer statistics as plain dicts
+def snapshot():
+    with _lock:
+        timings = {}
+        for name, (calls, total, longest, buckets) in sorted(_timings.items()):
+            timings[name] = {
+                "calls": calls,
+                "total_s": total,
+                "mean_s": total / calls,
+                "p50_s": min(longest, _percentile(buckets, calls, 0.5)),
+                "p95_s": min(longest, _percentile(buckets, calls, 0.95)),
+                "max_s": longest,
+                "histogram_us": {str(1 << bucket): n for bucket, n in sorted(buckets.items())},
+            }
+        return {"counters": dict(sorted(_counters.items())), "timings": timings}
+
+# Snapshot formatted as a text table
+def summary():
+    data = snapshot()
+    lines = ["=== Metrics ==="]
+    for name, value in data["counters"].items():
+        lines.append(f"{name:32s} {value:>14,}")
+    if data["timings"]:
+        lines.append(f"{'timer':32s} {'calls':>8s} {'total ms':>10s} {'mean ms':>9s}"
+                     f" {'p50 ms':>9s} {'p95 ms':>9s} {'max ms':>9s}")
+    for name, t in data["timings"].items():
+        lines.append(f"{name:32s} {t['calls']:8d} {t['total_s'] * 1000:10.2f} {t['mean_s'] * 1000:9.3f}"
+                     f" {t['p50_s'] * 1000:9.3f} {t['p95_s'] * 1000:9.3f} {t['max_s'] * 1000:9.3f}")
+    return "\n".join(lines)
+
+# Print the summary or write it to the metrics file
+def dump():
+    if not _counters and not _timings:
+        return
+    if _output:
+        with open(_output, "w") as f:
+            json.dump(snapshot(), f, indent=2)
+    else:
+        print(summary(), file=sys.stderr)
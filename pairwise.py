@@ -0,0 +1,216 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import analytics
+import metrics
+
+# Cross-portfolio statistics (covariance, correlation, beta, rolling pairwise
+# correlation) on daily returns aligned to one calendar. The aligned returns
+# and the result matrices live in multiprocessing.shared_memory; worker
+# processes attach to them by name and each computes a block of the pairwise
+# work in place, so no history or result is ever pickled.
+#
+# Pairs use every day on which both stocks have a return ("pairwise complete"),
+# so stocks listed at different times can still be compared.
+
+BLOCK = 128  # Symbols per side of one block of pairwise work
+MIN_OVERLAP = 20  # Fewer common returns than this give NaN
+
+# Days, symbols and a (days x symbols) matrix of daily returns. Closes are
+# carried forward over days a stock has no bar; returns before a stock's first
+# bar are NaN.
+def aligned_returns(stock_list, symbols=None):
+    stocks = [stock for stock in stock_list if len(stock.history) > 1 and (symbols is None or stock.symbol in symbols)]
+    columns = [analytics.history_arrays(stock.history)[:2] for stock in stocks]
+    if not columns:
+        return np.empty(0, dtype=np.int64), [], np.empty((0, 0))
+    days = np.unique(np.concatenate([stock_days for stock_days, _ in columns]))
+    closes = np.full((len(days), len(stocks)), np.nan)
+    for n, (stock_days, stock_closes) in enumerate(columns):
+        last = np.searchsorted(stock_days, days, side="right") - 1
+        held = last >= 0
+        closes[held, n] = stock_closes[last[held]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = closes[1:] / closes[:-1] - 1.0
+    returns[~np.isfinite(returns)] = np.nan
+    return days[1:], [stock.symbol for stock in stocks], returns
+
+
+# Named shared memory blocks holding NumPy arrays. The creating process owns
+# (and finally unlinks) them; pool workers attach with SharedArrays.attach(spec)
+# and share the creator's resource tracker, so they never unlink.
+class SharedArrays:
+    def __init__(self):
+        self.arrays = {}
+        self.spec = {}  # name -> (shared memory name, shape, dtype)
+        self._blocks = []
+        self._owner = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def add(self, name, shape, dtype=np.float64, fill=None):
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        if fill is not None:
+            array[...] = fill
+        self.arrays[name] = array
+        self.spec[name] = (block.name, shape, np.dtype(dtype).str)
+        return array
+
+    @classmethod
+    def attach(cls, spec):
+        shared = cls()
+        shared._owner = False
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared._blocks.append(block)
+            shared.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        return shared
+
+    def close(self):
+        self.arrays.clear()
+        for block in self._blocks:
+            block.close()
+            if self._owner:
+                block.unlink()
+        self._blocks = []
+
+
+_worker_arrays = None
+
+# Process pool initializer: attach to the shared arrays once per worker
+def _attach(spec):
+    global _worker_arrays
+    _worker_arrays = SharedArrays.attach(spec)
+
+# Covariance and correlation of symbol blocks rows[i0:i1] x columns[j0:j1],
+# written into the shared result matrices (and their mirror image)
+def _pair_block(i0, i1, j0, j1, arrays=None):
+    arrays = arrays or _worker_arrays.arrays
+    values, present = arrays["values"], arrays["present"]
+    xi, xj = values[:, i0:i1], values[:, j0:j1]
+    mi, mj = present[:, i0:i1], present[:, j0:j1]
+    count = mi.T @ mj
+    sum_i = xi.T @ mj  # Sum of x_i over the days where x_j is also present
+    sum_j = mi.T @ xj
+    products = xi.T @ xj
+    squares_i = (xi * xi).T @ mj
+    squares_j = mi.T @ (xj * xj)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = (products - sum_i * sum_j / count) / (count - 1)
+        variance_i = (squares_i - sum_i * sum_i / count) / (count - 1)
+        variance_j = (squares_j - sum_j * sum_j / count) / (count - 1)
+        correlation = covariance / np.sqrt(variance_i * variance_j)
+    too_short = count < MIN_OVERLAP
+    covariance[too_short] = np.nan
+    correlation[too_short] = np.nan
+    arrays["covariance"][i0:i1, j0:j1] = covariance
+    arrays["covariance"][j0:j1, i0:i1] = covariance.T
+    arrays["correlation"][i0:i1, j0:j1] = correlation
+    arrays["correlation"][j0:j1, i0:i1] = correlation.T
+
+# Rolling correlation for pairs[p0:p1] (index pairs), written into the shared
+# (days x pairs) result
+def _rolling_block(p0, p1, window, arrays=None):
+    arrays = arrays or _worker_arrays.arrays
+    values, present, pairs = arrays["values"], arrays["present"], arrays["pairs"]
+    result = arrays["rolling"]
+    for p in range(p0, p1):
+        i, j = pairs[p]
+        both = present[:, i] * present[:, j]
+        x, y = values[:, i] * both, values[:, j] * both
+        sums = [np.concatenate(([0.0], np.cumsum(column))) for column in (both, x, y, x * y, x * x, y * y)]
+        n, sx, sy, sxy, sxx, syy = (column[window:] - column[:-window] for column in sums)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            covariance = sxy - sx * sy / n
+            correlation = covariance / np.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+        correlation[n < min(window, MIN_OVERLAP)] = np.nan
+        result[:window - 1, p] = np.nan
+        result[window - 1:, p] = correlation
+
+# Split range(count) into (start, stop) blocks of `size`
+def _blocks(count, size):
+    return [(start, min(count, start + size)) for start in range(0, count, size)]
+
+# Run tasks (function, *args) on a pool attached to `shared`, or in this
+# process when workers is 1
+def _run(shared, tasks, workers):
+    if workers <= 1 or len(tasks) <= 1:
+        for func, *args in tasks:
+            func(*args, arrays=shared.arrays)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_attach, initargs=(shared.spec,)) as executor:
+        for future in [executor.submit(func, *args) for func, *args in tasks]:
+            future.result()
+
+# Returns matrix as shared NumPy arrays: zero-filled values and a presence mask
+def _share_returns(shared, returns):
+    present = shared.add("present", returns.shape)
+    present[...] = ~np.isnan(returns)
+    values = shared.add("values", returns.shape)
+    values[...] = np.nan_to_num(returns, nan=0.0)
+
+# Pairwise covariance and correlation matrices of daily returns for every stock
+# with at least two bars. Returns (symbols, covariance, correlation).
+@metrics.timed("pairwise.matrices")
+def correlation_matrices(stock_list, workers=None, block=BLOCK):
+    workers = workers or os.cpu_count() or 1
+    _, symbols, returns = aligned_returns(stock_list)
+    count = len(symbols)
+    with SharedArrays() as shared:
+        _share_returns(shared, returns)
+        covariance = shared.add("covariance", (count, count), fill=np.nan)
+        correlation = shared.add("correlation", (count, count), fill=np.nan)
+        spans = _blocks(count, block)
+        tasks = [(_pair_block, i0, i1, j0, j1)
+                 for n, (i0, i1) in enumerate(spans) for j0, j1 in spans[n:]]
+        _run(shared, tasks, workers)
+        return symbols, covariance.copy(), correlation.copy()
+
+# Beta of every stock against an index symbol (covariance with the index over
+# the index variance, on the days both have returns). Returns {symbol: beta}.
+def betas(stock_list, index_symbol):
+    _, symbols, returns = aligned_returns(stock_list)
+    if index_symbol not in symbols:
+        raise KeyError(f"No price history for index {index_symbol}.")
+    index = returns[:, symbols.index(index_symbol)]
+    result = {}
+    for n, symbol in enumerate(symbols):
+        both = ~np.isnan(returns[:, n]) & ~np.isnan(index)
+        if both.sum() < MIN_OVERLAP:
+            result[symbol] = math.nan
+            continue
+        x, y = returns[both, n], index[both]
+        variance = y.var(ddof=1)
+        result[symbol] = float(np.cov(x, y, ddof=1)[0, 1] / variance) if variance else math.nan
+    return result
+
+# Rolling correlation over `window` returns for pairs of symbols (all pairs
+# when None). Returns (days, pairs, matrix of days x pairs).
+@metrics.timed("pairwise.rolling")
+def rolling_correlations(stock_list, window=analytics.WINDOW, pairs=None, workers=None, block=BLOCK):
+    workers = workers or os.cpu_count() or 1
+    days, symbols, returns = aligned_returns(stock_list)
+    index = {symbol: n for n, symbol in enumerate(symbols)}
+    if pairs is None:
+        pairs = [(a, b) for n, a in enumerate(symbols) for b in symbols[n + 1:]]
+    pairs = [(a.upper(), b.upper()) for a, b in pairs if a.upper() in index and b.upper() in index]
+    if len(days) < window or not pairs:
+        return days, pairs, np.full((len(days), len(pairs)), np.nan)
+    with SharedArrays() as shared:
+        _share_returns(shared, returns)
+        pair_index = shared.add("pairs", (len(pairs), 2), dtype=np.int64)
+        pair_index[...] = [(index[a], index[b]) for a, b in pairs]
+        rolling = shared.add("rolling", (len(days), len(pairs)))
+        tasks = [(_rolling_block, p0, p1, window) for p0, p1 in _blocks(len(pairs), block)]
+        _run(shared, tasks, workers)
+        return days, pairs, rolling.copy()
@@ -0,0 +1,341 @@
+import csv
+import json
+import os
+import sys
+from bisect import bisect_left, bisect_right
+from contextlib import ExitStack
+from functools import lru_cache
+from itertools import repeat
+from math import isfinite
+from stock_class import from_epoch_day, to_epoch_day
+import rollups
+import metrics
+
+# Price report and bulk export of daily bars. Rows are streamed in blocks of
+# CHUNK_ROWS straight from each history's columns (or from stocks.db for
+# histories that are not loaded), so memory stays flat however large the
+# portfolio is. A block is formatted with one C-level map over its columns and
+# written with one call; dates are formatted once per distinct day. Long
+# ranges can be reported per week or month from the rollup tables instead.
+#
+#   text      the console report: a header and summary per stock, then one line per bar
+#   csv       symbol,date,close,volume with ISO dates
+#   jsonl     one JSON object per bar
+#   arrow     Arrow IPC file, one record batch per block (needs pyarrow)
+#   parquet   Parquet file, one row group per block (needs pyarrow)
+
+CHUNK_ROWS = 8192  # Bars formatted and written per block
+BUFFER_BYTES = 1 << 20  # Write buffer of export files
+PAGE_ROWS = 40  # Bars per screen in the console report
+TEXT_ROW = "%s | Close: $%.2f | Volume: %d\n"
+CSV_HEADER = ("symbol", "date", "close", "volume")
+FORMAT_EXTENSIONS = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl", ".arrow": "arrow", ".feather": "arrow",
+                     ".ipc": "arrow", ".parquet": "parquet"}
+
+@lru_cache(maxsize=1 << 16)
+def short_date(day):
+    return from_epoch_day(day).strftime("%m/%d/%y")
+
+@lru_cache(maxsize=1 << 16)
+def iso_date(day):
+    return from_epoch_day(day).strftime("%Y-%m-%d")
+
+# Stocks selected by a collection of symbols (all when None), in portfolio order
+def select_stocks(stock_list, symbols=None):
+    if symbols is None:
+        return list(stock_list)
+    wanted = {symbol.strip().upper() for symbol in symbols if symbol.strip()}
+    return [stock for stock in stock_list if stock.symbol.upper() in wanted]
+
+# (first, last) day numbers of an inclusive date range; None leaves a side open
+def _day_bounds(date_start, date_end):
+    return (to_epoch_day(date_start) if date_start else None,
+            to_epoch_day(date_end) if date_end else None)
+
+# Row span [lo, hi) of a date-ordered column between two inclusive day numbers
+def _span(days, first, last):
+    lo = bisect_left(days, first) if first is not None else 0
+    hi = bisect_right(days, last) if last is not None else len(days)
+    return lo, max(lo, hi)
+
+# Bars of a history that is not loaded, read from stocks.db in blocks
+def _database_chunks(conn, symbol, first, last, skip, limit, chunk_rows):
+    first = -(2 ** 63) if first is None else first
+    last = 2 ** 63 - 1 if last is None else last
+    cursor = conn.execute("SELECT date, price, volume FROM dailyData WHERE symbol = ? AND date BETWEEN ? AND ?"
+                          " ORDER BY date LIMIT ? OFFSET ?;", (symbol, first, last, -1 if limit is None else limit, skip))
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        yield tuple(zip(*rows))
+
+def _count_rows(conn, symbol, first, last):
+    first = -(2 ** 63) if first is None else first
+    last = 2 ** 63 - 1 if last is None else last
+    return conn.execute("SELECT count(*) FROM dailyData WHERE symbol = ? AND date BETWEEN ? AND ?;",
+                        (symbol, first, last)).fetchone()[0]
+
+# (day, close) of a symbol's newest bar in stocks.db, or None
+def _last_bar(conn, symbol):
+    return conn.execute("SELECT date, price FROM dailyData WHERE symbol = ? ORDER BY date DESC LIMIT 1;",
+                        (symbol,)).fetchone()
+
+# (day, close) of each stock's newest bar, by symbol: from the history when it
+# is loaded, otherwise from stocks.db so the history stays unloaded
+def last_closes(stocks):
+    latest = {}
+    unloaded = []
+    for stock in stocks:
+        if not stock.history_loaded:
+            unloaded.append(stock.symbol)
+        elif len(stock.history):
+            days = stock.history.days
+            index = len(days) - 1 if stock.history.is_sorted() else max(range(len(days)), key=days.__getitem__)
+            latest[stock.symbol] = (days[index], stock.history.closes[index])
+    if unloaded:
+        import stock_data
+
+        with stock_data.database().reader() as conn:
+            for symbol in unloaded:
+                bar = _last_bar(conn, symbol)
+                if bar is not None:
+                    latest[symbol] = bar
+    return latest
+
+def check_tier(tier):
+    if tier not in rollups.TIERS and tier != "auto":
+        raise ValueError(f"Unknown report tier: {tier}; use one of {', '.join(rollups.TIERS)} or auto.")
+
+# Rollup tier to report for one stock: `tier` itself, or for "auto" the
+# coarsest tier that still gives TIER_MIN_POINTS rows over the date range
+def _stock_tier(stock, tier, first, last, reader):
+    if tier != "auto":
+        return tier
+    if stock.history_loaded:
+        days = stock.history.days
+        stored = (days[0], days[-1]) if len(days) and stock.history.is_sorted() else None
+    else:
+        stored = rollups.stored_range(reader(), stock.symbol)
+    if stored is None:
+        return "daily"
+    first = stored[0] if first is None else max(first, stored[0])
+    last = stored[1] if last is None else min(last, stored[1])
+    return rollups.choose_tier(first, last)
+
+# (periods, closes, volumes) of one stock's weekly or monthly rollup: from
+# stocks.db, or aggregated from the loaded history when it has unsaved changes
+def _rollup_columns(stock, tier, first, last, reader):
+    if stock.history_loaded and stock.history.has_changes:
+        history = stock.history
+        if not history.is_sorted():
+            history.sort()
+        lo, hi = _span(history.days, None if first is None else rollups.period_start(first, tier), last)
+        columns = rollups.aggregate(history.days[lo:hi], history.closes[lo:hi], history.volumes[lo:hi], tier)
+    else:
+        columns = rollups.read(reader(), stock.symbol, tier, first, last)
+    return columns[0], columns[4], columns[5]
+
+# Bars of the selected stocks in date order as (stock, days, closes, volumes)
+# blocks of at most chunk_rows. `offset` and `limit` count bars across the whole
+# report, so report pages can be fetched directly. With a weekly or monthly
+# tier (or "auto"), each row is one period: its first day, last close and
+# total volume.
+def report_chunks(stock_list, symbols=None, date_start=None, date_end=None, offset=0, limit=None,
+                  chunk_rows=CHUNK_ROWS, tier="daily"):
+    check_tier(tier)
+    first, last = _day_bounds(date_start, date_end)
+    skip, remaining = offset, limit
+    with ExitStack() as stack:
+        conn = None
+
+        def reader():
+            nonlocal conn
+            if conn is None:
+                import stock_data
+                conn = stack.enter_context(stock_data.database().reader())
+            return conn
+
+        # Narrow `count` rows of one stock to the page; returns (start, stop)
+        def page(count):
+            nonlocal skip, remaining
+            start = min(skip, count)
+            skip -= start
+            stop = count if remaining is None else min(count, start + remaining)
+            if remaining is not None:
+                remaining -= stop - start
+            return start, stop
+
+        for stock in select_stocks(stock_list, symbols):
+            if remaining is not None and remaining <= 0:
+                return
+            stock_tier = _stock_tier(stock, tier, first, last, reader)
+            if stock_tier != "daily":
+                columns = _rollup_columns(stock, stock_tier, first, last, reader)
+                lo, hi = page(len(columns[0]))
+            elif stock.history_loaded:
+                history = stock.history
+                if not history.is_sorted():
+                    history.sort()
+                columns = history.days, history.closes, history.volumes
+                lo, hi = _span(history.days, first, last)
+                start, stop = page(hi - lo)
+                lo, hi = lo + start, lo + stop
+            else:
+                start, stop = page(_count_rows(reader(), stock.symbol, first, last))
+                if start < stop:
+                    for days, closes, volumes in _database_chunks(reader(), stock.symbol, first, last, start,
+                                                                  stop - start, chunk_rows):
+                        yield stock, days, closes, volumes
+                continue
+            for start in range(lo, hi, chunk_rows):
+                stop = min(hi, start + chunk_rows)
+                yield stock, columns[0][start:stop], columns[1][start:stop], columns[2][start:stop]
+
+# Console report text, one string per stock header or block of bars. The
+# indicator summary needs the whole history, so stocks whose history is not
+# loaded only get their latest close and value.
+def text_blocks(chunks, summary=True):
+    import analytics
+
+    current = None
+    for stock, days, closes, volumes in chunks:
+        if stock is not current:
+            current = stock
+            header = f"\n=== {stock.symbol} - {stock.name} ===\n"
+            if summary and stock.history_loaded:
+                header += analytics.format_summary(analytics.summarize(stock)) + "\n"
+            elif summary:
+                bar = last_closes([stock]).get(stock.symbol)
+                if bar is not None:
+                    header += f"Close: ${bar[1]:.2f} | Value: ${stock.shares * bar[1]:,.2f}\n"
+            yield header
+        yield "".join(map(TEXT_ROW.__mod__, zip(map(short_date, days), closes, volumes)))
+
+# Pass blocks through, adding their bars to counter[0]
+def _counting(chunks, counter):
+    for chunk in chunks:
+        counter[0] += len(chunk[1])
+        yield chunk
+
+# Closing line of the console report: the latest value of the selected stocks,
+# each at its newest close
+def value_line(stock_list, symbols=None):
+    stocks = select_stocks(stock_list, symbols)
+    latest = last_closes(stocks)
+    if not latest:
+        return ""
+    value = sum(stock.shares * latest[stock.symbol][1] for stock in stocks if stock.symbol in latest)
+    day = max(day for day, _ in latest.values())
+    return f"\nPortfolio value on {short_date(int(day))}: ${value:,.2f}\n"
+
+# Write the console report to `out` (stdout by default), followed by the value
+# of the selected stocks. Returns the number of bars written.
+@metrics.timed("report.render")
+def render_report(stock_list, out=None, symbols=None, date_start=None, date_end=None, offset=0, limit=None,
+                  summary=True, tier="daily"):
+    check_tier(tier)
+    out = out or sys.stdout
+    rows = [0]
+    chunks = report_chunks(stock_list, symbols, date_start, date_end, offset, limit, tier=tier)
+    for block in text_blocks(_counting(chunks, rows), summary):
+        out.write(block)
+    out.write(value_line(stock_list, symbols))
+    metrics.count("report.rows", rows[0])
+    return rows[0]
+
+def _write_csv(path, chunks):
+    rows = 0
+    with open(path, "w", newline="", buffering=BUFFER_BYTES) as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for stock, days, closes, volumes in chunks:
+            writer.writerows(zip(repeat(stock.symbol), map(iso_date, days), closes, volumes))
+            rows += len(days)
+    return rows
+
+# A float as a JSON number; NaN and infinities, which JSON lacks, become null
+def _json_number(value):
+    return repr(value) if isfinite(value) else "null"
+
+def _write_jsonl(path, chunks):
+    rows = 0
+    with open(path, "w", buffering=BUFFER_BYTES) as f:
+        for stock, days, closes, volumes in chunks:
+            symbol = json.dumps(stock.symbol).replace("%", "%%")
+            template = '{"symbol": ' + symbol + ', "date": "%s", "close": %s, "volume": %s}\n'
+            if all(map(isfinite, closes)) and all(map(isfinite, volumes)):
+                closes, volumes = map(repr, closes), map(repr, volumes)
+            else:
+                closes, volumes = map(_json_number, closes), map(_json_number, volumes)
+            f.write("".join(map(template.__mod__, zip(map(iso_date, days), closes, volumes))))
+            rows += len(days)
+    return rows
+
+# Arrow record batch for one block: symbol (dictionary encoded), date32, close, volume
+def _record_batch(pa, stock, days, closes, volumes):
+    import numpy as np
+
+    count = len(days)
+    symbol = pa.DictionaryArray.from_arrays(pa.array(np.zeros(count, dtype=np.int32)), pa.array([stock.symbol]))
+    return pa.record_batch([symbol,
+                            pa.array(np.asarray(days, dtype=np.int32)).cast(pa.date32()),
+                            pa.array(np.asarray(closes, dtype=np.float64)),
+                            pa.array(np.asarray(volumes, dtype=np.float64))], names=list(CSV_HEADER))
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError("Arrow and Parquet export need the pyarrow package (pip install pyarrow).") from None
+    return pyarrow
+
+def _write_columnar(path, chunks, parquet):
+    pa = _import_pyarrow()
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    schema = pa.schema([("symbol", pa.dictionary(pa.int32(), pa.string())), ("date", pa.date32()),
+                        ("close", pa.float64()), ("volume", pa.float64())])
+    writer = pyarrow.parquet.ParquetWriter(path, schema) if parquet else pyarrow.ipc.new_file(path, schema)
+    rows = 0
+    try:
+        for stock, days, closes, volumes in chunks:
+            batch = _record_batch(pa, stock, days, closes, volumes)
+            if parquet:
+                writer.write_batch(batch)
+            else:
+                writer.write(batch)
+            rows += len(days)
+    finally:
+        writer.close()
+    return rows
+
+EXPORTERS = {
+    "csv": _write_csv,
+    "jsonl": _write_jsonl,
+    "arrow": lambda path, chunks: _write_columnar(path, chunks, parquet=False),
+    "parquet": lambda path, chunks: _write_columnar(path, chunks, parquet=True),
+}
+
+# Export format named by a file's extension
+def format_for(path):
+    fmt = FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f"Cannot tell the export format of {path}; use one of {', '.join(FORMAT_EXTENSIONS)}.")
+    return fmt
+
+# Write the selected bars (or weekly/monthly rows) to `path` as csv, jsonl,
+# arrow or parquet (from the extension when fmt is None). Raises ValueError for
+# an unknown format or tier.
+# Returns the number of bars written.
+@metrics.timed("report.export")
+def export_report(stock_list, path, fmt=None, symbols=None, date_start=None, date_end=None, offset=0, limit=None,
+                  tier="daily"):
+    check_tier(tier)
+    fmt = fmt or format_for(path)
+    if fmt not in EXPORTERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    rows = EXPORTERS[fmt](path, report_chunks(stock_list, symbols, date_start, date_end, offset, limit, tier=tier))
+    metrics.count("report.rows", rows)
+    return rows
@@ -0,0 +1,182 @@
+from datetime import date
+from itertools import groupby
+from stock_class import from_epoch_day, to_epoch_day
+import metrics
+
+# Weekly and monthly aggregates of dailyData. Each rollup row holds the open
+# (of the first bar), high, low, close (of the last bar), total volume and bar
+# count of one symbol over one period; bars without an open, high or low count
+# with their close. A period is keyed by the day number of its first day (weeks
+# start on Monday). save_stock_data refreshes the periods
+# its bars fall in, so the rollups always match dailyData.
+#
+# With a retention policy, daily bars older than the policy are deleted once
+# their periods are rolled up. Periods that start before the oldest kept bar
+# are then frozen: later saves no longer recompute them.
+
+TIERS = ("daily", "weekly", "monthly")
+TABLES = {"weekly": "weeklyData", "monthly": "monthlyData"}
+TIER_DAYS = {"daily": 1, "weekly": 7, "monthly": 30.44}  # Average days per period
+TIER_MIN_POINTS = 200  # A coarser tier is used only if it still gives this many points
+COMPACT_STEP_DAYS = 30  # Retention runs again once its cutoff has moved this far
+
+ROLLUP_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        symbol TEXT NOT NULL,
+        period INTEGER NOT NULL,
+        open REAL NOT NULL,
+        high REAL NOT NULL,
+        low REAL NOT NULL,
+        close REAL NOT NULL,
+        volume REAL NOT NULL,
+        bars INTEGER NOT NULL,
+        PRIMARY KEY (symbol, period)
+    ) WITHOUT ROWID;
+"""
+
+# Settings and state kept with the data: retain_days, compacted_before and the
+# save counter, generation
+META_TABLE = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value
+    );
+"""
+
+# First day of the period holding dailyData.date, in SQL
+PERIOD_SQL = {
+    "weekly": "date - ((date % 7 + 10) % 7)",  # Day 0 (1970-01-01) was a Thursday
+    "monthly": "CAST(julianday(date * 86400, 'unixepoch', 'start of month') - 2440587.5 AS INTEGER)",
+}
+
+# Recompute whole periods from dailyData. Open and close are looked up by
+# primary key on each period's first and last day.
+REFRESH_ROLLUP = """
+    INSERT OR REPLACE INTO {table} (symbol, period, open, high, low, close, volume, bars)
+    SELECT p.symbol, p.period, coalesce(o.open, o.price), p.high, p.low, c.price, p.volume, p.bars
+    FROM (
+        SELECT symbol, {period} AS period, min(date) AS first_day, max(date) AS last_day,
+               max(coalesce(high, price)) AS high, min(coalesce(low, price)) AS low,
+               sum(volume) AS volume, count(*) AS bars
+        FROM dailyData WHERE {where}
+        GROUP BY symbol, period HAVING period >= ?
+    ) AS p
+    JOIN dailyData o ON o.symbol = p.symbol AND o.date = p.first_day
+    JOIN dailyData c ON c.symbol = p.symbol AND c.date = p.last_day;
+"""
+
+MIN_DAY, MAX_DAY = -(2 ** 63), 2 ** 63 - 1
+
+def create_tables(conn):
+    for table in TABLES.values():
+        conn.execute(ROLLUP_TABLE.format(name=table))
+    conn.execute(META_TABLE)
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?;", (key,)).fetchone()
+    return default if row is None or row[0] is None else row[0]
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?);", (key, value))
+
+# First day of the period holding `day`
+def period_start(day, tier):
+    if tier == "weekly":
+        return day - (day + 3) % 7
+    if tier == "monthly":
+        return to_epoch_day(from_epoch_day(day).replace(day=1))
+    return day
+
+# Last day of the period holding `day`
+def period_end(day, tier):
+    if tier == "weekly":
+        return period_start(day, tier) + 6
+    if tier == "monthly":
+        return period_start(period_start(day, tier) + 31, tier) - 1
+    return day
+
+# Coarsest tier that still gives at least `min_points` periods between two days
+def choose_tier(first_day, last_day, min_points=TIER_MIN_POINTS):
+    span = last_day - first_day + 1
+    for tier in ("monthly", "weekly"):
+        if span / TIER_DAYS[tier] >= min_points:
+            return tier
+    return "daily"
+
+# Recompute the weekly and monthly rows of every period touching first_day to
+# last_day, for one symbol or all of them. Frozen periods are left alone.
+# Returns the rollup rows written.
+@metrics.timed("db.rollup")
+def refresh(conn, symbol=None, first_day=None, last_day=None):
+    frozen_before = get_meta(conn, "compacted_before", MIN_DAY)
+    written = 0
+    for tier, table in TABLES.items():
+        first = MIN_DAY if first_day is None else period_start(first_day, tier)
+        last = MAX_DAY if last_day is None else period_end(last_day, tier)
+        where, params = "date BETWEEN ? AND ?", [first, last]
+        if symbol is not None:
+            where, params = "symbol = ? AND " + where, [symbol] + params
+        cur = conn.execute(REFRESH_ROLLUP.format(period=PERIOD_SQL[tier], where=where, table=table),
+                           params + [frozen_before])
+        written += cur.rowcount
+    metrics.count("db.rollup_rows", written)
+    return written
+
+# Rollup rows of one symbol as (periods, opens, highs, lows, closes, volumes)
+# lists, oldest first, for periods starting between two days (None for open ends)
+def read(conn, symbol, tier, first_day=None, last_day=None):
+    first = MIN_DAY if first_day is None else period_start(first_day, tier)
+    last = MAX_DAY if last_day is None else last_day
+    rows = conn.execute(f"SELECT period, open, high, low, close, volume FROM {TABLES[tier]}"
+                        " WHERE symbol = ? AND period BETWEEN ? AND ? ORDER BY period;", (symbol, first, last))
+    columns = list(zip(*rows))
+    return columns if columns else [[] for _ in range(6)]
+
+# (first, last) day covered by a symbol's monthly rollup, or None
+def stored_range(conn, symbol):
+    first, last = conn.execute("SELECT min(period), max(period) FROM monthlyData WHERE symbol = ?;",
+                               (symbol,)).fetchone()
+    return None if first is None else (first, period_end(last, "monthly"))
+
+# Aggregate in-memory columns (sorted by day) the same way as the rollup
+# tables; returns (periods, opens, highs, lows, closes, volumes) lists. Opens,
+# highs and lows may be None or hold NaN where only the close is known.
+def aggregate(days, closes, volumes, tier, opens=None, highs=None, lows=None):
+    result = [[] for _ in range(6)]
+    opens, highs, lows = (closes if column is None else column for column in (opens, highs, lows))
+    rows = zip(days, closes, volumes, opens, highs, lows)
+    for period, group in groupby(rows, key=lambda row: period_start(row[0], tier)):
+        group = list(group)
+        first, last = group[0], group[-1]
+        high = max(row[1] if row[4] != row[4] else row[4] for row in group)
+        low = min(row[1] if row[5] != row[5] else row[5] for row in group)
+        for column, value in zip(result, (period, first[1] if first[3] != first[3] else first[3], high, low,
+                                          last[1], sum(row[2] for row in group))):
+            column.append(value)
+    return result
+
+# Retention policy in days (None keeps every daily bar)
+def retention(conn):
+    return get_meta(conn, "retain_days")
+
+def set_retention(conn, days):
+    set_meta(conn, "retain_days", days)
+
+# Delete daily bars older than the retention policy once the cutoff has moved
+# COMPACT_STEP_DAYS (or at all, with force). Their periods are rolled up first
+# and frozen. Returns the daily bars deleted.
+@metrics.timed("db.compact")
+def compact(conn, today=None, force=False):
+    days = retention(conn)
+    if not days:
+        return 0
+    today = to_epoch_day(today or date.today())
+    cutoff = today - int(days)
+    previous = get_meta(conn, "compacted_before", MIN_DAY)
+    if cutoff <= previous or (not force and cutoff - previous < COMPACT_STEP_DAYS):
+        return 0
+    refresh(conn, first_day=None if previous == MIN_DAY else previous, last_day=cutoff)
+    deleted = conn.execute("DELETE FROM dailyData WHERE date < ?;", (cutoff,)).rowcount
+    set_meta(conn, "compacted_before", cutoff)
+    metrics.count("db.bars_compacted", deleted)
+    return deleted
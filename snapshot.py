@@ -0,0 +1,203 @@
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+from array import array
+from stock_class import Stock, History
+from database import DATABASE_FILE
+import metrics
+
+# Binary snapshot of a whole portfolio, opened with mmap so each history is a
+# zero-copy view into the file:
+#
+#   header     magic, format version, stock count, offset of the first block,
+#              database generation
+#   directory  per stock: row count, block offset, shares, symbol, name, flags
+#   blocks     per stock, 8-byte aligned: days (int64), closes, volumes, opens,
+#              highs, lows (float64, NaN where not known)
+#
+# All numbers are little-endian. Format 1 files (no opens, highs or lows),
+# format 2 files (no flags) and format 3 files (no generation) are still read.
+#
+# The flags record changes that had not been saved to stocks.db when the
+# snapshot was written; those stocks are opened with the changes still pending
+# so the next save writes them. The generation is the save counter stocks.db
+# keeps in its meta table: while the two match, nothing has been saved since
+# the snapshot was written.
+
+SNAPSHOT_FILE = "stocks.snap"
+MAGIC = b"STOCKSNP"
+FORMAT_VERSION = 4
+HEADER = struct.Struct("<8sIIQQ")  # magic, version, stock count, data offset, database generation
+OLD_HEADER = struct.Struct("<8sIIQ")  # Formats 1 to 3, without the generation
+ENTRY = struct.Struct("<QQdHHI")  # rows, block offset, shares, symbol bytes, name bytes, flags
+OLD_ENTRY = struct.Struct("<QQdHH")  # Formats 1 and 2, without flags
+FORMAT_COLUMNS = {1: 3, 2: 6, 3: 6, 4: 6}  # 8-byte columns per row in each readable format
+STOCK_UNSAVED = 1  # Name or shares not saved
+HISTORY_UNSAVED = 2  # Some bars not saved
+ROW_BYTES = 8 * FORMAT_COLUMNS[FORMAT_VERSION]
+_mappings = {}  # Absolute snapshot path -> mmap the opened histories view
+
+# Round up to the next multiple of 8 so every column starts aligned
+def _align(offset):
+    return (offset + 7) & ~7
+
+# A column as little-endian bytes for writing
+def _column_bytes(column, typecode):
+    if sys.byteorder == "little":
+        return column
+    column = array(typecode, column)
+    column.byteswap()
+    return column
+
+# Save counter of a database file (0 before its first save), or None if the
+# file does not exist or cannot be read
+def database_generation(database=DATABASE_FILE):
+    if not os.path.exists(database):
+        return None
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(database)}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation';").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return 0 if row is None or row[0] is None else int(row[0])
+
+# Copy the histories of stock_list out of the snapshot mapped from `path` and
+# close the mapping, so the file can be replaced (Windows does not allow that
+# while it is mapped). A mapping still viewed elsewhere is left open.
+def _release(stock_list, path):
+    mapping = _mappings.pop(os.path.abspath(path), None)
+    if mapping is None:
+        return
+    for stock in stock_list:
+        if stock.history_loaded and stock.history.is_mapped:
+            stock.history.unmap()
+    try:
+        mapping.close()
+    except BufferError:
+        pass
+
+# Write every stock and its history to `path`, replacing it atomically, stamped
+# with the generation of the database they were loaded from and saved to.
+# Histories are put in date order first. Returns False if the write failed.
+@metrics.timed("snapshot.save")
+def save_snapshot(stock_list, path=SNAPSHOT_FILE, database=DATABASE_FILE):
+    stocks = list(stock_list)
+    generation = database_generation(database) or 0
+    names = []
+    for stock in stocks:
+        stock.history.sort()
+        names.append((stock.symbol.encode("utf-8"), stock.name.encode("utf-8")))
+
+    directory_size = sum(ENTRY.size + len(symbol) + len(name) for symbol, name in names)
+    offset = _align(HEADER.size + directory_size)
+    directory = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, len(stocks), offset, generation))
+    for stock, (symbol, name) in zip(stocks, names):
+        rows = len(stock.history)
+        flags = (STOCK_UNSAVED if stock.dirty else 0) | (HISTORY_UNSAVED if stock.history.has_changes else 0)
+        directory += ENTRY.pack(rows, offset, stock.shares, len(symbol), len(name), flags) + symbol + name
+        offset += rows * ROW_BYTES
+    directory += bytes(_align(len(directory)) - len(directory))
+
+    folder = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(directory)
+            for stock in stocks:
+                history = stock.history
+                f.write(_column_bytes(history.days, "q"))
+                for column in (history.closes, history.volumes, history.opens, history.highs, history.lows):
+                    f.write(_column_bytes(column, "d"))
+        _release(stocks, path)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"[ERROR] Saving snapshot: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    metrics.count("snapshot.rows_written", (offset - len(directory)) // ROW_BYTES)
+    return True
+
+# Replace the contents of stock_list with the stocks in a snapshot. Each history
+# is a read-only view into the mapped file until it is first changed; stocks
+# with unsaved changes are copied and left pending. Raises ValueError if the
+# file is not a snapshot this version can read.
+@metrics.timed("snapshot.load")
+def load_snapshot(stock_list, path=SNAPSHOT_FILE):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError(f"{path} is not a stock snapshot.")
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+
+    magic, version, count, data_offset = OLD_HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a stock snapshot.")
+    if version not in FORMAT_COLUMNS:
+        raise ValueError(f"{path} is snapshot format {version}; this version reads {FORMAT_VERSION}.")
+    row_bytes = 8 * FORMAT_COLUMNS[version]
+    entry = ENTRY if version >= 3 else OLD_ENTRY
+
+    stocks = []
+    unsaved = {}
+    position = HEADER.size if version >= 4 else OLD_HEADER.size
+    for _ in range(count):
+        rows, offset, shares, symbol_size, name_size, *flags = entry.unpack_from(view, position)
+        position += entry.size
+        symbol = bytes(view[position:position + symbol_size]).decode("utf-8")
+        position += symbol_size
+        name = bytes(view[position:position + name_size]).decode("utf-8")
+        position += name_size
+        if offset < data_offset or offset + rows * row_bytes > size:
+            raise ValueError(f"{path} is truncated or damaged ({symbol}).")
+
+        width = rows * 8
+        columns = [view[offset + n * width:offset + (n + 1) * width].cast("q" if n == 0 else "d")
+                   for n in range(FORMAT_COLUMNS[version])]
+        if sys.byteorder == "little":
+            history = History.mapped(*columns[:3], True, *columns[3:])
+        else:
+            history = History()
+            history.extend_columns(*(_column_bytes(column, column.format) for column in columns))
+        stocks.append(Stock(symbol, name, shares, history))
+        unsaved[symbol] = flags[0] if flags else 0
+
+    _mappings[os.path.abspath(path)] = mapping
+    stock_list.clear()
+    stock_list.add_many(stocks)
+    for stock in stocks:
+        flags = unsaved[stock.symbol]
+        if flags & STOCK_UNSAVED:
+            stock.history.mark_clean()  # The stock itself stays dirty
+        else:
+            stock.mark_clean()
+        if flags & HISTORY_UNSAVED:
+            stock.history.mark_all_changed()
+    return len(stocks)
+
+# Database generation stamped in a snapshot, or None for a file written before
+# format 4 or one that is not a snapshot
+def snapshot_generation(path=SNAPSHOT_FILE):
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    magic, version, _, _, generation = HEADER.unpack(header)
+    return generation if magic == MAGIC and version >= 4 else None
+
+# True when a snapshot exists and nothing has been saved to the database since
+# it was written, so it can be opened instead of loading the database
+def snapshot_is_current(path=SNAPSHOT_FILE, database=DATABASE_FILE):
+    if not os.path.exists(path):
+        return False
+    generation = snapshot_generation(path)
+    if generation is None:
+        return False
+    return not os.path.exists(database) or database_generation(database) == generation
@@ -1,160 +1,973 @@
-from datetime import datetime
-
-# Represents a stock with basic information and a history of daily data
-class Stock:
-    def __init__(self, ticker, company_name, quantity):
-        self._ticker = ticker
-        self._company_name = company_name
-        self._quantity = quantity
-        self.history = []  # Holds DailyEntry objects
-
-    @property
-    def symbol(self):
-        return self._ticker
-
-    @symbol.setter
-    def symbol(self, value):
-        raise RuntimeWarning("Stock symbol cannot be changed once set.")
-
-    @property
-    def name(self):
-        return self._company_name
-
-    @name.setter
-    def name(self, value):
-        self._company_name = value
-
-    @property
-    def shares(self):
-        return self._quantity
-
-    @shares.setter
-    def shares(self, value):
-        raise RuntimeWarning("Use buy() or sell() methods to update share count.")
-
-    def buy(self, amount):
-        self._quantity += amount
-
-    def sell(self, amount):
-        self._quantity -= amount
-
-    def add_entry(self, daily_record):
-        self.history.append(daily_record)
-
-
-# Represents daily trading information for a stock
-class DailyEntry:
-    def __init__(self, date, closing_price, volume):
-        self._date = date
-        self._closing_price = closing_price
-        self._volume = volume
-
-    @property
-    def date(self):
-        return self._date
-
-    @date.setter
-    def date(self, value):
-        self._date = value
-
-    @property
-    def close(self):
-        return self._closing_price
-
-    @close.setter
-    def close(self, value):
-        self._closing_price = value
-
-    @property
-    def volume(self):
-        return self._volume
-
-    @volume.setter
-    def volume(self, value):
-        self._volume = value
-
-
-# --- Simple Unit Test to Validate Stock Class ---
-def main():
-    issues = []
-
-    print("Starting Stock Class Tests")
-
-    # Test stock creation
-    try:
-        stock = Stock("DEMO", "Demo Corp", 100)
-        print("Created stock successfully.")
-    except:
-        print("Could not create stock.")
-        issues.append("Stock constructor failed.")
-
-    # Test ticker immutability
-    try:
-        stock.symbol = "NEW"
-        print("Symbol changed. Should be read-only.")
-        issues.append("Ticker symbol change allowed (should be blocked).")
-    except:
-        print("Ticker symbol change blocked.")
-
-    # Test name update
-    try:
-        stock.name = "New Demo Corp"
-        if stock.name == "New Demo Corp":
-            print("Company name updated.")
-        else:
-            print("Company name not updated correctly.")
-            issues.append("Name update failed.")
-    except:
-        print("Error updating company name.")
-        issues.append("Name setter exception.")
-
-    # Test shares update (should be blocked)
-    try:
-        stock.shares = 999
-        print("Direct shares update allowed.")
-        issues.append("Shares should only be updated via buy/sell.")
-    except:
-        print("Direct shares update blocked.")
-
-    # Test buy and sell
-    stock.buy(50)
-    if stock.shares != 150:
-        print("Buy operation failed.")
-        issues.append("Buy method failed.")
-    else:
-        print("Buy operation passed.")
-
-    stock.sell(25)
-    if stock.shares != 125:
-        print("Sell operation failed.")
-        issues.append("Sell method failed.")
-    else:
-        print("Sell operation passed.")
-
-    # Test adding daily entry
-    try:
-        entry = DailyEntry(datetime.strptime("1/1/20", "%m/%d/%y"), 14.50, 100000)
-        stock.add_entry(entry)
-
-        if stock.history[0].date != datetime.strptime("1/1/20", "%m/%d/%y"):
-            issues.append("Incorrect date in daily record.")
-        if stock.history[0].close != 14.50:
-            issues.append("Incorrect closing price.")
-        if stock.history[0].volume != 100000:
-            issues.append("Incorrect volume.")
-        print("Daily entry added and verified.")
-    except:
-        print("Error adding daily stock entry.")
-        issues.append("add_entry method failed.")
-
-    # Test summary
-    print("\nTest Results")
-    if not issues:
-        print("All tests passed!")
-    else:
-        for issue in issues:
-            print("⚠️", issue)
-
-# Run unit test if file is executed
-if __name__ == "__main__":
-    main()
+from array import array
+from bisect import bisect_left, insort
+from collections import namedtuple
+from datetime import datetime
+from itertools import compress, islice, repeat
+from operator import le
+
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+NAN = float("nan")  # Stored for an open, high or low that is not known
+
+# Convert a date or datetime to a day number counted from 1970-01-01
+def to_epoch_day(value):
+    return value.toordinal() - EPOCH_ORDINAL
+
+# Convert a day number counted from 1970-01-01 back to a datetime
+def from_epoch_day(day):
+    return datetime.fromordinal(day + EPOCH_ORDINAL)
+
+# Column of `count` unknown opens, highs or lows
+def nan_column(count):
+    return array("d", [NAN]) * count
+
+# An open, high or low as stored in a History (None becomes NaN)
+def price_or_nan(value):
+    return NAN if value is None else value
+
+# True if two stored prices are equal, counting two unknowns as equal
+def same_price(a, b):
+    return a == b or (a != a and b != b)
+
+# Bar counts reported by History.merge_columns
+MergeResult = namedtuple("MergeResult", ["inserted", "updated", "unchanged"])
+
+# Represents a stock with basic information and a history of daily data
+class Stock:
+    def __init__(self, ticker, company_name, quantity, history=None):
+        self._ticker = ticker
+        self._company_name = company_name
+        self._quantity = quantity
+        self._dirty = True  # Set until the stock row has been saved
+        self._history = History() if history is None else history  # Columnar store of daily price data
+        self._history_loader = None
+
+    @property
+    def symbol(self):
+        return self._ticker
+
+    @symbol.setter
+    def symbol(self, value):
+        raise RuntimeWarning("Stock symbol cannot be changed once set.")
+
+    @property
+    def name(self):
+        return self._company_name
+
+    @name.setter
+    def name(self, value):
+        self._company_name = value
+        self._dirty = True
+
+    @property
+    def shares(self):
+        return self._quantity
+
+    @shares.setter
+    def shares(self, value):
+        raise RuntimeWarning("Use buy() or sell() methods to update share count.")
+
+    # Price history, fetched through the history loader on first access when loaded lazily
+    @property
+    def history(self):
+        if self._history is None:
+            self._history = self._history_loader(self._ticker)
+            self._history_loader = None
+        return self._history
+
+    # Defer loading the history until it is first accessed
+    def set_history_loader(self, loader):
+        self._history = None
+        self._history_loader = loader
+
+    @property
+    def history_loaded(self):
+        return self._history is not None
+
+    # True when name or shares changed since the last save or load
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def buy(self, amount):
+        self._quantity += amount
+        self._dirty = True
+
+    def sell(self, amount):
+        self._quantity -= amount
+        self._dirty = True
+
+    # Forget pending changes once the stock and its history are stored
+    def mark_clean(self):
+        self._dirty = False
+        if self._history is not None:
+            self._history.mark_clean()
+
+    # Add one bar in date order; a bar for an existing date replaces it
+    def add_entry(self, daily_record):
+        return self.history.insert(daily_record)
+
+    # Upsert a batch of DailyEntry-like bars by date; returns a MergeResult
+    def merge_entries(self, entries):
+        entries = list(entries)
+        return self.history.merge_columns(array("q", (to_epoch_day(e.date) for e in entries)),
+                                          array("d", (e.close for e in entries)),
+                                          array("d", (e.volume for e in entries)),
+                                          array("d", (price_or_nan(e.open) for e in entries)),
+                                          array("d", (price_or_nan(e.high) for e in entries)),
+                                          array("d", (price_or_nan(e.low) for e in entries)))
+
+    # Upsert a batch of bars given as (days, closes, volumes[, opens, highs,
+    # lows]) columns; returns a MergeResult
+    def merge_columns(self, days, closes, volumes, opens=None, highs=None, lows=None):
+        return self.history.merge_columns(days, closes, volumes, opens, highs, lows)
+
+
+# Stocks kept in symbol order with case-insensitive lookup by symbol
+class Portfolio:
+    def __init__(self, stocks=()):
+        self._stocks = {}  # Upper-case symbol -> Stock
+        self._keys = []  # Upper-case symbols in sorted order
+        self._removed = {}  # Upper-case symbol -> symbol of stocks removed since the last save
+        self.add_many(stocks)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return map(self._stocks.__getitem__, list(self._keys))
+
+    def __contains__(self, symbol):
+        return self._key(symbol) in self._stocks
+
+    # Position-based access in symbol order (matches the GUI list box)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._stocks[key] for key in self._keys[index]]
+        return self._stocks[self._keys[index]]
+
+    def __delitem__(self, index):
+        for key in (self._keys[index] if isinstance(index, slice) else [self._keys[index]]):
+            self._removed[key] = self._stocks.pop(key).symbol
+        del self._keys[index]
+
+    @staticmethod
+    def _key(symbol):
+        return symbol.symbol.upper() if isinstance(symbol, Stock) else symbol.upper()
+
+    def get(self, symbol, default=None):
+        return self._stocks.get(symbol.upper(), default)
+
+    # Position of a symbol in the sorted order
+    def index(self, symbol):
+        key = symbol.upper()
+        position = bisect_left(self._keys, key)
+        if position == len(self._keys) or self._keys[position] != key:
+            raise ValueError(f"{symbol} is not in the portfolio.")
+        return position
+
+    def symbols(self):
+        return [self._stocks[key].symbol for key in self._keys]
+
+    # Add a stock in symbol order; a stock with the same symbol is replaced
+    def add(self, stock):
+        key = stock.symbol.upper()
+        if key not in self._stocks:
+            insort(self._keys, key)
+        self._stocks[key] = stock
+        self._removed.pop(key, None)
+
+    append = add
+
+    def add_many(self, stocks):
+        for stock in stocks:
+            self._stocks[stock.symbol.upper()] = stock
+            self._removed.pop(stock.symbol.upper(), None)
+        if len(self._stocks) != len(self._keys):
+            self._keys = sorted(self._stocks)
+
+    # Remove a stock by symbol and return it (None if it was not there)
+    def remove(self, symbol):
+        stock = self._stocks.pop(symbol.upper(), None)
+        if stock is not None:
+            del self._keys[bisect_left(self._keys, symbol.upper())]
+            self._removed[symbol.upper()] = stock.symbol
+        return stock
+
+    # Remove several symbols at once; returns how many were removed
+    def remove_many(self, symbols):
+        removed = 0
+        for symbol in symbols:
+            stock = self._stocks.pop(symbol.upper(), None)
+            if stock is not None:
+                self._removed[symbol.upper()] = stock.symbol
+                removed += 1
+        if removed:
+            self._keys = [key for key in self._keys if key in self._stocks]
+        return removed
+
+    # Empty the portfolio, as before loading another one; nothing counts as removed
+    def clear(self):
+        self._stocks.clear()
+        self._keys.clear()
+        self._removed.clear()
+
+    # Symbols removed since the last save, whose stored rows the next save deletes
+    def removed_symbols(self):
+        return list(self._removed.values())
+
+    # Forget removals once the save has deleted them
+    def mark_removals_saved(self):
+        self._removed.clear()
+
+
+# Represents daily trading information for a stock. Open, high and low are
+# None when only the close is known.
+class DailyEntry:
+    __slots__ = ("_date", "_closing_price", "_volume", "_open", "_high", "_low")
+
+    def __init__(self, date, closing_price, volume, open_price=None, high=None, low=None):
+        self._date = date
+        self._closing_price = closing_price
+        self._volume = volume
+        self._open = open_price
+        self._high = high
+        self._low = low
+
+    @property
+    def date(self):
+        return self._date
+
+    @date.setter
+    def date(self, value):
+        self._date = value
+
+    @property
+    def close(self):
+        return self._closing_price
+
+    @close.setter
+    def close(self, value):
+        self._closing_price = value
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+
+    @property
+    def open(self):
+        return self._open
+
+    @open.setter
+    def open(self, value):
+        self._open = value
+
+    @property
+    def high(self):
+        return self._high
+
+    @high.setter
+    def high(self, value):
+        self._high = value
+
+    @property
+    def low(self):
+        return self._low
+
+    @low.setter
+    def low(self, value):
+        self._low = value
+
+
+# Columnar price history: dates as int64 day numbers; closes, volumes, opens,
+# highs and lows as float64 (NaN for an open, high or low that is not known).
+# Rows are handed out as HistoryRow views so callers can keep using the
+# DailyEntry interface (date, close, volume, open, high, low).
+# A history can also wrap read-only buffers (see History.mapped); the columns
+# are copied into arrays the first time the history is changed.
+class History:
+    def __init__(self, entries=()):
+        self._days = array("q")
+        self._closes = array("d")
+        self._volumes = array("d")
+        self._opens = array("d")
+        self._highs = array("d")
+        self._lows = array("d")
+        self._changed = bytearray()  # 1 for rows changed since the last save or load
+        self._changed_count = 0
+        self._sorted = True  # Known to be in date order; False means "not known"
+        self._version = 0  # Bumped on every change to the rows
+        self.extend(entries)
+
+    # History over existing read-only columns, such as memoryviews into a
+    # memory-mapped file. Nothing is copied until the history is changed.
+    # Pass is_sorted when the date order is already known to skip checking it.
+    # Opens, highs and lows default to unknown.
+    @classmethod
+    def mapped(cls, days, closes, volumes, is_sorted=None, opens=None, highs=None, lows=None):
+        extra = [nan_column(len(days)) if column is None else column for column in (opens, highs, lows)]
+        if not len(days) == len(closes) == len(volumes) == len(extra[0]) == len(extra[1]) == len(extra[2]):
+            raise ValueError("History columns must have the same length.")
+        history = cls()
+        history._days, history._closes, history._volumes = days, closes, volumes
+        history._opens, history._highs, history._lows = extra
+        history._changed = None  # All rows clean; allocated when the history is copied
+        history._sorted = days_ordered(days) if is_sorted is None else is_sorted
+        return history
+
+    # True while the columns are still the read-only buffers given to mapped()
+    @property
+    def is_mapped(self):
+        return self._changed is None
+
+    # Copy mapped columns into arrays so they can be changed
+    def _own(self):
+        if self._changed is None:
+            self._days = array("q", self._days)
+            self._closes = array("d", self._closes)
+            self._volumes = array("d", self._volumes)
+            self._opens = array("d", self._opens)
+            self._highs = array("d", self._highs)
+            self._lows = array("d", self._lows)
+            self._changed = bytearray(len(self._days))
+
+    # Copy mapped columns into arrays so the buffers they view can be released
+    def unmap(self):
+        self._own()
+
+    @property
+    def days(self):
+        return self._days
+
+    @property
+    def closes(self):
+        return self._closes
+
+    @property
+    def volumes(self):
+        return self._volumes
+
+    @property
+    def opens(self):
+        return self._opens
+
+    @property
+    def highs(self):
+        return self._highs
+
+    @property
+    def lows(self):
+        return self._lows
+
+    # Changes whenever rows are added, changed or reordered (for caches of derived data)
+    @property
+    def version(self):
+        return self._version
+
+    def __len__(self):
+        return len(self._days)
+
+    def __iter__(self):
+        return map(HistoryRow, repeat(self), range(len(self._days)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._days))
+            if step != 1:
+                raise ValueError("History slices do not support a step.")
+            return HistoryView(self, start, max(start, stop))
+        if index < 0:
+            index += len(self._days)
+        if not 0 <= index < len(self._days):
+            raise IndexError("History index out of range.")
+        return HistoryRow(self, index)
+
+    def append(self, daily_record):
+        self.append_row(to_epoch_day(daily_record.date), daily_record.close, daily_record.volume,
+                        price_or_nan(daily_record.open), price_or_nan(daily_record.high),
+                        price_or_nan(daily_record.low))
+
+    # Add a row at the end; use insert_row to keep the history in date order
+    def append_row(self, day, close, volume, open_price=NAN, high=NAN, low=NAN):
+        self._own()
+        if self._sorted and self._days and day < self._days[-1]:
+            self._sorted = False
+        self._days.append(day)
+        self._closes.append(close)
+        self._volumes.append(volume)
+        self._opens.append(open_price)
+        self._highs.append(high)
+        self._lows.append(low)
+        self._changed.append(1)
+        self._changed_count += 1
+        self._version += 1
+
+    def extend(self, entries):
+        for daily_record in entries:
+            self.append(daily_record)
+
+    # Append whole columns at once (day numbers, closes, volumes and optionally
+    # opens, highs and lows)
+    def extend_columns(self, days, closes, volumes, opens=None, highs=None, lows=None):
+        extra = [nan_column(len(days)) if column is None else column for column in (opens, highs, lows)]
+        if not len(days) == len(closes) == len(volumes) == len(extra[0]) == len(extra[1]) == len(extra[2]):
+            raise ValueError("History columns must have the same length.")
+        self._own()
+        if self._sorted and len(days):
+            self._sorted = days_ordered(days) and (not self._days or self._days[-1] <= days[0])
+        self._days.extend(days)
+        self._closes.extend(closes)
+        self._volumes.extend(volumes)
+        self._opens.extend(extra[0])
+        self._highs.extend(extra[1])
+        self._lows.extend(extra[2])
+        self._changed.extend(b"\x01" * len(days))
+        self._changed_count += len(days)
+        self._version += 1
+
+    def clear(self):
+        self._own()
+        del self._days[:]
+        del self._closes[:]
+        del self._volumes[:]
+        del self._opens[:]
+        del self._highs[:]
+        del self._lows[:]
+        self._changed = bytearray()
+        self._changed_count = 0
+        self._sorted = True
+        self._version += 1
+
+    # Upsert one bar by date with a binary search, keeping the history sorted.
+    # An unknown (NaN) open, high or low keeps the value of the bar it replaces.
+    def insert(self, daily_record):
+        return self.insert_row(to_epoch_day(daily_record.date), daily_record.close, daily_record.volume,
+                               price_or_nan(daily_record.open), price_or_nan(daily_record.high),
+                               price_or_nan(daily_record.low))
+
+    def insert_row(self, day, close, volume, open_price=NAN, high=NAN, low=NAN):
+        self._own()
+        if not self._sorted:
+            self.sort()
+        index = bisect_left(self._days, day)
+        if index < len(self._days) and self._days[index] == day:
+            extra = [old if new != new else new
+                     for new, old in zip((open_price, high, low),
+                                         (self._opens[index], self._highs[index], self._lows[index]))]
+            if self._closes[index] == close and self._volumes[index] == volume and \
+                    all(same_price(new, old) for new, old in
+                        zip(extra, (self._opens[index], self._highs[index], self._lows[index]))):
+                return MergeResult(0, 0, 1)
+            self._closes[index] = close
+            self._volumes[index] = volume
+            self._opens[index], self._highs[index], self._lows[index] = extra
+            self.mark_changed(index)
+            self._version += 1
+            return MergeResult(0, 1, 0)
+        self._days.insert(index, day)
+        self._closes.insert(index, close)
+        self._volumes.insert(index, volume)
+        self._opens.insert(index, open_price)
+        self._highs.insert(index, high)
+        self._lows.insert(index, low)
+        self._changed.insert(index, 1)
+        self._changed_count += 1
+        self._version += 1
+        return MergeResult(1, 0, 0)
+
+    @property
+    def has_changes(self):
+        return self._changed_count > 0
+
+    # Flag one row as changed so the next save writes it
+    def mark_changed(self, index):
+        self._own()
+        if not self._changed[index]:
+            self._changed[index] = 1
+            self._changed_count += 1
+
+    # Yield (day, close, volume, open, high, low) for every row changed since
+    # the last save or load
+    def dirty_rows(self):
+        rows = zip(self._days, self._closes, self._volumes, self._opens, self._highs, self._lows)
+        if not self._changed_count:
+            return iter(())
+        if self._changed_count == len(self._days):
+            return rows
+        return compress(rows, self._changed)
+
+    # (first, last) day of the rows changed since the last save or load, or None
+    def dirty_span(self):
+        if not self._changed_count:
+            return None
+        days = self._days if self._changed_count == len(self._days) else list(compress(self._days, self._changed))
+        if self._sorted:
+            return days[0], days[-1]
+        return min(days), max(days)
+
+    # Flag every row as changed, e.g. for bars that were never saved
+    def mark_all_changed(self):
+        self._own()
+        self._changed = bytearray(b"\x01") * len(self._days)
+        self._changed_count = len(self._days)
+
+    # Clear the changed flag of the rows for the given days, once they alone
+    # have been saved
+    def mark_saved(self, days):
+        if self._changed is None:
+            return
+        if not self._sorted:
+            self.sort()
+        for day in days:
+            index = bisect_left(self._days, day)
+            if index < len(self._days) and self._days[index] == day and self._changed[index]:
+                self._changed[index] = 0
+                self._changed_count -= 1
+
+    def mark_clean(self):
+        if self._changed is not None:
+            self._changed = bytearray(len(self._days))
+        self._changed_count = 0
+
+    # True when the rows are known to be in date order
+    def is_sorted(self):
+        return self._sorted
+
+    # Upsert bars by date in O(n + m), leaving the history sorted by date. A bar
+    # whose date already exists replaces it unless it holds the same values; an
+    # unknown (NaN) open, high or low keeps the existing one. When the batch
+    # repeats a date, its last bar wins.
+    def merge_columns(self, days, closes, volumes, opens=None, highs=None, lows=None):
+        opens, highs, lows = (nan_column(len(days)) if column is None else column
+                              for column in (opens, highs, lows))
+        if not len(days) == len(closes) == len(volumes) == len(opens) == len(highs) == len(lows):
+            raise ValueError("History columns must have the same length.")
+        if not self._sorted:
+            self.sort()
+        if not len(days):
+            return MergeResult(0, 0, 0)
+        self._own()
+        batch = sorted_batch(days, closes, volumes, opens, highs, lows)
+
+        # Rows before the first new date are kept as they are
+        start = bisect_left(self._days, batch[0][0])
+        if start == len(self._days):
+            self.extend_columns(*batch)
+            return MergeResult(len(batch[0]), 0, 0)
+
+        old_days, old_closes, old_volumes = self._days, self._closes, self._volumes
+        old_opens, old_highs, old_lows, old_changed = self._opens, self._highs, self._lows, self._changed
+        merged = [column[:start] for column in (old_days, old_closes, old_volumes, old_opens, old_highs, old_lows)]
+        merged_days, merged_closes, merged_volumes, merged_opens, merged_highs, merged_lows = merged
+        merged_changed = old_changed[:start]
+        inserted = updated = unchanged = 0
+        i, count = start, len(old_days)
+        for day, close, volume, open_price, high, low in zip(*batch):
+            while i < count and old_days[i] < day:
+                merged_days.append(old_days[i])
+                merged_closes.append(old_closes[i])
+                merged_volumes.append(old_volumes[i])
+                merged_opens.append(old_opens[i])
+                merged_highs.append(old_highs[i])
+                merged_lows.append(old_lows[i])
+                merged_changed.append(old_changed[i])
+                i += 1
+            if i < count and old_days[i] == day:
+                if open_price != open_price:
+                    open_price = old_opens[i]
+                if high != high:
+                    high = old_highs[i]
+                if low != low:
+                    low = old_lows[i]
+                if old_closes[i] == close and old_volumes[i] == volume and same_price(old_opens[i], open_price) \
+                        and same_price(old_highs[i], high) and same_price(old_lows[i], low):
+                    merged_changed.append(old_changed[i])
+                    unchanged += 1
+                else:
+                    merged_changed.append(1)
+                    updated += 1
+                i += 1
+            else:
+                merged_changed.append(1)
+                inserted += 1
+            merged_days.append(day)
+            merged_closes.append(close)
+            merged_volumes.append(volume)
+            merged_opens.append(open_price)
+            merged_highs.append(high)
+            merged_lows.append(low)
+
+        for column, old in zip(merged, (old_days, old_closes, old_volumes, old_opens, old_highs, old_lows)):
+            column.extend(old[i:])
+        merged_changed.extend(old_changed[i:])
+        self._days, self._closes, self._volumes, self._opens, self._highs, self._lows = merged
+        self._changed = merged_changed
+        self._changed_count = merged_changed.count(1)
+        if inserted or updated:
+            self._version += 1
+        return MergeResult(inserted, updated, unchanged)
+
+    # Reorder rows; without a key the rows are ordered by date, which is
+    # skipped when the history is already known to be in order
+    def sort(self, key=None, reverse=False):
+        if key is None and not reverse and self._sorted:
+            return
+        self._own()
+        if key is None:
+            order = sorted(range(len(self._days)), key=self._days.__getitem__, reverse=reverse)
+        else:
+            order = sorted(range(len(self._days)), key=lambda i: key(HistoryRow(self, i)), reverse=reverse)
+        self._days = array("q", [self._days[i] for i in order])
+        self._closes, self._volumes, self._opens, self._highs, self._lows = (
+            array("d", [column[i] for i in order])
+            for column in (self._closes, self._volumes, self._opens, self._highs, self._lows))
+        self._changed = bytearray(self._changed[i] for i in order)
+        self._sorted = days_ordered(self._days)
+        self._version += 1
+
+
+# True if a column of day numbers never goes backwards, in one linear pass
+# that stops at the first step back
+def days_ordered(days):
+    return all(map(le, days, islice(days, 1, None)))
+
+# Return a batch of (days, *value columns) ordered by date with repeated dates
+# collapsed (last one wins)
+def sorted_batch(days, *columns):
+    count = len(days)
+    if days_ordered(days) and len(set(days)) == count:
+        return (days,) + columns
+    order = sorted(range(count), key=days.__getitem__)
+    order = [i for n, i in enumerate(order) if n + 1 == count or days[order[n + 1]] != days[i]]
+    return (array("q", [days[i] for i in order]),) + \
+        tuple(array("d", [column[i] for i in order]) for column in columns)
+
+
+# Read-only window over a range of History rows; no data is copied
+class HistoryView:
+    def __init__(self, history, start, stop):
+        self._history = history
+        self._start = start
+        self._stop = stop
+
+    # Column slices are memoryviews into the history buffers. Release them
+    # before appending to the history, since an exported buffer cannot grow.
+    @property
+    def days(self):
+        return memoryview(self._history.days)[self._start:self._stop]
+
+    @property
+    def closes(self):
+        return memoryview(self._history.closes)[self._start:self._stop]
+
+    @property
+    def volumes(self):
+        return memoryview(self._history.volumes)[self._start:self._stop]
+
+    @property
+    def opens(self):
+        return memoryview(self._history.opens)[self._start:self._stop]
+
+    @property
+    def highs(self):
+        return memoryview(self._history.highs)[self._start:self._stop]
+
+    @property
+    def lows(self):
+        return memoryview(self._history.lows)[self._start:self._stop]
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        return map(HistoryRow, repeat(self._history), range(self._start, self._stop))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("History slices do not support a step.")
+            return HistoryView(self._history, self._start + start, self._start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("History index out of range.")
+        return HistoryRow(self._history, self._start + index)
+
+
+# DailyEntry-compatible view of a single History row
+class HistoryRow:
+    __slots__ = ("_history", "_index")
+
+    def __init__(self, history, index):
+        self._history = history
+        self._index = index
+
+    @property
+    def date(self):
+        return from_epoch_day(self._history._days[self._index])
+
+    @date.setter
+    def date(self, value):
+        history, index = self._history, self._index
+        day = to_epoch_day(value)
+        history._own()
+        history._days[index] = day
+        if (index > 0 and history._days[index - 1] > day) or \
+                (index + 1 < len(history._days) and history._days[index + 1] < day):
+            history._sorted = False
+        history.mark_changed(index)
+        history._version += 1
+
+    @property
+    def close(self):
+        return self._history._closes[self._index]
+
+    @close.setter
+    def close(self, value):
+        self._history._own()
+        self._history._closes[self._index] = value
+        self._history.mark_changed(self._index)
+        self._history._version += 1
+
+    @property
+    def volume(self):
+        return self._history._volumes[self._index]
+
+    @volume.setter
+    def volume(self, value):
+        self._history._own()
+        self._history._volumes[self._index] = value
+        self._history.mark_changed(self._index)
+        self._history._version += 1
+
+    # Open, high and low are None when not known
+    @property
+    def open(self):
+        return self._price("_opens")
+
+    @open.setter
+    def open(self, value):
+        self._set_price("_opens", value)
+
+    @property
+    def high(self):
+        return self._price("_highs")
+
+    @high.setter
+    def high(self, value):
+        self._set_price("_highs", value)
+
+    @property
+    def low(self):
+        return self._price("_lows")
+
+    @low.setter
+    def low(self, value):
+        self._set_price("_lows", value)
+
+    def _price(self, name):
+        value = getattr(self._history, name)[self._index]
+        return None if value != value else value
+
+    def _set_price(self, name, value):
+        history = self._history
+        history._own()
+        getattr(history, name)[self._index] = price_or_nan(value)
+        history.mark_changed(self._index)
+        history._version += 1
+
+
+# --- Simple Unit Test to Validate Stock Class ---
+def main():
+    issues = []
+
+    print("Starting Stock Class Tests")
+
+    # Test stock creation
+    try:
+        stock = Stock("DEMO", "Demo Corp", 100)
+        print("Created stock successfully.")
+    except:
+        print("Could not create stock.")
+        issues.append("Stock constructor failed.")
+
+    # Test ticker immutability
+    try:
+        stock.symbol = "NEW"
+        print("Symbol changed. Should be read-only.")
+        issues.append("Ticker symbol change allowed (should be blocked).")
+    except:
+        print("Ticker symbol change blocked.")
+
+    # Test name update
+    try:
+        stock.name = "New Demo Corp"
+        if stock.name == "New Demo Corp":
+            print("Company name updated.")
+        else:
+            print("Company name not updated correctly.")
+            issues.append("Name update failed.")
+    except:
+        print("Error updating company name.")
+        issues.append("Name setter exception.")
+
+    # Test shares update (should be blocked)
+    try:
+        stock.shares = 999
+        print("Direct shares update allowed.")
+        issues.append("Shares should only be updated via buy/sell.")
+    except:
+        print("Direct shares update blocked.")
+
+    # Test buy and sell
+    stock.buy(50)
+    if stock.shares != 150:
+        print("Buy operation failed.")
+        issues.append("Buy method failed.")
+    else:
+        print("Buy operation passed.")
+
+    stock.sell(25)
+    if stock.shares != 125:
+        print("Sell operation failed.")
+        issues.append("Sell method failed.")
+    else:
+        print("Sell operation passed.")
+
+    # Test adding daily entry
+    try:
+        entry = DailyEntry(datetime.strptime("1/1/20", "%m/%d/%y"), 14.50, 100000)
+        stock.add_entry(entry)
+
+        if stock.history[0].date != datetime.strptime("1/1/20", "%m/%d/%y"):
+            issues.append("Incorrect date in daily record.")
+        if stock.history[0].close != 14.50:
+            issues.append("Incorrect closing price.")
+        if stock.history[0].volume != 100000:
+            issues.append("Incorrect volume.")
+        print("Daily entry added and verified.")
+    except:
+        print("Error adding daily stock entry.")
+        issues.append("add_entry method failed.")
+
+    # Test merge and upsert counts
+    try:
+        history = History()
+        history.extend_columns(array("q", [10, 11, 12]), array("d", [1.0, 2.0, 3.0]), array("d", [100, 100, 100]))
+        history.mark_clean()
+        merged = history.merge_columns(array("q", [9, 11, 12, 13]), array("d", [0.5, 2.0, 3.5, 4.0]),
+                                       array("d", [100, 100, 100, 100]))
+        if merged != MergeResult(2, 1, 1) or list(history.days) != [9, 10, 11, 12, 13]:
+            issues.append(f"merge_columns counted {merged}, expected 2 inserted, 1 updated, 1 unchanged.")
+        elif len(list(history.dirty_rows())) != 3:
+            issues.append("merge_columns did not mark exactly the inserted and updated rows changed.")
+        upserts = [history.insert_row(11, 2.0, 100), history.insert_row(11, 2.5, 100), history.insert_row(14, 5.0, 1)]
+        if upserts != [MergeResult(0, 0, 1), MergeResult(0, 1, 0), MergeResult(1, 0, 0)]:
+            issues.append(f"insert_row counted {upserts}.")
+        print("Merge and upsert counts verified.")
+    except Exception as e:
+        print(f"Error merging bars: {e}")
+        issues.append("merge_columns or insert_row failed.")
+
+    database_checks(issues)
+
+    # Test summary
+    print("\nTest Results")
+    if not issues:
+        print("All tests passed!")
+    else:
+        for issue in issues:
+            print("⚠️", issue)
+
+# Checks of stock_data and rollups against a throwaway database: migration
+# from schema v1 (with unreadable dates), rollups kept up to date by saves,
+# and fetch planning around ranges known to be empty
+def database_checks(issues):
+    import os
+    import sqlite3
+    import tempfile
+    import rollups
+    import stock_data
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "v1.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE stocks (symbol TEXT PRIMARY KEY, name TEXT, shares REAL);")
+        conn.execute("CREATE TABLE dailyData (symbol TEXT, date TEXT, price REAL, volume REAL);")
+        conn.execute("INSERT INTO stocks VALUES ('DEMO', 'Demo Corp', 10);")
+        conn.executemany("INSERT INTO dailyData VALUES ('DEMO', ?, ?, 1000);",
+                         [("01/02/20", 14.5), ("01/03/20", 15.0), ("1/6/2020", 15.5), ("12/31/99", 9.0)])
+        conn.commit()
+        conn.close()
+
+        # Test migration from schema v1
+        try:
+            with stock_data.open_database(path) as db:
+                stocks = Portfolio()
+                stock_data.load_stock_data(stocks)
+                with db.reader() as conn:
+                    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+                    unreadable = conn.execute("SELECT date FROM dailyData_unreadable;").fetchall()
+            days = list(stocks.get("DEMO").history.days)
+            expected = [to_epoch_day(datetime(1999, 12, 31)), to_epoch_day(datetime(2020, 1, 2)),
+                        to_epoch_day(datetime(2020, 1, 3))]
+            if version != stock_data.SCHEMA_VERSION or days != expected or unreadable != [("1/6/2020",)]:
+                issues.append(f"v1 migration gave version {version}, days {days}, unreadable {unreadable}.")
+            else:
+                print("Schema v1 migration verified.")
+        except Exception as e:
+            print(f"Error migrating a v1 database: {e}")
+            issues.append("v1 migration failed.")
+
+        # Test incremental rollups against rollups.aggregate
+        try:
+            with stock_data.open_database(os.path.join(folder, "rollups.db")) as db:
+                stock = Stock("ROLL", "Rollup Corp", 1)
+                stock.merge_columns(array("q", range(18000, 18400)), array("d", (float(n % 37) for n in range(400))),
+                                    array("d", repeat(1000.0, 400)))
+                stocks = Portfolio([stock])
+                stock_data.save_stock_data(stocks)
+                stock.merge_columns(array("q", [18100, 18401]), array("d", [99.0, 1.0]), array("d", [5.0, 5.0]))
+                stock_data.save_stock_data(stocks)
+                history = stock.history
+                with db.reader() as conn:
+                    for tier in ("weekly", "monthly"):
+                        stored = [list(column) for column in rollups.read(conn, "ROLL", tier)]
+                        expected = rollups.aggregate(history.days, history.closes, history.volumes, tier)
+                        if stored != expected:
+                            issues.append(f"{tier} rollup does not match rollups.aggregate after an update.")
+            print("Incremental rollups verified.")
+        except Exception as e:
+            print(f"Error checking rollups: {e}")
+            issues.append("Rollup check failed.")
+
+        # Test fetch planning around empty ranges
+        try:
+            days = array("q", range(18300, 18400))
+            plain = stock_data.missing_ranges(days, 18000, 18450, today=18500)
+            skipped = stock_data.missing_ranges(days, 18000, 18450, today=18500, empty=[(18000, 18299)])
+            if plain != [(18000, 18299), (18400, 18450)] or skipped != [(18400, 18450)]:
+                issues.append(f"missing_ranges gave {plain} and, with an empty range, {skipped}.")
+            with stock_data.open_database(os.path.join(folder, "plan.db")) as db:
+                stocks = Portfolio([Stock("PLAN", "Plan Corp", 0)])
+                first, last = stock_data.day_range("01/01/20", "06/30/20")
+                before = stock_data.plan_fetch(stocks, "01/01/20", "06/30/20")
+                with db.transaction() as conn:
+                    conn.execute("INSERT INTO emptyRanges (symbol, first_day, last_day, checked) VALUES (?, ?, ?, ?);",
+                                 ("PLAN", first, last, to_epoch_day(datetime.today())))
+                after = stock_data.plan_fetch(stocks, "01/01/20", "06/30/20")
+            if len(before) != 1 or after:
+                issues.append(f"plan_fetch requested {before} before and {after} after an empty range was stored.")
+            else:
+                print("Fetch planning around empty ranges verified.")
+        except Exception as e:
+            print(f"Error planning fetches: {e}")
+            issues.append("Fetch planning check failed.")
+
+# Run unit test if file is executed
+if __name__ == "__main__":
+    main()
@@ -1,152 +1,294 @@
-from datetime import datetime
-from stock_class import Stock, DailyEntry
-from utilities import clear_console, show_price_chart, sort_stocks_by_symbol, sort_stock_history_by_date
-from os import path
-import stock_data
-
-def show_main_menu(stocks):
-    choice = ""
-    while choice != "0":
-        clear_console()
-        print("=== KM Stock Application ===")
-        print("1 - Portfolio Management")
-        print("2 - Enter Daily Price Data")
-        print("3 - View Report")
-        print("4 - Plot Price Chart")
-        print("5 - Save / Load / Import")
-        print("0 - Quit")
-        choice = input("Select an option: ")
-        if choice == "1":
-            manage_portfolio(stocks)
-        elif choice == "2":
-            add_daily_info(stocks)
-        elif choice == "3":
-            print_report(stocks)
-        elif choice == "4":
-            plot_chart(stocks)
-        elif choice == "5":
-            data_options(stocks)
-
-def manage_portfolio(stocks):
-    action = ""
-    while action != "0":
-        clear_console()
-        print("=== Portfolio Menu ===")
-        print("1 - Add New Stock")
-        print("2 - Modify Share Count")
-        print("3 - Remove Stock")
-        print("4 - Show All Stocks")
-        print("0 - Back to Main Menu")
-        action = input("Choose action: ")
-        if action == "1":
-            create_stock(stocks)
-        elif action == "2":
-            modify_shares(stocks)
-        elif action == "3":
-            remove_stock(stocks)
-        elif action == "4":
-            list_all_stocks(stocks)
-
-def create_stock(stocks):
-    symbol = input("Enter ticker symbol: ").upper()
-    name = input("Company name: ")
-    try:
-        shares = float(input("Number of shares: "))
-        new_stock = Stock(symbol, name, shares)
-        stocks.append(new_stock)
-        sort_stocks_by_symbol(stocks)
-    except:
-        print("Invalid input for shares.")
-
-def modify_shares(stocks):
-    list_all_stocks(stocks)
-    target = input("Enter ticker symbol to update: ").upper()
-    for s in stocks:
-        if s.symbol == target:
-            action = input("Buy or Sell? (b/s): ").lower()
-            try:
-                qty = float(input("Enter amount: "))
-                if action == "b":
-                    s.buy(qty)
-                elif action == "s":
-                    s.sell(qty)
-            except:
-                print("Invalid quantity.")
-            return
-    print("Ticker Symbol not found.")
-
-def remove_stock(stocks):
-    list_all_stocks(stocks)
-    target = input("Enter ticker symbol to remove: ").upper()
-    stocks[:] = [s for s in stocks if s.symbol != target]
-
-def list_all_stocks(stocks):
-    print("\nYour Portfolio:")
-    for s in stocks:
-        print(f"{s.symbol} - {s.name} ({s.shares} shares)")
-
-def add_daily_info(stocks):
-    list_all_stocks(stocks)
-    ticker = input("Enter ticker symbol: ").upper()
-    for s in stocks:
-        if s.symbol == ticker:
-            try:
-                date_input = input("Date (m/d/yy): ")
-                date_obj = datetime.strptime(date_input, "%m/%d/%y")
-                price = float(input("Closing price: "))
-                volume = float(input("Volume: "))
-                daily = DailyEntry(date_obj, price, volume)
-                s.add_entry(daily)
-                sort_stock_history_by_date(stocks)
-            except:
-                print("Invalid input. Try again.")
-            return
-    print("Ticker symbol not found.")
-
-def print_report(stocks):
-    for s in stocks:
-        print(f"\n=== {s.symbol} - {s.name} ===")
-        for d in s.history:
-            print(f"{d.date.strftime('%m/%d/%y')} | Close: ${d.close:.2f} | Volume: {int(d.volume)}")
-
-def plot_chart(stocks):
-    ticker = input("Enter ticker symbol to view chart: ").upper()
-    show_price_chart(stocks, ticker)
-
-def data_options(stocks):
-    print("\n1 - Save to DB")
-    print("2 - Load from DB")
-    print("3 - Get Data Online")
-    print("4 - Load CSV File")
-    choice = input("Select an option: ")
-    if choice == "1":
-        stock_data.save_stock_data(stocks)
-    elif choice == "2":
-        stock_data.load_stock_data(stocks)
-    elif choice == "3":
-        fetch_from_web(stocks)
-    elif choice == "4":
-        load_csv(stocks)
-
-def fetch_from_web(stocks):
-    start = input("Start date (m/d/yy): ")
-    end = input("End date (m/d/yy): ")
-    try:
-        count = stock_data.retrieve_stock_web(start, end, stocks)
-        print(f"{count} records downloaded.")
-    except Exception as err:
-        print(f"Something went wrong: {err}")
-
-def load_csv(stocks):
-    ticker = input("Ticker to load CSV for: ").upper()
-    filepath = input("Path to CSV file: ")
-    stock_data.import_stock_web_csv(stocks, ticker, filepath)
-
-def main():
-    if not path.exists("stocks.db"):
-        stock_data.create_database()
-    portfolio = []
-    show_main_menu(portfolio)
-
-if __name__ == "__main__":
-    main()
+from datetime import datetime, timedelta
+from stock_class import Stock, DailyEntry, Portfolio
+from utilities import clear_console, show_price_chart
+import sqlite3
+import sys
+from os import path
+import stock_data
+import snapshot
+import report
+import ledger
+import metrics
+
+def show_main_menu(stocks):
+    choice = ""
+    while choice != "0":
+        clear_console()
+        print("=== KM Stock Application ===")
+        print("1 - Portfolio Management")
+        print("2 - Enter Daily Price Data")
+        print("3 - View Report")
+        print("4 - Plot Price Chart")
+        print("5 - Save / Load / Import")
+        print("6 - Transaction Log")
+        print("0 - Quit")
+        choice = input("Select an option: ")
+        if choice == "1":
+            manage_portfolio(stocks)
+        elif choice == "2":
+            add_daily_info(stocks)
+        elif choice == "3":
+            print_report(stocks)
+        elif choice == "4":
+            plot_chart(stocks)
+        elif choice == "5":
+            data_options(stocks)
+        elif choice == "6":
+            show_transaction_log(stocks)
+
+def manage_portfolio(stocks):
+    action = ""
+    while action != "0":
+        clear_console()
+        print("=== Portfolio Menu ===")
+        print("1 - Add New Stock")
+        print("2 - Modify Share Count")
+        print("3 - Remove Stock")
+        print("4 - Show All Stocks")
+        print("0 - Back to Main Menu")
+        action = input("Choose action: ")
+        if action == "1":
+            create_stock(stocks)
+        elif action == "2":
+            modify_shares(stocks)
+        elif action == "3":
+            remove_stock(stocks)
+        elif action == "4":
+            list_all_stocks(stocks)
+
+def create_stock(stocks):
+    symbol = input("Enter ticker symbol: ").upper()
+    if symbol in stocks:
+        print(f"{symbol} is already in your portfolio.")
+        return
+    name = input("Company name: ")
+    try:
+        shares = float(input("Number of shares: "))
+        new_stock = Stock(symbol, name, 0)
+        stocks.add(new_stock)
+        if shares:
+            ledger.buy(new_stock, shares)
+    except:
+        print("Invalid input for shares.")
+
+def modify_shares(stocks):
+    list_all_stocks(stocks)
+    target = input("Enter ticker symbol to update: ").upper()
+    s = stocks.get(target)
+    if s is None:
+        print("Ticker Symbol not found.")
+        return
+    action = input("Buy or Sell? (b/s): ").lower()
+    try:
+        qty = float(input("Enter amount: "))
+        if action == "b":
+            ledger.buy(s, qty)
+        elif action == "s":
+            ledger.sell(s, qty)
+    except:
+        print("Invalid quantity.")
+
+def remove_stock(stocks):
+    list_all_stocks(stocks)
+    target = input("Enter ticker symbol to remove: ").upper()
+    removed = stocks.remove(target)
+    if removed is not None and removed.shares:
+        ledger.sell(removed, removed.shares)
+
+def list_all_stocks(stocks):
+    print("\nYour Portfolio:")
+    for s in stocks:
+        print(f"{s.symbol} - {s.name} ({s.shares} shares)")
+
+def add_daily_info(stocks):
+    list_all_stocks(stocks)
+    ticker = input("Enter ticker symbol: ").upper()
+    s = stocks.get(ticker)
+    if s is None:
+        print("Ticker symbol not found.")
+        return
+    try:
+        date_input = input("Date (m/d/yy): ")
+        date_obj = datetime.strptime(date_input, "%m/%d/%y")
+        price = float(input("Closing price: "))
+        volume = float(input("Volume: "))
+        daily = DailyEntry(date_obj, price, volume)
+        s.add_entry(daily)
+    except:
+        print("Invalid input. Try again.")
+
+# Report for some or all stocks over a date range, shown a page at a time or
+# exported to a CSV, JSON lines, Arrow or Parquet file
+def print_report(stocks):
+    symbols = input("Ticker symbol(s), comma separated (blank for all): ").upper()
+    try:
+        start = input("From date (m/d/yy, blank for the first bar): ").strip()
+        end = input("To date (m/d/yy, blank for the last bar): ").strip()
+        date_start = datetime.strptime(start, "%m/%d/%y") if start else None
+        date_end = datetime.strptime(end, "%m/%d/%y") if end else None
+    except ValueError:
+        print("Dates must look like m/d/yy.")
+        return
+    symbols = symbols.split(",") if symbols.strip() else None
+    tier = input("Detail (daily, weekly, monthly, auto; blank for daily): ").strip().lower() or "daily"
+    try:
+        report.check_tier(tier)
+    except ValueError as e:
+        print(e)
+        return
+    filename = input("Export to file (.csv, .jsonl, .arrow, .parquet; blank to show here): ").strip()
+    if filename:
+        try:
+            count = report.export_report(stocks, filename, symbols=symbols, date_start=date_start, date_end=date_end,
+                                         tier=tier)
+            print(f"{count} rows written to {filename}.")
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] Exporting report: {e}")
+        return
+
+    chunks = report.report_chunks(stocks, symbols, date_start, date_end, chunk_rows=report.PAGE_ROWS, tier=tier)
+    for block in report.text_blocks(chunks):
+        sys.stdout.write(block)
+        if not block.startswith("\n===") and input("-- Enter for more, q to stop -- ").strip().lower() == "q":
+            return
+    sys.stdout.write(report.value_line(stocks, symbols))
+
+# Trades from the ledger, optionally for one symbol and a date range, followed
+# by the positions they add up to
+def show_transaction_log(stocks):
+    symbol = input("Ticker symbol (blank for all): ").upper()
+    try:
+        start = input("From date (m/d/yy, blank for the first trade): ")
+        end = input("To date (m/d/yy, blank for today): ")
+        start = datetime.strptime(start, "%m/%d/%y") if start else None
+        end = datetime.strptime(end, "%m/%d/%y") + timedelta(days=1) if end else None
+    except ValueError:
+        print("Dates must look like m/d/yy.")
+        return
+    trade_log = ledger.default_ledger()
+    sync_shares(stocks)
+    count = 0
+    for trade in trade_log.trades(symbol or None, start, end):
+        print(ledger.format_trade(trade))
+        count += 1
+    print(f"\n{count} trades.")
+    for held, quantity in trade_log.positions().items():
+        if not symbol or held == symbol:
+            print(f"{held}: {quantity:g} shares")
+
+def plot_chart(stocks):
+    tickers = input("Enter ticker symbol(s) to view chart (comma separated): ").upper()
+    try:
+        start = input("Start date (m/d/yy, blank for all): ").strip()
+        end = input("End date (m/d/yy, blank for all): ").strip()
+        date_start = datetime.strptime(start, "%m/%d/%y") if start else None
+        date_end = datetime.strptime(end, "%m/%d/%y") if end else None
+    except ValueError:
+        print("Invalid date.")
+        return
+    show_price_chart(stocks, tickers, date_start, date_end)
+
+def data_options(stocks):
+    print("\n1 - Save to DB")
+    print("2 - Load from DB")
+    print("3 - Get Data Online")
+    print("4 - Load CSV File")
+    print("5 - Export Snapshot")
+    print("6 - Open Snapshot")
+    print("7 - Daily Bar Retention")
+    print("8 - Replay Tick File")
+    choice = input("Select an option: ")
+    if choice == "1":
+        stock_data.save_stock_data(stocks)
+    elif choice == "2":
+        stock_data.load_stock_data(stocks, lazy=True)
+        sync_shares(stocks)
+    elif choice == "3":
+        fetch_from_web(stocks)
+    elif choice == "4":
+        load_csv(stocks)
+    elif choice == "5":
+        if snapshot.save_snapshot(stocks, database=stock_data.database().path):
+            print(f"Snapshot written to {snapshot.SNAPSHOT_FILE}.")
+    elif choice == "6":
+        open_snapshot(stocks)
+    elif choice == "7":
+        set_retention()
+    elif choice == "8":
+        replay_ticks(stocks)
+
+def fetch_from_web(stocks):
+    start = input("Start date (m/d/yy): ")
+    end = input("End date (m/d/yy): ")
+    try:
+        count = stock_data.retrieve_stock_web(start, end, stocks)
+        print(f"{count} records downloaded.")
+    except Exception as err:
+        print(f"Something went wrong: {err}")
+
+def load_csv(stocks):
+    ticker = input("Ticker to load CSV for: ").upper()
+    filepath = input("Path to CSV file: ")
+    stock_data.import_stock_web_csv(stocks, ticker, filepath)
+
+# Daily bars older than the retention period are deleted from the database;
+# weekly and monthly rollups keep their history
+def set_retention():
+    years = input("Keep daily bars for how many years (blank or 0 keeps them all): ").strip()
+    try:
+        days = round(float(years) * 365.25) if years else 0
+        deleted = stock_data.set_retention(days or None)
+    except ValueError:
+        print("Enter a number of years.")
+        return
+    except sqlite3.Error as e:
+        print(f"[ERROR] Setting retention: {e}")
+        return
+    print(f"{deleted} old daily bars compacted." if deleted else "Retention updated.")
+    if deleted and input("Reclaim the disk space now (y/n)? ").strip().lower() == "y":
+        stock_data.vacuum_database()
+
+# Intraday ticks (SYMBOL,TIMESTAMP,PRICE,SIZE lines) become daily bars, saved
+# to the database at each session close
+def replay_ticks(stocks):
+    import ticks
+
+    filepath = input("Path to tick file: ")
+    add_missing = input("Add stocks that are not in your list (y/n)? ").strip().lower() == "y"
+    try:
+        result = ticks.ingest(stocks, ticks.read_tick_file(filepath), add_missing=add_missing)
+    except OSError as e:
+        print(f"[ERROR] Reading ticks: {e}")
+        return
+    print(f"{result.ticks} ticks replayed into {result.bars} daily bars over {result.sessions} sessions.")
+    if result.late_ticks:
+        print(f"{result.late_ticks} ticks arrived after their session closed and were skipped.")
+
+def open_snapshot(stocks):
+    try:
+        count = snapshot.load_snapshot(stocks)
+        print(f"{count} stocks opened from {snapshot.SNAPSHOT_FILE}.")
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] Opening snapshot: {e}")
+        return
+    sync_shares(stocks)
+
+# Share counts come from the ledger; report the stocks that disagreed with it
+def sync_shares(stocks):
+    for discrepancy in ledger.sync_shares(stocks):
+        print(ledger.format_discrepancy(discrepancy))
+
+# Starts from the snapshot when nothing was saved to the database after it was written
+def main(database_path=stock_data.DATABASE_FILE):
+    with stock_data.open_database(database_path) as db:
+        current = snapshot.snapshot_is_current(database=db.path)
+        if not path.exists(db.path):
+            stock_data.create_database()
+        portfolio = Portfolio()
+        if current:
+            open_snapshot(portfolio)
+        show_main_menu(portfolio)
+
+if __name__ == "__main__":
+    metrics.configure()
+    main()
@@ -1,149 +1,666 @@
 import sqlite3
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from bs4 import BeautifulSoup
-from datetime import datetime
+import threading
+import warnings
+from datetime import date, datetime
 import csv
-import time
-from utilities import clear_console, sort_stock_history_by_date
-from stock_class import Stock, DailyEntry
+import glob
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from utilities import clear_console
+from stock_class import Stock, History, MergeResult, to_epoch_day, nan_column, NAN
+from database import Database, DATABASE_FILE, SYNCHRONOUS_MODES
+import rollups
+import metrics
+
+SCHEMA_VERSION = 7  # Stored in PRAGMA user_version
+MIN_DAY, MAX_DAY = -(2 ** 63), 2 ** 63 - 1
+MIGRATION_CHUNK = 100000  # dailyData rows copied per transaction while migrating
+CSV_CHUNK_BYTES = 1 << 20  # CSV text converted per chunk while importing
+MAX_MARKET_GAP = 4  # Longest run of days without bars that is treated as a weekend or holiday
+MERGE_GAP_DAYS = 30  # Missing ranges closer together than this are fetched with one request
+EMPTY_RANGE_DAYS = 90  # Days a range that came back empty is skipped before it is asked for again
+FETCH_CACHE_DIR = "fetch_cache"
+FETCH_CACHE_TTL = 12 * 3600  # Seconds a downloaded page is reused
+FETCH_CACHE_BYTES = 256 * 1024 * 1024
+_fetch_cache = None
+_database = None
+_database_lock = threading.Lock()
+
+STOCKS_TABLE = """
+    CREATE TABLE IF NOT EXISTS stocks (
+        symbol TEXT PRIMARY KEY,
+        name TEXT,
+        shares REAL
+    );
+"""
+
+# Schema v2: dates are day numbers counted from 1970-01-01. Schema v4 adds the
+# open, high and low, NULL where only the close is known.
+DAILY_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        symbol TEXT NOT NULL,
+        date INTEGER NOT NULL,
+        price REAL NOT NULL,
+        volume REAL NOT NULL,
+        open REAL,
+        high REAL,
+        low REAL,
+        PRIMARY KEY (symbol, date)
+    ) WITHOUT ROWID;
+"""
+OHLC_COLUMNS = ("open", "high", "low")
+
+# Schema v5: day ranges a fetch returned an empty history table for (before a
+# listing, long market closures), so incremental fetches do not request them
+# again for EMPTY_RANGE_DAYS. Schema v6 adds the day each range was fetched.
+EMPTY_RANGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS emptyRanges (
+        symbol TEXT NOT NULL,
+        first_day INTEGER NOT NULL,
+        last_day INTEGER NOT NULL,
+        checked INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (symbol, first_day)
+    ) WITHOUT ROWID;
+"""
+
+# Finds the bars of a date range across all symbols (compaction, rollup
+# refreshes); schema v7 narrowed it from a covering index over price and volume
+DAILY_DATE_INDEX = "CREATE INDEX IF NOT EXISTS dailyData_date_symbol ON dailyData (date, symbol);"
+OLD_DAILY_DATE_INDEX = "dailyData_date"
+
+# Version 1 rows whose text date could not be read are kept here for repair
+# instead of being dropped with the old table
+UNREADABLE_TABLE = """
+    CREATE TABLE IF NOT EXISTS dailyData_unreadable (
+        symbol TEXT,
+        date TEXT,
+        price REAL,
+        volume REAL
+    );
+"""
+
+# Schema v1 stored m/d/yy text; this turns it into a day number (%y maps 69-99 to 19xx)
+V1_DATE_TO_DAY = ("CAST(julianday(CASE WHEN substr(date, 7, 2) >= '69' THEN '19' ELSE '20' END"
+                  " || substr(date, 7, 2) || '-' || substr(date, 1, 2) || '-' || substr(date, 4, 2))"
+                  " - 2440587.5 AS INTEGER)")
+
+# Open the database shared by every load, save, fetch and import in this
+# process, replacing (and closing) the one open before. Options are passed to
+# database.Database. Use it as a context manager to close it at the end:
+#
+#   with stock_data.open_database("other.db"):
+#       stock_data.load_stock_data(portfolio)
+def open_database(path=DATABASE_FILE, **options):
+    global _database
+    db = Database(path, prepare=prepare_database, **options)
+    with _database_lock:
+        previous, _database = _database, db
+    if previous is not None:
+        previous.close()
+    return db
+
+# The shared database, opening stocks.db (or reopening the last path) on first use
+def database():
+    global _database
+    with _database_lock:
+        if _database is None or _database.closed:
+            path = _database.path if _database is not None else DATABASE_FILE
+            _database = Database(path, prepare=prepare_database)
+        return _database
 
 # Create the SQLite database for stocks and their history
 def create_database():
-    conn = sqlite3.connect("stocks.db")
-    cur = conn.cursor()
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS stocks (
-            symbol TEXT PRIMARY KEY,
-            name TEXT,
-            shares REAL
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS dailyData (
-            symbol TEXT NOT NULL,
-            date TEXT NOT NULL,
-            price REAL NOT NULL,
-            volume REAL NOT NULL,
-            PRIMARY KEY (symbol, date)
-        );
-    """)
+    with database().writer():
+        pass
+
+# Create the tables or upgrade an older schema as needed; runs once per
+# database on its writer connection
+def prepare_database(conn):
+    if conn.execute("PRAGMA user_version;").fetchone()[0] < SCHEMA_VERSION:
+        migrate_database(conn)
+
+# Bring the schema up to SCHEMA_VERSION in place. Version 1 dailyData rows are
+# copied into the new table in rowid chunks, one transaction per chunk, so the
+# data never has to fit in memory and an interrupted run can simply be repeated.
+# Rows with unreadable dates are moved to dailyData_unreadable first.
+# Version 3 adds the weekly and monthly rollups, built here from dailyData,
+# version 4 the nullable open, high and low columns (the rollups are rebuilt
+# for them), version 5 the emptyRanges table, version 6 its checked day and
+# version 7 the narrower date index.
+@metrics.timed("db.migrate")
+def migrate_database(conn):
+    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    conn.execute(STOCKS_TABLE)
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(dailyData);")}
+
+    if columns.get("date", "").upper() == "TEXT":
+        conn.execute(DAILY_TABLE.format(name="dailyData_v2"))
+        conn.execute(UNREADABLE_TABLE)
+        conn.execute("DELETE FROM dailyData_unreadable;")  # Left by an interrupted run
+        last_rowid = conn.execute("SELECT max(rowid) FROM dailyData;").fetchone()[0] or 0
+        for first in range(0, last_rowid, MIGRATION_CHUNK):
+            with conn:
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO dailyData_v2 (symbol, date, price, volume)
+                    SELECT symbol, {V1_DATE_TO_DAY} AS day, price, volume FROM dailyData
+                    WHERE rowid > ? AND rowid <= ? AND day IS NOT NULL;
+                """, (first, first + MIGRATION_CHUNK))
+                conn.execute(f"""
+                    INSERT INTO dailyData_unreadable (symbol, date, price, volume)
+                    SELECT symbol, date, price, volume FROM dailyData
+                    WHERE rowid > ? AND rowid <= ? AND {V1_DATE_TO_DAY} IS NULL;
+                """, (first, first + MIGRATION_CHUNK))
+        unreadable = conn.execute("SELECT count(*) FROM dailyData_unreadable;").fetchone()[0]
+        if unreadable:
+            print(f"[WARNING] {unreadable} dailyData rows have unreadable dates; they were moved to"
+                  f" dailyData_unreadable.")
+        conn.execute("BEGIN;")
+        conn.execute("DROP TABLE dailyData;")
+        conn.execute("ALTER TABLE dailyData_v2 RENAME TO dailyData;")
+    else:
+        conn.execute("BEGIN;")
+        conn.execute(DAILY_TABLE.format(name="dailyData"))
+        for name in OHLC_COLUMNS:
+            if columns and name not in columns:
+                conn.execute(f"ALTER TABLE dailyData ADD COLUMN {name} REAL;")
 
+    conn.execute(f"DROP INDEX IF EXISTS {OLD_DAILY_DATE_INDEX};")
+    conn.execute(DAILY_DATE_INDEX)
+    conn.execute(EMPTY_RANGES_TABLE)
+    if "checked" not in {row[1] for row in conn.execute("PRAGMA table_info(emptyRanges);")}:
+        conn.execute("ALTER TABLE emptyRanges ADD COLUMN checked INTEGER NOT NULL DEFAULT 0;")
+    rollups.create_tables(conn)
+    if version < 4:
+        rollups.refresh(conn)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
     conn.commit()
-    conn.close()
 
-# Save stock objects and their history to the database
-def save_stock_data(stock_list):
-    conn = sqlite3.connect("stocks.db")
-    cur = conn.cursor()
+# Apply optional journaling and sync settings to a connection (on the shared
+# writer they stay in effect for later saves)
+def configure_connection(conn, wal=False, synchronous=None):
+    if wal:
+        conn.execute("PRAGMA journal_mode=WAL;")
+    if synchronous is not None:
+        if str(synchronous).upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown synchronous mode: {synchronous}")
+        conn.execute(f"PRAGMA synchronous={str(synchronous).upper()};")
 
+# Save stocks and history rows changed since the last save or load, and delete
+# the stocks rows of stocks removed from the portfolio (their bars stay, for a
+# stock added again later). All writes go through executemany inside a single
+# transaction, together with the rollup periods the changed rows fall in and,
+# when a retention policy is set, compaction of old daily bars.
+# Returns False (and keeps the changes pending) if the save failed.
+@metrics.timed("db.save")
+def save_stock_data(stock_list, wal=False, synchronous=None):
+    stock_rows = [(stock.symbol, stock.name, stock.shares) for stock in stock_list if stock.dirty]
+    removed = [(symbol,) for symbol in stock_list.removed_symbols()]
+    changed = [stock for stock in stock_list if stock.history_loaded and stock.history.has_changes]
+    # SQLite stores the NaN of an unknown open, high or low as NULL
+    daily_rows = ((stock.symbol, *row) for stock in changed for row in stock.history.dirty_rows())
+    spans = [(stock.symbol, *stock.history.dirty_span()) for stock in changed]
+
+    try:
+        with database().writer() as conn:
+            configure_connection(conn, wal, synchronous)
+            with conn:
+                conn.executemany("DELETE FROM stocks WHERE symbol = ?;", removed)
+                conn.executemany("INSERT OR REPLACE INTO stocks (symbol, name, shares) VALUES (?, ?, ?);", stock_rows)
+                rows_written = conn.executemany("INSERT OR REPLACE INTO dailyData (symbol, date, price, volume, open, high, low)"
+                                                " VALUES (?, ?, ?, ?, ?, ?, ?);", daily_rows).rowcount
+                for symbol, first_day, last_day in spans:
+                    rollups.refresh(conn, symbol, first_day, last_day)
+                compacted = rollups.compact(conn)
+                if stock_rows or removed or spans or compacted:
+                    bump_generation(conn)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"[ERROR] Saving stock data: {e}")
+        return False
+    metrics.count("db.stocks_written", len(stock_rows))
+    metrics.count("db.rows_written", rows_written)
+    stock_list.mark_removals_saved()
     for stock in stock_list:
-        try:
-            cur.execute("INSERT OR REPLACE INTO stocks (symbol, name, shares) VALUES (?, ?, ?);",
-                        (stock.symbol, stock.name, stock.shares))
-        except Exception as e:
-            print(f"[ERROR] Saving stock {stock.symbol}: {e}")
+        stock.mark_clean()
+    return True
+
+# Save just the given bars, as (symbol, day, close, volume, open, high, low)
+# rows, and the stocks rows of `new_stocks`, leaving every other pending change
+# for the next save_stock_data. The rows are then marked saved in the histories
+# of stock_list. Returns False (and keeps them pending) if the save failed.
+@metrics.timed("db.save_bars")
+def save_bars(stock_list, rows, new_stocks=()):
+    rows = sorted(rows, key=itemgetter(0, 1))
+    spans = []
+    for symbol, group in groupby(rows, key=itemgetter(0)):
+        days = [row[1] for row in group]
+        spans.append((symbol, days[0], days[-1]))
+    try:
+        with database().transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO stocks (symbol, name, shares) VALUES (?, ?, ?);",
+                             [(stock.symbol, stock.name, stock.shares) for stock in new_stocks])
+            conn.executemany("INSERT OR REPLACE INTO dailyData (symbol, date, price, volume, open, high, low)"
+                             " VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+            for symbol, first_day, last_day in spans:
+                rollups.refresh(conn, symbol, first_day, last_day)
+            rollups.compact(conn)
+            bump_generation(conn)
+    except (sqlite3.Error, ValueError) as e:
+        print(f"[ERROR] Saving bars: {e}")
+        return False
+    metrics.count("db.rows_written", len(rows))
+    for stock in new_stocks:
+        stock.mark_clean()
+    for symbol, group in groupby(rows, key=itemgetter(0)):
+        stock = stock_list.get(symbol)
+        if stock is not None and stock.history_loaded:
+            stock.history.mark_saved(row[1] for row in group)
+    return True
+
+# Count one more save in meta; snapshots are stamped with the count to tell
+# whether the database changed after they were written
+def bump_generation(conn):
+    rollups.set_meta(conn, "generation", rollups.get_meta(conn, "generation", 0) + 1)
 
-        for record in stock.history:
+# Open, high or low column read from dailyData, with NULL as NaN
+def price_column(values):
+    nulls = values.count(None)
+    if nulls == len(values):
+        return nan_column(nulls)
+    return array("d", values if not nulls else (NAN if value is None else value for value in values))
+
+# Append (date, price, volume, open, high, low) rows to a history. Whole batches
+# are converted to columns at once; rows are only checked one by one if a batch
+# holds bad values.
+def fill_history(history, rows):
+    rows = list(rows)
+    metrics.count("db.rows_read", len(rows))
+    try:
+        days, closes, volumes, *prices = zip(*rows) if rows else ((),) * 6
+        history.extend_columns(array("q", days), array("d", closes), array("d", volumes),
+                               *(price_column(column) for column in prices))
+    except TypeError:
+        for day, price, volume, *prices in rows:
             try:
-                cur.execute("INSERT OR REPLACE INTO dailyData (symbol, date, price, volume) VALUES (?, ?, ?, ?);",
-                            (stock.symbol, record.date.strftime("%m/%d/%y"), record.close, record.volume))
-            except Exception as e:
-                print(f"[ERROR] Saving data for {stock.symbol} on {record.date}: {e}")
+                history.append_row(int(day), float(price), float(volume),
+                                   *(NAN if value is None else float(value) for value in prices))
+            except (TypeError, ValueError) as e:
+                print(f"Reading row is generating an ERROR {(day, price, volume)}: {e}")
+    history.mark_clean()
 
-    conn.commit()
-    conn.close()
+# Load one symbol's history, oldest bar first, optionally limited to a date range
+@metrics.timed("db.load_history")
+def load_stock_history(symbol, date_start=None, date_end=None):
+    first = to_epoch_day(date_start) if date_start else MIN_DAY
+    last = to_epoch_day(date_end) if date_end else MAX_DAY
+    with database().reader() as conn:
+        rows = conn.execute("SELECT date, price, volume, open, high, low FROM dailyData"
+                            " WHERE symbol = ? AND date BETWEEN ? AND ? ORDER BY date;", (symbol, first, last))
+        history = History()
+        fill_history(history, rows)
+        return history
+
+# Weekly or monthly rollup of one symbol as (periods, opens, highs, lows,
+# closes, volumes) lists for periods starting in a date range
+@metrics.timed("db.load_rollup")
+def load_rollup(symbol, tier, date_start=None, date_end=None):
+    with database().reader() as conn:
+        return rollups.read(conn, symbol, tier, to_epoch_day(date_start) if date_start else None,
+                            to_epoch_day(date_end) if date_end else None)
+
+# (first, last) day numbers of a symbol's stored bars, rolled up or not, or None
+def stored_range(symbol):
+    with database().reader() as conn:
+        return rollups.stored_range(conn, symbol)
+
+# Keep only the last `days` days of daily bars (None keeps everything); older
+# bars survive in the weekly and monthly rollups. Compacts straight away.
+# Returns the daily bars deleted.
+def set_retention(days):
+    with database().transaction() as conn:
+        rollups.set_retention(conn, days)
+        deleted = rollups.compact(conn, force=True)
+        if deleted:
+            bump_generation(conn)
+        return deleted
 
-# Loading stock data from database
-def load_stock_data(stock_list):
+# Reclaim the space freed by compaction
+def vacuum_database():
+    with database().writer() as conn:
+        conn.execute("VACUUM;")
+
+# Loading stock data from database into a Portfolio.
+# Eager mode streams dailyData once in primary key order (symbol, date), so no
+# history needs sorting afterwards. Lazy mode reads only the stocks table and
+# fetches each symbol's bars the first time its history is used.
+@metrics.timed("db.load")
+def load_stock_data(stock_list, lazy=False):
     stock_list.clear()
-    conn = sqlite3.connect("stocks.db")
-    cur = conn.cursor()
-
-    cur.execute("SELECT symbol, name, shares FROM stocks;")
-    for symbol, name, shares in cur.fetchall():
-        stock = Stock(symbol, name, shares)
-        cur2 = conn.cursor()
-        cur2.execute("SELECT date, price, volume FROM dailyData WHERE symbol = ?;", (symbol,))
-        for row in cur2.fetchall():
-            try:
-                date = datetime.strptime(row[0], "%m/%d/%y")
-                price = float(row[1])
-                volume = float(row[2])
-                stock.add_entry(DailyEntry(date, price, volume))
-            except Exception as e:
-                print(f"Reading row is generating an ERROR {row}: {e}")
-        stock_list.append(stock)
-
-    conn.close()
-    sort_stock_history_by_date(stock_list)
-
-# Scrape data from Yahoo! Finance
-def retrieve_stock_web(date_start, date_end, stock_list):
-    start_unix = str(int(time.mktime(time.strptime(date_start, "%m/%d/%y"))))
-    end_unix = str(int(time.mktime(time.strptime(date_end, "%m/%d/%y"))))
-    total_records = 0
+    with database().reader() as conn:
+        stocks = {}
+        for symbol, name, shares in conn.execute("SELECT symbol, name, shares FROM stocks ORDER BY symbol;"):
+            stock = Stock(symbol, name, shares)
+            if lazy:
+                stock.set_history_loader(load_stock_history)
+            stocks[symbol] = stock
+        stock_list.add_many(stocks.values())
 
-    options = webdriver.ChromeOptions()
-    options.add_experimental_option('excludeSwitches', ['enable-logging'])
-    options.add_experimental_option("prefs", {'profile.managed_default_content_settings.javascript': 2})
+        if not lazy:
+            rows = conn.execute("SELECT symbol, date, price, volume, open, high, low FROM dailyData"
+                                " ORDER BY symbol, date;")
+            for symbol, group in groupby(rows, key=itemgetter(0)):
+                stock = stocks.get(symbol)
+                if stock is not None:
+                    fill_history(stock.history, (row[1:] for row in group))
 
-    driver = None
-    try:
-        driver = webdriver.Chrome(options=options)
-        driver.implicitly_wait(10)
+    for stock in stock_list:
+        stock.mark_clean()
+
+# Convert m/d/yy start and end dates into day numbers
+def day_range(date_start, date_end):
+    return (to_epoch_day(datetime.strptime(date_start, "%m/%d/%y")),
+            to_epoch_day(datetime.strptime(date_end, "%m/%d/%y")))
+
+# Parts of the (start, end) day ranges in `gaps` outside the sorted (first,
+# last) ranges in `covered`
+def subtract_ranges(gaps, covered):
+    result = []
+    for start, end in gaps:
+        for first, last in covered:
+            if last < start or first > end:
+                continue
+            if first > start:
+                result.append((start, first - 1))
+            start = last + 1
+            if start > end:
+                break
+        if start <= end:
+            result.append((start, end))
+    return result
+
+# Day ranges between first_day and last_day (inclusive) that are not covered by
+# `days` (sorted) or by the sorted `empty` ranges that earlier fetches found
+# no bars in. Short gaps are weekends and holidays and are skipped, except
+# after the last bar when the range reaches the last few days, where new bars
+# may have been published since the previous fetch.
+def missing_ranges(days, first_day, last_day, today=None, empty=()):
+    today = to_epoch_day(date.today()) if today is None else today
+    last_day = min(last_day, today)
+    if first_day > last_day:
+        return []
+    lo, hi = bisect_left(days, first_day), bisect_right(days, last_day)
 
+    gaps = []
+    if lo == hi:
+        gaps.append((first_day, last_day))
+    else:
+        if days[lo] - first_day > MAX_MARKET_GAP:
+            gaps.append((first_day, days[lo] - 1))
+        for i in range(lo + 1, hi):
+            if days[i] - days[i - 1] - 1 > MAX_MARKET_GAP:
+                gaps.append((days[i - 1] + 1, days[i] - 1))
+        if last_day > days[hi - 1] and (last_day - days[hi - 1] > MAX_MARKET_GAP or
+                                        last_day > today - MAX_MARKET_GAP):
+            gaps.append((days[hi - 1] + 1, last_day))
+    if empty:
+        gaps = subtract_ranges(gaps, empty)
+
+    ranges = []
+    for start, end in gaps:
+        if ranges and start - ranges[-1][1] < MERGE_GAP_DAYS:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+# Work out the (symbol, start_unix, end_unix) requests needed to cover m/d/yy
+# start and end dates. In incremental mode only the missing ranges are requested;
+# histories that have not been loaded yet are checked against stocks.db without
+# loading them.
+@metrics.timed("web.plan")
+def plan_fetch(stock_list, date_start, date_end, incremental=True):
+    first_day, last_day = day_range(date_start, date_end)
+    if not incremental:
+        return [(symbol, first_day * 86400, (last_day + 1) * 86400) for symbol in stock_list.symbols()]
+
+    requests = []
+    checked_after = to_epoch_day(date.today()) - EMPTY_RANGE_DAYS
+    with database().reader() as conn:
+        # Bars deleted by the retention policy are not missing
+        first_day = max(first_day, rollups.get_meta(conn, "compacted_before", first_day))
         for stock in stock_list:
-            url = f"https://finance.yahoo.com/quote/{stock.symbol}/history?period1={start_unix}&period2={end_unix}&interval=1d&filter=history&frequency=1d"
-            print(f"Scraping: {url}")
-            driver.get(url)
-            soup = BeautifulSoup(driver.page_source, "html.parser")
-
-            rows = soup.find_all("tr")
-            for row in rows:
-                cells = row.find_all("td")
-                values = [cell.text.strip() for cell in cells]
-                if len(values) == 7:
-                    try:
-                        parsed_date = datetime.strptime(values[0].strip()[:12], "%b %d, %Y")
-                        price = float(values[5].replace(",", ""))
-                        volume = float(values[6].replace(",", ""))
-                        daily_entry = DailyEntry(parsed_date, price, volume)
-                        stock.add_entry(daily_entry)
-                        total_records += 1
-                    except Exception as e:
-                        print(f"Could not parse: {values} — {e}")
-                        continue
-            print(f"Done: {stock.symbol} - {total_records} entries added.")
-
-    except Exception as e:
-        raise RuntimeError(f"Web scraping failed: {e}")
-    finally:
-        if driver:
-            driver.quit()
+            if stock.history_loaded:
+                days = stock.history.days
+            else:
+                days = array("q", (row[0] for row in conn.execute(
+                    "SELECT date FROM dailyData WHERE symbol = ? AND date BETWEEN ? AND ? ORDER BY date;",
+                    (stock.symbol, first_day, last_day))))
+            empty = conn.execute("SELECT first_day, last_day FROM emptyRanges WHERE symbol = ? AND last_day >= ?"
+                                 " AND first_day <= ? AND checked > ? ORDER BY first_day;",
+                                 (stock.symbol, first_day, last_day, checked_after)).fetchall()
+            requests.extend((stock.symbol, start * 86400, (end + 1) * 86400)
+                            for start, end in missing_ranges(days, first_day, last_day, empty=empty))
+    return requests
+
+# Page cache shared by every fetch in this process, created on first use
+def fetch_cache():
+    global _fetch_cache
+    import stock_web
+
+    if _fetch_cache is None:
+        _fetch_cache = stock_web.FetchCache(FETCH_CACHE_DIR, FETCH_CACHE_TTL, FETCH_CACHE_BYTES)
+    return _fetch_cache
+
+# Scrape data from Yahoo! Finance.
+# Only the ranges each stock is missing are requested unless `incremental` is
+# False. Pages are served from `cache` while they are fresh: True uses the shared
+# fetch cache, False skips it, or pass a stock_web.FetchCache.
+# Requests run concurrently (see stock_web.fetch_ranges) and each result is
+# added to its stock here, on the calling thread. `progress(result, done, total)`
+# is called after every request.
+@metrics.timed("web.retrieve")
+def retrieve_stock_web(date_start, date_end, stock_list, workers=8, per_second=4.0, progress=None,
+                       base_url=None, incremental=True, cache=True):
+    import stock_web
+
+    requests = plan_fetch(stock_list, date_start, date_end, incremental)
+    if cache is True:
+        cache = fetch_cache()
+    total_records = 0
+    errors = []
+    fetched = []
+    if not requests:
+        print("All stocks are up to date.")
+        return 0
+
+    results = stock_web.fetch_ranges(requests, workers, per_second, base_url=base_url or stock_web.YAHOO_URL,
+                                     cache=cache or None)
+    for done, result in enumerate(results, start=1):
+        if result.error is not None:
+            print(f"Failed: {result.symbol} — {result.error}")
+            errors.append(result)
+        else:
+            with metrics.timer("web.merge"):
+                merged = stock_list.get(result.symbol).merge_columns(*result.columns)
+            total_records += len(result)
+            fetched.append(result)
+            print(f"Done: {result.symbol} - {merged.inserted} entries added, {merged.updated} updated.")
+        if progress:
+            progress(result, done, len(requests))
 
+    save_empty_ranges(fetched)
+
+    if errors and len(errors) == len(requests):
+        raise RuntimeError(f"Web scraping failed: {errors[0].error}")
     return total_records
 
-# Loading data from a Yahoo! Finance CSV file
+# (symbol, first_day, last_day) for a fetch of [start_unix, end_unix) that
+# returned no bars, or None. The last few days are left out since their bars
+# may not have been published yet.
+def empty_range(symbol, start_unix, end_unix, today=None):
+    today = to_epoch_day(date.today()) if today is None else today
+    first_day = start_unix // 86400
+    last_day = min(end_unix // 86400 - 1, today - MAX_MARKET_GAP)
+    return (symbol, first_day, last_day) if last_day >= first_day else None
+
+# Remember the ranges of fetch results whose page was an empty history table,
+# so plan_fetch skips them for EMPTY_RANGE_DAYS. Used by every front end.
+def save_empty_ranges(results):
+    today = to_epoch_day(date.today())
+    rows = [(*row, today) for row in (empty_range(result.symbol, *result.span, today) for result in results
+                                      if result.error is None and result.empty and result.span is not None)
+            if row is not None]
+    if not rows:
+        return
+    try:
+        with database().transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO emptyRanges (symbol, first_day, last_day, checked)"
+                             " VALUES (?, ?, ?, ?);", rows)
+    except sqlite3.Error as e:
+        print(f"[ERROR] Saving empty fetch ranges: {e}")
+
+# Parse a Yahoo! Finance CSV date (YYYY-MM-DD) into a day number
+@lru_cache(maxsize=None)
+def parse_csv_date(text):
+    return to_epoch_day(date.fromisoformat(text))
+
+# Convert a chunk of CSV rows to (days, closes, volumes) arrays in one pass per
+# column. If the chunk holds a bad row it is converted row by row instead so
+# only the bad rows are skipped.
+def convert_csv_rows(rows):
+    try:
+        dates, closes, volumes = zip(*[(row[0], row[4], row[6]) for row in rows])
+        columns = (array("q", map(parse_csv_date, dates)),
+                   array("d", map(float, closes)),
+                   array("d", map(float, volumes)))
+        metrics.count("csv.rows", len(rows))
+        return columns
+    except (IndexError, ValueError):
+        pass
+
+    columns = (array("q"), array("d"), array("d"))
+    for row in rows:
+        try:
+            values = (parse_csv_date(row[0]), float(row[4]), float(row[6]))
+        except (IndexError, ValueError) as e:
+            print(f"[ERROR] Skipped row: {e}")
+            metrics.count("csv.parse_failures")
+            continue
+        for column, value in zip(columns, values):
+            column.append(value)
+    metrics.count("csv.rows", len(columns[0]))
+    return columns
+
+# Convert a chunk of CSV lines (Date,Open,High,Low,Close,Adj Close,Volume) to
+# (days, closes, volumes) arrays. NumPy parses the whole chunk as one run of
+# numbers, with each date split into year, month and day, and the day numbers
+# are computed column-wise. A chunk it cannot take in one piece (quoted fields,
+# null values, bad dates, short rows) goes through the csv module and
+# convert_csv_rows instead.
+def convert_csv_lines(lines):
+    import numpy as np
+
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return array("q"), array("d"), array("d")
+    text = "".join(lines).replace("\r", "").replace("-", ",").replace("\n", ",")
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            values = np.fromstring(text, sep=",")
+    except (ValueError, DeprecationWarning):
+        values = None
+    if values is not None and values.size == 9 * len(lines):
+        table = values.reshape(-1, 9)
+        year, month, day = table[:, 0], table[:, 1], table[:, 2]
+        months = ((year - 1970) * 12 + month - 1).astype(np.int64).astype("datetime64[M]")
+        days = months.astype("datetime64[D]") + (day - 1).astype(np.int64)
+        if (table[:, :3] == np.floor(table[:, :3])).all() and ((month >= 1) & (month <= 12) & (day >= 1)).all() \
+                and (days.astype("datetime64[M]") == months).all():
+            metrics.count("csv.rows", len(table))
+            return (array("q", days.astype(np.int64).tobytes()),
+                    array("d", np.ascontiguousarray(table[:, 6]).tobytes()),
+                    array("d", np.ascontiguousarray(table[:, 8]).tobytes()))
+    return convert_csv_rows([row for row in csv.reader(lines) if row])
+
+# Read the date, close and volume columns of a Yahoo! Finance CSV file,
+# CSV_CHUNK_BYTES at a time
+@metrics.timed("csv.read")
+def read_csv_columns(filename):
+    columns = (array("q"), array("d"), array("d"))
+    with open(filename, newline="") as f:
+        next(f, None)  # Header row
+        while True:
+            lines = f.readlines(CSV_CHUNK_BYTES)
+            if not lines:
+                break
+            for column, chunk in zip(columns, convert_csv_lines(lines)):
+                column.extend(chunk)
+    return columns
+
+# Process pool worker: read one SYMBOL.csv file, returning (symbol, columns or None)
+def read_csv_file(filename):
+    symbol = os.path.splitext(os.path.basename(filename))[0].upper()
+    try:
+        return symbol, read_csv_columns(filename)
+    except OSError as e:
+        print(f"[ERROR] Reading {filename}: {e}")
+        return symbol, None
+
+# Loading data from a Yahoo! Finance CSV file. Bars are merged by date, so
+# importing the same file again does not duplicate them. Returns a MergeResult.
+@metrics.timed("csv.import")
 def import_stock_web_csv(stock_list, symbol, filename):
-    for stock in stock_list:
-        if stock.symbol == symbol:
-            try:
-                with open(filename, newline='') as f:
-                    reader = csv.reader(f)
-                    next(reader) 
-                    for row in reader:
-                        try:
-                            date = datetime.strptime(row[0], "%Y-%m-%d")
-                            close = float(row[4])
-                            volume = float(row[6])
-                            stock.add_entry(DailyEntry(date, close, volume))
-                        except Exception as e:
-                            print(f"[ERROR] Skipped row: {e}")
-            except FileNotFoundError:
-                print(f"File not found: {filename}")
+    stock = stock_list.get(symbol)
+    if stock is None:
+        return MergeResult(0, 0, 0)
+    try:
+        columns = read_csv_columns(filename)
+    except FileNotFoundError:
+        print(f"File not found: {filename}")
+        return MergeResult(0, 0, 0)
+    return stock.merge_columns(*columns)
+
+# Import many SYMBOL.csv files, given as a directory or a glob pattern. Files are
+# parsed in parallel worker processes; the rows are merged into the matching stocks
+# here. Files for symbols not in the list are skipped unless add_missing is set.
+# Returns the MergeResult totals over all files. (Metrics recorded inside worker
+# processes stay there; the parent times the whole import and counts merged rows.)
+@metrics.timed("csv.import_files")
+def import_stock_csv_files(stock_list, source, processes=None, add_missing=False):
+    if os.path.isdir(source):
+        source = os.path.join(source, "*.csv")
+    filenames = sorted(glob.glob(source))
+    totals = [0, 0, 0]
+
+    if len(filenames) > 1 and processes != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=processes)
+        results = executor.map(read_csv_file, filenames, chunksize=8)
+    else:
+        executor = None
+        results = map(read_csv_file, filenames)
+    try:
+        for symbol, columns in results:
+            if columns is None:
+                continue
+            stock = stock_list.get(symbol)
+            if stock is None:
+                if not add_missing:
+                    print(f"Skipped {symbol}: not in your stock list.")
+                    continue
+                stock = Stock(symbol, symbol, 0.0)
+                stock_list.add(stock)
+            metrics.count("csv.files")
+            for n, count in enumerate(stock.merge_columns(*columns)):
+                totals[n] += count
+    finally:
+        if executor:
+            executor.shutdown()
+    return MergeResult(*totals)
 
 def main():
     clear_console()
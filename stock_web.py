@@ -0,0 +1,266 @@
+import gzip
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import lru_cache
+from html.parser import HTMLParser
+from stock_class import to_epoch_day
+import metrics
+
+YAHOO_URL = "https://finance.yahoo.com"
+HISTORY_PATH = "/quote/{symbol}/history?period1={start}&period2={end}&interval=1d&filter=history&frequency=1d"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Result of fetching one symbol: parsed (days, closes, volumes) columns or the error that stopped it
+class FetchResult:
+    def __init__(self, symbol, columns=None, failures=0, error=None, span=None, empty=False):
+        self.symbol = symbol
+        self.columns = columns if columns is not None else (array("q"), array("d"), array("d"))
+        self.failures = failures  # Table rows that could not be parsed
+        self.error = error
+        self.span = span  # (start_unix, end_unix) of the request
+        self.empty = empty  # The page held a history table with no price rows
+
+    def __len__(self):
+        return len(self.columns[0])
+
+
+# Spaces out requests to the same host so they start at most `per_second` times a second
+class RateLimiter:
+    def __init__(self, per_second):
+        self._interval = 1.0 / per_second if per_second else 0.0
+        self._next_start = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# On-disk cache of downloaded pages, one gzip file per URL. Entries older than
+# `ttl` seconds are treated as missing (ttl=None keeps them forever, which lets
+# pages be re-parsed without touching the network). When the folder grows past
+# `max_bytes`, the least recently used files are removed.
+class FetchCache:
+    def __init__(self, folder, ttl=12 * 3600, max_bytes=256 * 1024 * 1024):
+        self.folder = os.path.abspath(folder)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+    def _path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".html.gz")
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            modified = os.stat(path).st_mtime
+            if self.ttl is not None and time.time() - modified > self.ttl:
+                return None
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path, (time.time(), modified))  # Access time drives eviction
+            metrics.count("web.cache_hits")
+            return text
+        except (OSError, EOFError):
+            return None
+
+    def put(self, url, text):
+        path = self._path(url)
+        data = gzip.compress(text.encode("utf-8"))
+        handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        with self._lock:
+            try:
+                self._size -= os.stat(path).st_size
+            except OSError:
+                pass
+            os.replace(temp_path, path)
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    # Drop least recently used files until the cache is back under 90% of max_bytes
+    def _evict(self):
+        entries = sorted((entry for entry in os.scandir(self.folder) if entry.name.endswith(".html.gz")),
+                         key=lambda entry: entry.stat().st_atime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._size -= size
+            except OSError:
+                pass
+
+
+# Collects the text of every <td> cell, one list per table row, and of every
+# <th> cell, one list per header row
+class HistoryTableParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        self.headers = []
+        self._row = None
+        self._header = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "tr":
+            self._row = []
+            self._header = []
+        elif tag in ("td", "th") and self._row is not None:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag in ("td", "th") and self._cell is not None:
+            (self._row if tag == "td" else self._header).append("".join(self._cell).strip())
+            self._cell = None
+        elif tag == "tr" and self._row is not None:
+            self.rows.append(self._row)
+            if self._header:
+                self.headers.append(self._header)
+            self._row = self._header = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+
+# Parse a history table date such as "Jan 03, 2020" into a day number
+@lru_cache(maxsize=None)
+def parse_page_date(text):
+    return to_epoch_day(datetime.strptime(text.strip()[:12], "%b %d, %Y"))
+
+# Extract (days, closes, volumes) columns from a Yahoo! Finance history page.
+# Returns the columns and the number of price rows that could not be parsed.
+@metrics.timed("web.parse")
+def parse_history_page(html):
+    parser = HistoryTableParser()
+    parser.feed(html)
+    parser.close()
+    days, closes, volumes = array("q"), array("d"), array("d")
+    failures = 0
+    for values in parser.rows:
+        if len(values) == 7:
+            try:
+                row = (parse_page_date(values[0]),
+                       float(values[5].replace(",", "")),
+                       float(values[6].replace(",", "")))
+            except ValueError as e:
+                print(f"Could not parse: {values} — {e}")
+                failures += 1
+                continue
+            days.append(row[0])
+            closes.append(row[1])
+            volumes.append(row[2])
+    metrics.count("web.rows_parsed", len(days))
+    metrics.count("web.parse_failures", failures)
+    return (days, closes, volumes), failures
+
+# True if a page holds a history table, recognized by its "Date ... Volume"
+# header row, without any price rows. Consent, error and redesigned pages have
+# no such table, so they are never taken for a range without trading.
+def is_empty_history(html):
+    parser = HistoryTableParser()
+    parser.feed(html)
+    parser.close()
+    has_table = any(cells[0].startswith("Date") and any(cell.startswith("Volume") for cell in cells)
+                    for cells in parser.headers)
+    return has_table and not any(len(values) == 7 for values in parser.rows)
+
+# Build the history page URL for a symbol and a unix time range
+def history_url(base_url, symbol, start_unix, end_unix):
+    return base_url.rstrip("/") + HISTORY_PATH.format(symbol=urllib.parse.quote(symbol), start=start_unix, end=end_unix)
+
+# Download a page, retrying connection errors and throttled or failed responses
+# with exponential backoff plus jitter. Pages found in `cache` skip the network.
+def fetch_page(url, limiter=None, retries=3, backoff=0.5, timeout=30, cache=None):
+    if cache is not None:
+        text = cache.get(url)
+        if text is not None:
+            return text
+    text = download_page(url, limiter, retries, backoff, timeout)
+    if cache is not None:
+        metrics.count("web.cache_misses")
+        cache.put(url, text)
+    return text
+
+@metrics.timed("web.download")
+def download_page(url, limiter=None, retries=3, backoff=0.5, timeout=30):
+    host = urllib.parse.urlsplit(url).netloc
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.wait(host)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                charset = response.headers.get_content_charset() or "utf-8"
+                body = response.read()
+            metrics.count("web.requests")
+            metrics.count("web.bytes_fetched", len(body))
+            return body.decode(charset, errors="replace")
+        except urllib.error.HTTPError as e:
+            metrics.count("web.http_errors")
+            if e.code not in RETRY_STATUS or attempt >= retries:
+                raise
+        except (urllib.error.URLError, TimeoutError, ConnectionError):
+            metrics.count("web.connection_errors")
+            if attempt >= retries:
+                raise
+        metrics.count("web.retries")
+        time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+        attempt += 1
+
+# Fetch and parse one symbol's history page; errors are returned, not raised
+def fetch_history(symbol, start_unix, end_unix, base_url=YAHOO_URL, limiter=None, retries=3, cache=None):
+    try:
+        url = history_url(base_url, symbol, start_unix, end_unix)
+        html = fetch_page(url, limiter, retries, cache=cache)
+        columns, failures = parse_history_page(html)
+        empty = not len(columns[0]) and not failures and is_empty_history(html)
+        return FetchResult(symbol, columns, failures, span=(start_unix, end_unix), empty=empty)
+    except Exception as e:
+        return FetchResult(symbol, error=e, span=(start_unix, end_unix))
+
+# Fetch (symbol, start_unix, end_unix) requests on a bounded pool of worker
+# threads and yield a FetchResult for each one as soon as it is done. Each
+# worker parses its own page, so parsing overlaps with the other downloads.
+def fetch_ranges(requests, workers=8, per_second=4.0, retries=3, base_url=YAHOO_URL, cache=None):
+    limiter = RateLimiter(per_second)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(fetch_history, symbol, start_unix, end_unix, base_url, limiter, retries, cache)
+                   for symbol, start_unix, end_unix in requests]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Fetch the same date range for many symbols (see fetch_ranges)
+def fetch_histories(symbols, start_unix, end_unix, workers=8, per_second=4.0, retries=3, base_url=YAHOO_URL,
+                    cache=None):
+    requests = [(symbol, start_unix, end_unix) for symbol in symbols]
+    return fetch_ranges(requests, workers, per_second, retries, base_url, cache)
@@ -0,0 +1,219 @@
+import socket
+import time
+from collections import namedtuple
+from stock_class import Stock, DailyEntry, from_epoch_day
+import metrics
+
+# Intraday ticks folded into daily OHLC bars as they stream in. A tick is
+# (symbol, timestamp, price, size) with the timestamp in Unix seconds (UTC);
+# feeds are text lines "SYMBOL,TIMESTAMP,PRICE,SIZE", read from a file or a TCP
+# socket a chunk at a time.
+#
+# Only one bar per symbol is kept open, so memory grows with the number of
+# symbols, never with the number of ticks. The session closes at
+# SESSION_END_SECONDS (checked against each tick's time, and against the clock
+# while a live feed is idle) or at the first tick of a new session day,
+# whichever comes first; its bars are then upserted into the portfolio and
+# saved to stocks.db.
+
+SESSION_UTC_OFFSET = -5 * 3600  # Seconds from UTC to the exchange day (US Eastern; any DST offset gives the same day for market hours)
+SESSION_END_SECONDS = 16 * 3600  # Seconds into the exchange day when the session closes (4 PM)
+IDLE_SECONDS = 5.0  # A quiet live feed checks the session close this often
+READ_CHUNK_BYTES = 1 << 20  # Bytes of feed text parsed per chunk
+
+IngestResult = namedtuple("IngestResult", ["ticks", "bars", "sessions", "late_ticks", "skipped_bars"])
+
+
+# Keeps the open bar of each symbol for the current session day and hands
+# closed bars to on_bar(symbol, day, open, high, low, close, volume).
+# Ticks for a session that has already closed are counted and dropped.
+class TickAggregator:
+    def __init__(self, on_bar, utc_offset=SESSION_UTC_OFFSET, session_end=SESSION_END_SECONDS):
+        self._on_bar = on_bar
+        self._offset = utc_offset
+        self._session_end = session_end
+        self._bars = {}  # symbol -> [day, open, high, low, close, volume]
+        self._day = None  # Session day of the newest tick
+        self._close_at = float("inf")  # Unix time the current session closes
+        self._closed = False  # The current day's session has closed
+        self.ticks = 0
+        self.late_ticks = 0
+        self.sessions = 0
+
+    @property
+    def day(self):
+        return self._day
+
+    @property
+    def open_bars(self):
+        return len(self._bars)
+
+    def add(self, symbol, timestamp, price, size):
+        self.add_many(((symbol, timestamp, price, size),))
+
+    # Fold a batch of ticks into the open bars. Ticks for a symbol's open bar
+    # stay on the fast path; anything else goes through _start.
+    def add_many(self, ticks):
+        bars, offset = self._bars, self._offset
+        count = 0
+        for symbol, timestamp, price, size in ticks:
+            count += 1
+            if timestamp >= self._close_at:
+                self.check_clock(timestamp)
+            day = int(timestamp + offset) // 86400
+            bar = bars.get(symbol)
+            if bar is not None and bar[0] == day:
+                if price > bar[2]:
+                    bar[2] = price
+                elif price < bar[3]:
+                    bar[3] = price
+                bar[4] = price
+                bar[5] += size
+            else:
+                self._start(symbol, day, price, size)
+        self.ticks += count
+        metrics.count("ticks.read", count)
+
+    # First tick of a symbol's bar; a new session day closes the previous one
+    def _start(self, symbol, day, price, size):
+        if self._day is None or day > self._day:
+            self.close_session()
+            self._day = day
+            self._close_at = day * 86400 + self._session_end - self._offset
+            self._closed = False
+        elif day < self._day or self._closed:
+            self.late_ticks += 1
+            metrics.count("ticks.late")
+            return
+        self._bars[symbol] = [day, price, price, price, price, size]
+
+    # Close the session once `now` (a unix time, the clock by default) has
+    # reached its end; later ticks for the same day are dropped as late
+    def check_clock(self, now=None):
+        if (time.time() if now is None else now) >= self._close_at:
+            self._close_at = float("inf")
+            self._closed = True
+            self.close_session()
+
+    # Close every open bar, as at the end of a session or of the feed. The dict
+    # is emptied in place, since add_many keeps a reference to it.
+    def close_session(self):
+        if not self._bars:
+            return
+        bars = list(self._bars.items())
+        self._bars.clear()
+        for symbol, (day, open_price, high, low, close, volume) in bars:
+            self._on_bar(symbol, day, open_price, high, low, close, volume)
+        self.sessions += 1
+        metrics.count("ticks.bars", len(bars))
+
+
+# Split a stream of bytes from read(size) into lists of complete lines. A read
+# that returns None (nothing arrived in time) yields an empty list.
+def _line_chunks(read, chunk_bytes=READ_CHUNK_BYTES):
+    rest = b""
+    while True:
+        data = read(chunk_bytes)
+        if data is None:
+            yield []
+            continue
+        if not data:
+            break
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        if lines:
+            yield lines
+    if rest.strip():
+        yield [rest]
+
+# Convert feed lines to ticks in one pass. If a chunk holds a bad line it is
+# converted line by line instead so only the bad lines are skipped; blank lines
+# and a "symbol,..." header are ignored.
+def parse_ticks(lines):
+    try:
+        return [(symbol.decode(), float(timestamp), float(price), float(size))
+                for symbol, timestamp, price, size in (line.split(b",") for line in lines)]
+    except (ValueError, UnicodeDecodeError):
+        pass
+
+    ticks = []
+    for line in lines:
+        if not line.strip() or line.lower().startswith(b"symbol"):
+            continue
+        try:
+            symbol, timestamp, price, size = line.split(b",")
+            ticks.append((symbol.decode(), float(timestamp), float(price), float(size)))
+        except (ValueError, UnicodeDecodeError) as e:
+            print(f"[ERROR] Skipped tick {line[:80]!r}: {e}")
+            metrics.count("ticks.parse_failures")
+    return ticks
+
+# Ticks from a feed file, as one list per chunk
+def read_tick_file(path, chunk_bytes=READ_CHUNK_BYTES):
+    with open(path, "rb") as f:
+        for lines in _line_chunks(f.read, chunk_bytes):
+            yield parse_ticks(lines)
+
+# Ticks from a TCP feed until the server closes the connection, as one list
+# per block received, and an empty list after every idle_seconds without data
+def read_tick_socket(host, port, timeout=None, chunk_bytes=READ_CHUNK_BYTES, idle_seconds=IDLE_SECONDS):
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.settimeout(idle_seconds)
+
+        def read(size):
+            try:
+                return sock.recv(size)
+            except socket.timeout:
+                return None
+
+        for lines in _line_chunks(read, chunk_bytes):
+            yield parse_ticks(lines)
+
+# Stream tick chunks into the portfolio. At every session close the finished
+# bars are upserted into the stocks' histories as DailyEntry bars and, with
+# save, written to stocks.db on their own (other unsaved changes stay pending);
+# the end of the feed closes the last session. An empty chunk, as a quiet live
+# feed yields, checks the session end against the clock.
+# Symbols not in the list are skipped unless add_missing is set.
+# Returns an IngestResult.
+@metrics.timed("ticks.ingest")
+def ingest(stock_list, chunks, add_missing=False, save=True, utc_offset=SESSION_UTC_OFFSET):
+    import stock_data
+
+    closed = []
+    unknown = set()
+    bars = skipped_bars = 0
+
+    def store():
+        nonlocal bars, skipped_bars
+        rows, added = [], []
+        for symbol, day, open_price, high, low, close, volume in closed:
+            stock = stock_list.get(symbol)
+            if stock is None:
+                if not add_missing:
+                    if symbol not in unknown:
+                        print(f"Skipped {symbol}: not in your stock list.")
+                        unknown.add(symbol)
+                    skipped_bars += 1
+                    continue
+                stock = Stock(symbol, symbol, 0.0)
+                stock_list.add(stock)
+                added.append(stock)
+            stock.history.insert(DailyEntry(from_epoch_day(day), close, volume, open_price, high, low))
+            rows.append((stock.symbol, day, close, volume, open_price, high, low))
+            bars += 1
+        if rows and save:
+            stock_data.save_bars(stock_list, rows, added)
+        closed.clear()
+
+    aggregator = TickAggregator(lambda *bar: closed.append(bar), utc_offset)
+    for chunk in chunks:
+        if chunk:
+            aggregator.add_many(chunk)
+        else:
+            aggregator.check_clock()
+        if closed:
+            store()
+    aggregator.close_session()
+    store()
+    return IngestResult(aggregator.ticks, bars, aggregator.sessions, aggregator.late_ticks, skipped_bars)
@@ -1,7 +1,23 @@
 import os
 import platform
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+from functools import lru_cache
+from stock_class import from_epoch_day, to_epoch_day
+import rollups
+import metrics
+
+# NumPy and matplotlib are imported inside the chart functions, so programs
+# that never draw a chart start without loading them.
+
+CHART_WINDOW = "Price Chart"  # Figure reused by show_price_chart
+MARKER_LIMIT = 60  # Draw point markers only for short series
+
+# Offset from an epoch day to a matplotlib date number
+@lru_cache(maxsize=None)
+def date_offset():
+    import matplotlib.dates as mdates
+    return mdates.date2num(from_epoch_day(0))
 
 # Clear the console screen based on the operating system
 def clear_console():
@@ -10,40 +26,195 @@ def clear_console():
     else:
         os.system('clear')
 
-# Sort the stock list alphabetically by symbol
-def sort_stocks_by_symbol(stock_list):
-    stock_list.sort(key=lambda stock: stock.symbol)
-
-# Sort each stock's history list by date (oldest to newest)
+# Sort each stock's history list by date (oldest to newest).
+# Histories that are not loaded yet already come back from the database in order.
+@metrics.timed("history.sort")
 def sort_stock_history_by_date(stock_list):
     for stock in stock_list:
-        stock.history.sort(key=lambda record: record.date)
+        if stock.history_loaded:
+            stock.history.sort()
+
+# Largest-Triangle-Three-Buckets downsampling: pick `threshold` of the points
+# (xs, ys) that keep the visual shape of the line. Returns the chosen indices.
+def lttb_indices(xs, ys, threshold):
+    import numpy as np
+
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    chosen = np.empty(threshold, dtype=np.int64)
+    chosen[0], chosen[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else count
+        # Average of the next bucket is the third corner of the triangle
+        next_x = xs[stop:next_stop].mean()
+        next_y = ys[stop:next_stop].mean()
+        areas = np.abs((xs[previous] - next_x) * (ys[start:stop] - ys[previous])
+                       - (xs[previous] - xs[start:stop]) * (next_y - ys[previous]))
+        previous = start + int(np.argmax(areas))
+        chosen[bucket + 1] = previous
+    return chosen
+
+# Weekly or monthly closes for a chart, when the date range is long enough for
+# rollups.choose_tier to pick one that still fills max_points and the stock has
+# nothing unsaved; otherwise None
+def rollup_points(stock, date_start, date_end, max_points):
+    import stock_data
+
+    if stock.history_loaded:
+        history = stock.history
+        if history.has_changes or not len(history) or not history.is_sorted():
+            return None
+        stored = (history.days[0], history.days[-1])
+    else:
+        stored = stock_data.stored_range(stock.symbol)
+        if stored is None:
+            return None
+    first = max(stored[0], to_epoch_day(date_start)) if date_start else stored[0]
+    last = min(stored[1], to_epoch_day(date_end)) if date_end else stored[1]
+    tier = rollups.choose_tier(first, last, max_points)
+    if tier == "daily":
+        return None
+    periods, _, _, _, closes, _ = stock_data.load_rollup(stock.symbol, tier, date_start, date_end)
+    if not periods:
+        return None
+    metrics.count(f"chart.tier.{tier}")
+    return periods, closes
+
+# Chart data for one stock: matplotlib date numbers and closes for the bars
+# between date_start and date_end (datetimes, None for open ends), downsampled
+# to at most max_points with LTTB. Long ranges are drawn from the weekly or
+# monthly rollups in stocks.db instead of the daily bars. Only the requested
+# range is copied.
+@metrics.timed("chart.points")
+def chart_points(stock, date_start=None, date_end=None, max_points=None):
+    import numpy as np
+
+    points = rollup_points(stock, date_start, date_end, max_points) if max_points else None
+    if points is None:
+        history = stock.history
+        history.sort()
+        days = history.days
+        first = bisect_left(days, to_epoch_day(date_start)) if date_start else 0
+        last = bisect_right(days, to_epoch_day(date_end)) if date_end else len(days)
+        window = history[first:max(first, last)]
+        points = window.days, window.closes
+    xs = np.array(points[0], dtype=np.float64) + date_offset()
+    ys = np.array(points[1], dtype=np.float64)
+    if max_points:
+        keep = lttb_indices(xs, ys, max_points)
+        xs, ys = xs[keep], ys[keep]
+    metrics.count("chart.points_plotted", len(xs))
+    return xs, ys
+
+# True if a stock has any bars, without loading a lazy history
+def has_bars(stock):
+    import stock_data
+
+    if stock.history_loaded:
+        return len(stock.history) > 0
+    return stock_data.stored_range(stock.symbol) is not None
+
+# Look up the stocks for one symbol, a comma separated string or a list of symbols
+def find_chart_stocks(stock_list, symbols):
+    if isinstance(symbols, str):
+        symbols = symbols.split(",")
+    found = []
+    for symbol in (symbol.strip() for symbol in symbols):
+        stock = stock_list.get(symbol)
+        if stock is None:
+            print(f"{symbol} not found in your stock list.")
+        elif not has_bars(stock):
+            print(f"No historical data for {symbol}")
+        else:
+            found.append(stock)
+    return found
+
+# Number of points worth drawing across an axes: two per horizontal pixel
+def point_budget(ax):
+    return max(2 * int(ax.get_window_extent().width), 100)
+
+# Plot one line per stock on `ax`, titled and formatted like the price chart
+@metrics.timed("chart.draw")
+def draw_price_chart(ax, stocks, date_start=None, date_end=None):
+    import matplotlib.dates as mdates
+
+    budget = point_budget(ax)
+    lines = []
+    for stock in stocks:
+        xs, ys = chart_points(stock, date_start, date_end, budget)
+        marker = 'o' if len(xs) <= MARKER_LIMIT else None
+        lines.extend(ax.plot(xs, ys, marker=marker, linestyle='-', label=stock.symbol.upper()))
+    ax.set_title(" / ".join(stock.symbol.upper() for stock in stocks) + " Price Chart")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Close Price ($)")
+    ax.grid(True)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.tick_params(axis="x", labelrotation=45)
+    ax.legend()
+    return lines
+
+# Re-sample each line for the visible date range after a zoom or pan
+def resample_on_zoom(ax, stocks, lines):
+    import matplotlib.dates as mdates
+
+    def on_xlim_changed(ax):
+        low, high = ax.get_xlim()
+        date_start = mdates.num2date(low).replace(tzinfo=None)
+        date_end = mdates.num2date(high).replace(tzinfo=None)
+        for stock, line in zip(stocks, lines):
+            xs, ys = chart_points(stock, date_start - timedelta(days=1), date_end + timedelta(days=1),
+                                  point_budget(ax))
+            line.set_data(xs, ys)
+            line.set_marker('o' if len(xs) <= MARKER_LIMIT else None)
+        metrics.count("chart.resamples")
+
+    ax.callbacks.connect("xlim_changed", on_xlim_changed)
+
+# Show a price chart (line plot) for one or more stocks, optionally limited to a date range.
+# The same window is reused for every chart.
+def show_price_chart(stock_list, symbol, date_start=None, date_end=None):
+    import matplotlib.pyplot as plt
+
+    stocks = find_chart_stocks(stock_list, symbol)
+    if not stocks:
+        return
+
+    fig = plt.figure(num=CHART_WINDOW, figsize=(10, 5))
+    fig.clf()
+    ax = fig.add_subplot()
+    lines = draw_price_chart(ax, stocks, date_start, date_end)
+    fig.tight_layout()
+    resample_on_zoom(ax, stocks, lines)
+    plt.show()
+
+# Render a price chart straight to a PNG file without opening a window
+def save_price_chart(stock_list, symbol, filename, date_start=None, date_end=None, size=(10, 5), dpi=100):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    stocks = find_chart_stocks(stock_list, symbol)
+    if not stocks:
+        return False
+    fig = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    draw_price_chart(fig.add_subplot(), stocks, date_start, date_end)
+    fig.tight_layout()
+    with metrics.timer("chart.save"):
+        fig.savefig(filename)
+    return True
 
-# Show a simple price chart (line plot) for a specific stock
-def show_price_chart(stock_list, symbol):
+# Render one PNG per stock into a folder for batch reports; returns the files written
+def save_price_charts(stock_list, folder, date_start=None, date_end=None):
+    os.makedirs(folder, exist_ok=True)
+    written = []
     for stock in stock_list:
-        if stock.symbol.lower() == symbol.lower():
-            if not stock.history:
-                print(f"No historical data for {symbol}")
-                return
-
-            # Sort history by date to ensure correct plotting
-            stock.history.sort(key=lambda record: record.date)
-            dates = [r.date for r in stock.history]
-            prices = [r.close for r in stock.history]
-
-            plt.figure(figsize=(10, 5))
-            plt.plot(dates, prices, marker='o', linestyle='-', label=symbol.upper())
-            plt.title(f"{symbol.upper()} Price Chart")
-            plt.xlabel("Date")
-            plt.ylabel("Close Price ($)")
-            plt.xticks(rotation=45)
-            plt.grid(True)
-            plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-            plt.gca().xaxis.set_major_locator(mdates.AutoDateLocator())
-            plt.tight_layout()
-            plt.legend()
-            plt.show()
-            return
-
-    print(f"{symbol} not found in your stock list.")
+        if has_bars(stock):
+            filename = os.path.join(folder, f"{stock.symbol}.png")
+            if save_price_chart(stock_list, [stock.symbol], filename, date_start, date_end):
+                written.append(filename)
+    return written